@@ -0,0 +1,192 @@
+"""Sync schema with the models and add foreign key and sort indexes
+
+Revision ID: 5b8d2f4c9e1a
+Revises: 23a1165309f3
+Create Date: 2026-10-17 12:00:00.000000
+
+Databases at 23a1165309f3 got the remaining tables from init_db's create_all,
+so every step checks what already exists. On PostgreSQL the indexes of existing
+tables are built with CREATE INDEX CONCURRENTLY outside of a transaction, which
+does not block writes while they build.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8d2f4c9e1a'
+down_revision: Union[str, None] = '23a1165309f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Indexes added by this revision: (name, table, columns)
+INDEXES = [
+    ('ix_users_role_id', 'users', ['role_id']),
+    ('ix_users_created_at_id', 'users', ['created_at', 'id']),
+    ('ix_user_profiles_user_id', 'user_profiles', ['user_id']),
+    ('ix_posts_user_id', 'posts', ['user_id']),
+    ('ix_posts_parent_post_id', 'posts', ['parent_post_id']),
+    ('ix_posts_created_at_id', 'posts', ['created_at', 'id']),
+    ('ix_comments_post_id_created_at_id', 'comments', ['post_id', 'created_at', 'id']),
+    ('ix_comments_parent_comment_id', 'comments', ['parent_comment_id']),
+    ('ix_comments_user_id', 'comments', ['user_id']),
+    ('ix_media_post_id', 'media', ['post_id']),
+    ('ix_voice_messages_room_id_created_at', 'voice_messages', ['room_id', 'created_at']),
+    ('ix_voice_room_participants_room_id_user_id', 'voice_room_participants', ['room_id', 'user_id']),
+]
+
+post_visibility = sa.Enum('PUBLIC', 'PRIVATE', 'FOLLOWERS', name='postvisibility')
+post_type = sa.Enum('POST', 'SHARE', 'PROMOTION', name='posttype')
+media_type = sa.Enum('IMAGE', 'VIDEO', 'AUDIO', 'DOCUMENT', name='mediatype')
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    tables = set(inspector.get_table_names())
+    postgresql = bind.dialect.name == 'postgresql'
+
+    # Posts lost their title and gained likes, visibility, type and shares
+    post_columns = {column['name'] for column in inspector.get_columns('posts')}
+    if 'title' in post_columns:
+        with op.batch_alter_table('posts') as batch_op:
+            batch_op.drop_column('title')
+    if postgresql:
+        post_visibility.create(bind, checkfirst=True)
+        post_type.create(bind, checkfirst=True)
+    new_post_columns = [
+        sa.Column('likes', sa.Integer(), nullable=True),
+        sa.Column('visibility', post_visibility, nullable=True),
+        sa.Column('post_type', post_type, nullable=True),
+        sa.Column('parent_post_id', sa.Integer(), sa.ForeignKey('posts.id', name='posts_parent_post_id_fkey'), nullable=True),
+    ]
+    for column in new_post_columns:
+        if column.name not in post_columns:
+            with op.batch_alter_table('posts') as batch_op:
+                batch_op.add_column(column)
+
+    # String lengths and cascading foreign keys of the models
+    if postgresql:
+        op.alter_column('roles', 'name', type_=sa.String(length=50))
+        op.alter_column('roles', 'description', type_=sa.String(length=250))
+        op.alter_column('users', 'username', type_=sa.String(length=50))
+        op.alter_column('users', 'email', type_=sa.String(length=100))
+        op.alter_column('users', 'hashed_password', type_=sa.String(length=255))
+        for table, column, referred in [('users', 'role_id', 'roles'), ('posts', 'user_id', 'users')]:
+            name = f'{table}_{column}_fkey'
+            op.drop_constraint(name, table, type_='foreignkey')
+            op.create_foreign_key(name, table, referred, [column], ['id'], ondelete='CASCADE')
+    unique_constraints = {c['name'] for c in inspector.get_unique_constraints('users')}
+    if 'uq_username_email' not in unique_constraints:
+        with op.batch_alter_table('users') as batch_op:
+            batch_op.create_unique_constraint('uq_username_email', ['username', 'email'])
+
+    # Tables that only existed in the models
+    if 'user_profiles' not in tables:
+        op.create_table('user_profiles',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('first_name', sa.String(length=50), nullable=False),
+        sa.Column('last_name', sa.String(length=50), nullable=False),
+        sa.Column('bio', sa.String(length=250), nullable=True),
+        sa.Column('profile_photo', sa.String(length=255), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_user_profiles_id'), 'user_profiles', ['id'], unique=False)
+    if 'comments' not in tables:
+        op.create_table('comments',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('content', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.Column('likes', sa.Integer(), nullable=True),
+        sa.Column('parent_comment_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['parent_comment_id'], ['comments.id'], ),
+        sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_comments_id'), 'comments', ['id'], unique=False)
+    if 'media' not in tables:
+        op.create_table('media',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('file_url', sa.String(), nullable=False),
+        sa.Column('media_type', media_type, nullable=True),
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_media_id'), 'media', ['id'], unique=False)
+    if 'voice_rooms' not in tables:
+        op.create_table('voice_rooms',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('description', sa.String(length=255), nullable=True),
+        sa.Column('created_by', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('is_private', sa.Boolean(), nullable=True),
+        sa.Column('max_participants', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['created_by'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_voice_rooms_id'), 'voice_rooms', ['id'], unique=False)
+    if 'voice_messages' not in tables:
+        op.create_table('voice_messages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('room_id', sa.Integer(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('file_url', sa.String(), nullable=False),
+        sa.Column('duration', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['room_id'], ['voice_rooms.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_voice_messages_id'), 'voice_messages', ['id'], unique=False)
+    if 'voice_room_participants' not in tables:
+        op.create_table('voice_room_participants',
+        sa.Column('room_id', sa.Integer(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('is_muted', sa.Boolean(), nullable=True),
+        sa.Column('joined_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['room_id'], ['voice_rooms.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        )
+
+    # Foreign key and sort indexes, concurrently on PostgreSQL
+    if postgresql:
+        # A failed concurrent build leaves an invalid index behind, rebuild it
+        invalid = bind.execute(sa.text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE NOT i.indisvalid"
+        )).scalars().all()
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                if name in invalid:
+                    op.drop_index(name, table_name=table, postgresql_concurrently=True)
+                op.create_index(name, table, columns, unique=False,
+                                postgresql_concurrently=True, if_not_exists=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    # Only the indexes are dropped, the tables and columns match the models
+    # and may hold data created since the upgrade
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in reversed(INDEXES):
+                op.drop_index(name, table_name=table, postgresql_concurrently=True,
+                              if_exists=True)
+    else:
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,44 @@
+"""Add likes table
+
+Revision ID: 8e3a6c1d7f20
+Revises: 5b8d2f4c9e1a
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e3a6c1d7f20'
+down_revision: Union[str, None] = '5b8d2f4c9e1a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # init_db's create_all may have created the table already
+    if 'likes' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table('likes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=True),
+    sa.Column('comment_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+    sa.CheckConstraint('(post_id IS NULL) <> (comment_id IS NULL)', name='ck_likes_one_target'),
+    sa.ForeignKeyConstraint(['comment_id'], ['comments.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'comment_id', name='uq_likes_user_id_comment_id'),
+    sa.UniqueConstraint('user_id', 'post_id', name='uq_likes_user_id_post_id')
+    )
+    op.create_index(op.f('ix_likes_id'), 'likes', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_likes_id'), table_name='likes')
+    op.drop_table('likes')
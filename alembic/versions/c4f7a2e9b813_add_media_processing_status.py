@@ -0,0 +1,45 @@
+"""Add media processing status
+
+Revision ID: c4f7a2e9b813
+Revises: 8e3a6c1d7f20
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4f7a2e9b813'
+down_revision: Union[str, None] = '8e3a6c1d7f20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+media_status = sa.Enum('PENDING', 'PROCESSING', 'READY', 'FAILED', name='mediastatus')
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    # init_db's create_all may have added the columns already
+    columns = {column['name'] for column in sa.inspect(bind).get_columns('media')}
+    if bind.dialect.name == 'postgresql':
+        media_status.create(bind, checkfirst=True)
+    # Existing media were processed during their upload
+    with op.batch_alter_table('media') as batch_op:
+        if 'status' not in columns:
+            batch_op.add_column(sa.Column('status', media_status, server_default='READY', nullable=False))
+        if 'source_url' not in columns:
+            batch_op.add_column(sa.Column('source_url', sa.String(), nullable=True))
+        if 'error' not in columns:
+            batch_op.add_column(sa.Column('error', sa.String(length=255), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('media') as batch_op:
+        batch_op.drop_column('error')
+        batch_op.drop_column('source_url')
+        batch_op.drop_column('status')
+    if op.get_bind().dialect.name == 'postgresql':
+        media_status.drop(op.get_bind(), checkfirst=True)
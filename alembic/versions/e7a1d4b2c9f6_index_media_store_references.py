@@ -0,0 +1,50 @@
+"""Index the columns referencing media store files
+
+Revision ID: e7a1d4b2c9f6
+Revises: c4f7a2e9b813
+Create Date: 2026-10-17 16:00:00.000000
+
+Processed uploads are shared by content, a file is removed once no media row
+or profile references it, which is counted through these indexes.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7a1d4b2c9f6'
+down_revision: Union[str, None] = 'c4f7a2e9b813'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Indexes added by this revision: (name, table, columns)
+INDEXES = [
+    ('ix_media_file_url', 'media', ['file_url']),
+    ('ix_user_profiles_profile_photo', 'user_profiles', ['profile_photo']),
+]
+
+
+def upgrade() -> None:
+    # Built concurrently on PostgreSQL so uploads are not blocked meanwhile
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns, unique=False,
+                                postgresql_concurrently=True, if_not_exists=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in reversed(INDEXES):
+                op.drop_index(name, table_name=table, postgresql_concurrently=True,
+                              if_exists=True)
+    else:
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,41 @@
+"""Add image variants to media and user profiles
+
+Revision ID: f3c8b5a2d6e4
+Revises: e7a1d4b2c9f6
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3c8b5a2d6e4'
+down_revision: Union[str, None] = 'e7a1d4b2c9f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Variant columns added by this revision: (table, column)
+COLUMNS = [
+    ('media', 'variants'),
+    ('user_profiles', 'profile_photo_variants'),
+]
+
+
+def upgrade() -> None:
+    # init_db's create_all may have added the columns already
+    inspector = sa.inspect(op.get_bind())
+    # Media processed before have no variants, clients fall back to file_url
+    for table, column in COLUMNS:
+        if column not in {c['name'] for c in inspector.get_columns(table)}:
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.add_column(sa.Column(column, sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    for table, column in reversed(COLUMNS):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column(column)
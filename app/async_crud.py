@@ -0,0 +1,113 @@
+# Async versions of the CRUD functions for AsyncSession
+# The queries of app/crud.py run through AsyncSession.run_sync, so the statements
+# go through the async driver without blocking the event loop
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import app.crud as crud
+
+
+async def find_role_by_id(db: AsyncSession, role_id: int, fields: dict = None):
+    return await db.run_sync(crud.find_role_by_id, role_id, fields)
+
+
+async def find_all_roles(db: AsyncSession, fields: dict = None):
+    return await db.run_sync(crud.find_all_roles, fields)
+
+
+async def find_user_by_id(db: AsyncSession, user_id: int, fields: dict = None):
+    return await db.run_sync(crud.find_user_by_id, user_id, fields)
+
+
+async def find_user_by_username(db: AsyncSession, username: str, fields: dict = None):
+    return await db.run_sync(crud.find_user_by_username, username, fields)
+
+
+async def find_all_users(db: AsyncSession, limit: int, after=None, fields: dict = None):
+    return await db.run_sync(crud.find_all_users, limit, after, fields)
+
+
+async def count_all_users(db: AsyncSession):
+    return await db.run_sync(crud.count_all_users)
+
+
+async def find_user_profile(db: AsyncSession, user_id: int, fields: dict = None):
+    return await db.run_sync(crud.find_user_profile, user_id, fields)
+
+
+async def find_all_posts(db: AsyncSession, limit: int, after=None, fields: dict = None):
+    return await db.run_sync(crud.find_all_posts, limit, after, fields)
+
+
+async def count_all_posts(db: AsyncSession):
+    return await db.run_sync(crud.count_all_posts)
+
+
+async def find_post_by_id(db: AsyncSession, post_id: int, fields: dict = None):
+    return await db.run_sync(crud.find_post_by_id, post_id, fields)
+
+
+async def find_all_parent_comments_by_post_id(
+    db: AsyncSession, post_id: int, fields: dict = None
+):
+    return await db.run_sync(crud.find_all_parent_comments_by_post_id, post_id, fields)
+
+
+async def find_all_comments_by_post_id(
+    db: AsyncSession, post_id: int, limit: int, after=None, fields: dict = None
+):
+    return await db.run_sync(
+        crud.find_all_comments_by_post_id, post_id, limit, after, fields
+    )
+
+
+async def count_all_comments_by_post_id(db: AsyncSession, post_id: int):
+    return await db.run_sync(crud.count_all_comments_by_post_id, post_id)
+
+
+async def find_comment_thread(
+    db: AsyncSession,
+    post_id: int,
+    max_depth: int,
+    limit: int,
+    parent_comment_id: int = None,
+    fields: dict = None,
+):
+    return await db.run_sync(
+        crud.find_comment_thread, post_id, max_depth, limit, parent_comment_id, fields
+    )
+
+
+async def find_comment_by_id(db: AsyncSession, comment_id: int, fields: dict = None):
+    return await db.run_sync(crud.find_comment_by_id, comment_id, fields)
+
+
+async def find_all_media_by_post_id(
+    db: AsyncSession, post_id: int, fields: dict = None
+):
+    return await db.run_sync(crud.find_all_media_by_post_id, post_id, fields)
+
+
+async def find_media_by_id(db: AsyncSession, media_id: int, fields: dict = None):
+    return await db.run_sync(crud.find_media_by_id, media_id, fields)
+
+
+async def count_file_references(db: AsyncSession, file_url: str):
+    return await db.run_sync(crud.count_file_references, file_url)
+
+
+async def release_file(db: AsyncSession, file_url: str, variants: list = None):
+    return await db.run_sync(crud.release_file, file_url, variants)
+
+
+async def add_like(
+    db: AsyncSession, user_id: int, post_id: int = None, comment_id: int = None
+):
+    return await db.run_sync(crud.add_like, user_id, post_id, comment_id)
+
+
+async def save_to_db(db: AsyncSession, model, refresh: bool = True):
+    return await db.run_sync(crud.save_to_db, model, refresh)
+
+
+async def save_post_with_media(db: AsyncSession, post, media: list = ()):
+    return await db.run_sync(crud.save_post_with_media, post, media)
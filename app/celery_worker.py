@@ -6,12 +6,26 @@ import time
 # Load environment variables from the .env file
 load_dotenv(".env")
 
-# Create a new Celery instance
-celery = Celery(__name__)
+from app.utils.file_upload import MEDIA_WORKER_CONCURRENCY  # noqa: E402
+
+# Create a new Celery instance, the media pipeline tasks are registered on it
+celery = Celery(__name__, include=["app.tasks.media_tasks"])
 
 # Configure Celery with broker URL and result backend from environment variables
 celery.conf.broker_url = os.getenv("CELERY_BROKER_URL")
 celery.conf.result_backend = os.getenv("CELERY_RESULT_BACKEND")
+# Run tasks in the calling process instead of a worker (tests default to it)
+celery.conf.task_always_eager = (
+    os.getenv("CELERY_TASK_ALWAYS_EAGER", os.getenv("IS_TEST", "false")).lower()
+    == "true"
+)
+# Media tasks run for minutes, a worker takes one at a time and acknowledges
+# it when done so tasks of a crashed worker are delivered again
+celery.conf.worker_prefetch_multiplier = 1
+celery.conf.task_acks_late = True
+# Each file of a post is its own task, the worker's process pool processes them
+# in parallel within the node's MEDIA_WORKER_CONCURRENCY budget
+celery.conf.worker_concurrency = MEDIA_WORKER_CONCURRENCY
 
 # import app.tasks.task_example
 @celery.task(name="task_example")
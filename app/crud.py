@@ -1,52 +1,162 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, or_, String, literal, inspect, insert, select, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, aliased, defer, selectinload
 
 import app.models as models
+from app.response_cache import invalidate_model
+from app.user_cache import evict_user
+from app.utils import media_store
 
 
-def find_role_by_id(db: Session, role_id: int):
-    role = db.query(models.Role).filter(models.Role.id == role_id).first()
+# Query that skips unselected wide columns and eager loads the selected relationships
+# `fields` is the tree of selected attribute names, None loads everything
+def project(db: Session, model, fields: dict = None):
+    query = db.query(model)
+    if fields is None:
+        return query
+    return query.options(*_load_options(model, fields))
+
+
+def _load_options(model, fields: dict):
+    mapper = inspect(model)
+    options = [defer(column) for column in _deferred_columns(model, fields)]
+    # Related rows are loaded with one SELECT ... IN per relationship
+    # Lists are left to the GraphQL loaders, which bound the rows per parent
+    for name, subfields in fields.items():
+        if name in mapper.relationships and not mapper.relationships[name].uselist:
+            related = mapper.relationships[name].mapper.class_
+            options.append(
+                selectinload(getattr(model, name)).options(
+                    *[defer(column) for column in _deferred_columns(related, subfields)]
+                )
+            )
+    return options
+
+
+# Unselected unbounded text columns (e.g. Post.content)
+# Narrow columns are always loaded so rows stay complete in the session identity map
+def _deferred_columns(model, fields: dict):
+    columns = []
+    for attr in inspect(model).column_attrs:
+        column_type = attr.columns[0].type
+        if (
+            attr.key not in fields
+            and isinstance(column_type, String)
+            and column_type.length is None
+        ):
+            columns.append(getattr(model, attr.key))
+    return columns
+
+
+# Keyset pagination ordered on (created_at, id)
+# `after` is the (created_at, id) pair of the last row of the previous page
+def paginate(db: Session, query, model, limit: int, after=None, descending=True):
+    created_at_column = _keyset_column(db, model.created_at)
+    if after:
+        created_at, row_id = after
+        created_at = _keyset_value(db, model.created_at, created_at)
+        if descending:
+            query = query.filter(
+                or_(
+                    created_at_column < created_at,
+                    and_(created_at_column == created_at, model.id < row_id),
+                )
+            )
+        else:
+            query = query.filter(
+                or_(
+                    created_at_column > created_at,
+                    and_(created_at_column == created_at, model.id > row_id),
+                )
+            )
+    if descending:
+        query = query.order_by(created_at_column.desc(), model.id.desc())
+    else:
+        query = query.order_by(created_at_column.asc(), model.id.asc())
+    return query.limit(limit).all()
+
+
+# SQLite stores timestamps as text, server defaults without fractional seconds
+# and SQLAlchemy with microseconds, so the column and the cursor value are both
+# compared and ordered in one text form there
+_SQLITE_KEYSET_FORMAT = "%Y-%m-%d %H:%M:%f"
+
+
+def _is_sqlite(db: Session):
+    return db.bind is not None and db.bind.dialect.name == "sqlite"
+
+
+def _keyset_column(db: Session, column):
+    if _is_sqlite(db):
+        return func.strftime(_SQLITE_KEYSET_FORMAT, column)
+    return column
+
+
+def _keyset_value(db: Session, column, value):
+    value = literal(value, column.type)
+    if _is_sqlite(db):
+        return func.strftime(_SQLITE_KEYSET_FORMAT, value)
+    return value
+
+
+def find_role_by_id(db: Session, role_id: int, fields: dict = None):
+    role = project(db, models.Role, fields).filter(models.Role.id == role_id).first()
     return role
 
 
-def find_all_roles(db: Session):
-    return db.query(models.Role).all()
+def find_all_roles(db: Session, fields: dict = None):
+    return project(db, models.Role, fields).all()
 
 
-def find_user_by_id(db: Session, user_id: int):
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+def find_user_by_id(db: Session, user_id: int, fields: dict = None):
+    user = project(db, models.User, fields).filter(models.User.id == user_id).first()
     return user
 
 
-def find_user_by_username(db: Session, username: str):
-    user = db.query(models.User).filter(models.User.username == username).first()
+def find_user_by_username(db: Session, username: str, fields: dict = None):
+    user = (
+        project(db, models.User, fields)
+        .filter(models.User.username == username)
+        .first()
+    )
     return user
 
 
-def find_all_users(db: Session):
-    return db.query(models.User).all()
+def find_all_users(db: Session, limit: int, after=None, fields: dict = None):
+    query = project(db, models.User, fields)
+    return paginate(db, query, models.User, limit, after)
+
+
+def count_all_users(db: Session):
+    return db.query(models.User).count()
 
 
-def find_user_profile(db: Session, user_id: int):
+def find_user_profile(db: Session, user_id: int, fields: dict = None):
     user_profile = (
-        db.query(models.UserProfile)
+        project(db, models.UserProfile, fields)
         .filter(models.UserProfile.user_id == user_id)
         .first()
     )
     return user_profile
 
 
-def find_all_posts(db: Session):
-    return db.query(models.Post).all()
+def find_all_posts(db: Session, limit: int, after=None, fields: dict = None):
+    query = project(db, models.Post, fields)
+    return paginate(db, query, models.Post, limit, after)
 
 
-def find_post_by_id(db: Session, post_id: int):
-    post = db.query(models.Post).filter(models.Post.id == post_id).first()
+def count_all_posts(db: Session):
+    return db.query(models.Post).count()
+
+
+def find_post_by_id(db: Session, post_id: int, fields: dict = None):
+    post = project(db, models.Post, fields).filter(models.Post.id == post_id).first()
     return post
 
 
-def find_all_parent_comments_by_post_id(db: Session, post_id: int):
+def find_all_parent_comments_by_post_id(db: Session, post_id: int, fields: dict = None):
     return (
-        db.query(models.Comment)
+        project(db, models.Comment, fields)
         .filter(
             models.Comment.post_id == post_id,
             models.Comment.parent_comment_id.is_(None),
@@ -55,26 +165,184 @@ def find_all_parent_comments_by_post_id(db: Session, post_id: int):
     )
 
 
-def find_all_comments_by_post_id(db: Session, post_id: int):
-    return db.query(models.Comment).filter(models.Comment.post_id == post_id).all()
+def find_all_comments_by_post_id(
+    db: Session, post_id: int, limit: int, after=None, fields: dict = None
+):
+    query = project(db, models.Comment, fields).filter(
+        models.Comment.post_id == post_id
+    )
+    # Comments are listed oldest first
+    return paginate(db, query, models.Comment, limit, after, descending=False)
 
 
-def find_comment_by_id(db: Session, comment_id: int):
-    comment = db.query(models.Comment).filter(models.Comment.id == comment_id).first()
+def count_all_comments_by_post_id(db: Session, post_id: int):
+    return (
+        db.query(models.Comment).filter(models.Comment.post_id == post_id).count()
+    )
+
+
+# Comment tree of a post (or of the replies to a comment) in a single statement
+# A recursive CTE walks the replies down to `max_depth`, every step keeps the
+# `limit` oldest replies of each parent so the cut branches are never walked.
+# Returns (comment, depth, reply_count) rows ordered by depth then age,
+# reply_count counts all the replies of the comment
+def find_comment_thread(
+    db: Session,
+    post_id: int,
+    max_depth: int,
+    limit: int,
+    parent_comment_id: int = None,
+    fields: dict = None,
+):
+    Comment = models.Comment
+
+    # IDs of the `limit` oldest comments matching `condition(comment)`
+    # The replies are correlated on the child row rather than on the CTE, which
+    # SQLite does not allow in subqueries of the recursive step
+    def oldest_comments(condition):
+        comment = aliased(Comment)
+        return (
+            select(comment.id)
+            .where(condition(comment))
+            .order_by(comment.created_at, comment.id)
+            .limit(limit)
+        )
+
+    def is_root(comment):
+        if parent_comment_id is None:
+            return and_(
+                comment.post_id == post_id, comment.parent_comment_id.is_(None)
+            )
+        return and_(
+            comment.post_id == post_id, comment.parent_comment_id == parent_comment_id
+        )
+
+    tree = (
+        select(Comment.id, literal(1).label("depth"))
+        .where(Comment.id.in_(oldest_comments(is_root)))
+        .cte("comment_tree", recursive=True)
+    )
+    child = aliased(Comment)
+
+    def is_sibling(comment):
+        return comment.parent_comment_id == child.parent_comment_id
+
+    tree = tree.union_all(
+        select(child.id, tree.c.depth + 1).where(
+            child.parent_comment_id == tree.c.id,
+            tree.c.depth < max_depth,
+            child.id.in_(oldest_comments(is_sibling)),
+        )
+    )
+
+    reply = aliased(Comment)
+    reply_count = (
+        select(func.count(reply.id))
+        .where(reply.parent_comment_id == Comment.id)
+        .scalar_subquery()
+    )
+    nodes = (
+        select(tree.c.id, tree.c.depth, reply_count.label("reply_count"))
+        .join_from(tree, Comment, Comment.id == tree.c.id)
+        .subquery()
+    )
+    return (
+        project(db, Comment, fields)
+        .join(nodes, nodes.c.id == Comment.id)
+        .add_columns(nodes.c.depth, nodes.c.reply_count)
+        .order_by(nodes.c.depth, Comment.created_at, Comment.id)
+        .all()
+    )
+
+
+def find_comment_by_id(db: Session, comment_id: int, fields: dict = None):
+    comment = (
+        project(db, models.Comment, fields)
+        .filter(models.Comment.id == comment_id)
+        .first()
+    )
     return comment
 
 
-def find_all_media_by_post_id(db: Session, post_id: int):
-    return db.query(models.Media).filter(models.Media.post_id == post_id).all()
+def find_all_media_by_post_id(db: Session, post_id: int, fields: dict = None):
+    return (
+        project(db, models.Media, fields).filter(models.Media.post_id == post_id).all()
+    )
 
 
-def find_media_by_id(db: Session, media_id: int):
-    media = db.query(models.Media).filter(models.Media.id == media_id).first()
+def find_media_by_id(db: Session, media_id: int, fields: dict = None):
+    media = project(db, models.Media, fields).filter(models.Media.id == media_id).first()
     return media
 
 
-def save_to_db(db: Session, model):
+# Reference count of a stored media file: the media rows and profiles using it
+def count_file_references(db: Session, file_url: str):
+    media = (
+        db.query(func.count(models.Media.id))
+        .filter(models.Media.file_url == file_url)
+        .scalar()
+    )
+    profiles = (
+        db.query(func.count(models.UserProfile.id))
+        .filter(models.UserProfile.profile_photo == file_url)
+        .scalar()
+    )
+    return media + profiles
+
+
+# Remove a media store artifact and its variants once no row references it
+def release_file(db: Session, file_url: str, variants: list = None):
+    if count_file_references(db, file_url) > 0:
+        return False
+    for variant in variants or []:
+        if variant["url"] != file_url:
+            media_store.release(variant["url"])
+    return media_store.release(file_url)
+
+
+# Record a like of a post or comment
+# Returns False when the user already liked it, the unique key makes it idempotent
+def add_like(db: Session, user_id: int, post_id: int = None, comment_id: int = None):
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    statement = (
+        dialect.insert(models.Like)
+        .values(user_id=user_id, post_id=post_id, comment_id=comment_id)
+        .on_conflict_do_nothing()
+    )
+    result = db.execute(statement)
+    db.commit()
+    return result.rowcount == 1
+
+
+# Save a row and return its ID
+# `refresh` reloads server generated values, callers that only need the ID skip it
+def save_to_db(db: Session, model, refresh: bool = True):
     db.add(model)
     db.commit()
-    db.refresh(model)
+    if refresh:
+        db.refresh(model)
+    # Drop the cached GraphQL responses and user rows that contain the saved row
+    invalidate_model(model)
+    evict_user(model)
     return model.id
+
+
+# Unit of work for a post and its media: one transaction with a single commit
+# The media rows are inserted in one executemany INSERT once the post has an ID
+# `media` holds the column values of each media row except post_id
+def save_post_with_media(db: Session, post: models.Post, media: list = ()):
+    try:
+        db.add(post)
+        db.flush()  # INSERT the post to get its ID, nothing is committed yet
+        if media:
+            db.execute(
+                insert(models.Media),
+                [{**values, "post_id": post.id} for values in media],
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    # The post tag also covers its media
+    invalidate_model(post)
+    return post.id
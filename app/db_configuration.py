@@ -1,9 +1,23 @@
+import asyncio
+import itertools
+import logging
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base
+import time
+from collections import deque
+from contextvars import ContextVar
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.orm import Session, declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 from dotenv import load_dotenv
 
+from app.metrics import DB_POOL_CHECKOUT_WAIT, instrument_engine
+
+# app.utils imports the models, which import this module
+logger = logging.getLogger(__name__)
+
 # Load environment variables from a .env file
 load_dotenv(".env")
 
@@ -20,6 +34,77 @@ SQLALCHEMY_DATABASE_URL = CLOUD_DATABASE_URL if IS_CLOUD else POSTGRE_DATABASE_U
 if not SQLALCHEMY_DATABASE_URL:
     raise ValueError("DATABASE_URL is not set in the environment")
 
+# Optional comma separated read replica URLs, GraphQL queries read from them
+REPLICA_DATABASE_URLS = [
+    url.strip()
+    for url in os.getenv("REPLICA_DATABASE_URLS", "").split(",")
+    if url.strip()
+]
+# Reads of a viewer stay on the primary for this long after they wrote
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", 5))
+# Shares the recent writers between workers, without it a viewer whose next
+# request lands on another worker may read from a lagging replica
+REPLICA_STICKY_REDIS_URL = os.getenv("REPLICA_STICKY_REDIS_URL")
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", 10))
+REPLICA_HEALTH_TIMEOUT = float(os.getenv("REPLICA_HEALTH_TIMEOUT", 2))
+
+
+
+# Connection pool configuration, applied to the sync and the async engine
+# Each worker opens up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections per engine
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))  # Connections kept open
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))  # Extra connections on bursts
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # Max connection age, -1 never
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # Max checkout wait
+# Liveness check on checkout: "always", "idle" (only connections idle for more
+# than DB_PRE_PING_IDLE_SECONDS) or "never"
+DB_PRE_PING = os.getenv("DB_PRE_PING", "idle").lower()
+DB_PRE_PING_IDLE_SECONDS = float(os.getenv("DB_PRE_PING_IDLE_SECONDS", 30))
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", DB_POOL_SIZE))  # Opened at startup
+POOL_WAIT_SAMPLES = 1000  # Recent checkout waits kept for the percentiles
+
+
+# Queue pool that records how long each checkout waited for a connection
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_times = deque(maxlen=POOL_WAIT_SAMPLES)  # Recent waits (seconds)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            self.wait_times.append(wait)
+            DB_POOL_CHECKOUT_WAIT.observe(wait)
+
+
+# Async variant of the instrumented pool used by the async engine
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+# Async driver URL for a database URL: asyncpg for PostgreSQL, aiosqlite for SQLite
+def async_database_url(url: str):
+    url = make_url(url)
+    if url.get_backend_name() == "postgresql":
+        query = dict(url.query)
+        # asyncpg takes `ssl` instead of libpq's `sslmode`
+        if "sslmode" in query:
+            query["ssl"] = query.pop("sslmode")
+        return url.set(drivername="postgresql+asyncpg", query=query)
+    if url.get_backend_name() == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    return url
+
+
+# Prepared statements cached per asyncpg connection
+# Transaction pooling PgBouncer (the cloud pooler) does not support them
+ASYNC_STATEMENT_CACHE_SIZE = int(
+    os.getenv("ASYNC_STATEMENT_CACHE_SIZE", 0 if IS_CLOUD else 100)
+)
+
 # Fetch IS_TESTING from environment variables and convert it to a boolean
 IS_TESTING = os.getenv("IS_TEST", "false").lower() == "true"
 # Create the SQLAlchemy engine
@@ -32,12 +117,205 @@ else:
     engine = create_engine(
         SQLALCHEMY_DATABASE_URL,  # Database URL
         # connect_args={"check_same_thread": False},  # Required for SQLite
-        pool_pre_ping=True,  # Option to ensure the connection is alive before using
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=DB_PRE_PING == "always",  # Ping on every checkout
+        poolclass=InstrumentedQueuePool,  # Record pool checkout wait times
+    )
+
+
+# Async engine with the configured pool for a database URL
+def create_async_database_engine(url: str):
+    return create_async_engine(
+        async_database_url(url),
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=DB_PRE_PING == "always",
+        poolclass=InstrumentedAsyncAdaptedQueuePool,  # Record pool checkout wait times
+        connect_args={"statement_cache_size": ASYNC_STATEMENT_CACHE_SIZE},
     )
 
+
+# Create the async SQLAlchemy engine used by the GraphQL resolvers
+if IS_TESTING:
+    async_engine = create_async_engine(async_database_url(TEST_DATABASE_URL))
+else:
+    async_engine = create_async_database_engine(SQLALCHEMY_DATABASE_URL)
+
+
+# Ping connections that have been idle for a while when they are checked out
+# A dead connection is replaced by the pool instead of failing the request
+def ping_idle_connections(engine, idle_seconds: float):
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        connection_record.info["checkin_time"] = time.monotonic()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        checkin_time = connection_record.info.get("checkin_time")
+        if checkin_time is None or time.monotonic() - checkin_time < idle_seconds:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        except Exception:
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+
+
+# Read replicas, round-robin over the replicas that passed their last health check
+class ReplicaSet:
+    def __init__(self, engines):
+        self.engines = list(engines)
+        self.healthy = list(self.engines)
+        self._turn = itertools.count()
+
+    # Next healthy replica, None when there is none
+    def choose(self):
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    async def _ping(self, engine):
+        try:
+            async with engine.connect() as connection:
+                await asyncio.wait_for(
+                    connection.execute(text("SELECT 1")), REPLICA_HEALTH_TIMEOUT
+                )
+            return True
+        except Exception as e:
+            logger.warning(f"[{ReplicaSet.__name__}] {engine.url!r} is unhealthy: {e}")
+            return False
+
+    # Ping every replica and keep the ones that answered
+    async def check(self):
+        results = await asyncio.gather(*(self._ping(e) for e in self.engines))
+        self.healthy = [e for e, ok in zip(self.engines, results) if ok]
+
+    # Check the replicas every REPLICA_HEALTH_INTERVAL seconds
+    async def monitor(self, interval: float = REPLICA_HEALTH_INTERVAL):
+        while True:
+            await self.check()
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return [
+            {"url": repr(e.url), "healthy": e in self.healthy, **pool_stats(e)}
+            for e in self.engines
+        ]
+
+
+replicas = ReplicaSet(create_async_database_engine(url) for url in REPLICA_DATABASE_URLS)
+
+if not IS_TESTING and DB_PRE_PING == "idle":
+    ping_idle_connections(engine, DB_PRE_PING_IDLE_SECONDS)
+    ping_idle_connections(async_engine.sync_engine, DB_PRE_PING_IDLE_SECONDS)
+    for replica_engine in replicas.engines:
+        ping_idle_connections(replica_engine.sync_engine, DB_PRE_PING_IDLE_SECONDS)
+
+# Count SQL statements and their duration per request
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+for replica_engine in replicas.engines:
+    instrument_engine(replica_engine.sync_engine)
+
+
+# Session that sends reads to the replica set in `info["replica"]`
+# Flushes and INSERT/UPDATE/DELETE statements always go to the primary
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get("replica")
+        if (
+            replica is not None
+            and not self._flushing
+            and not getattr(clause, "is_dml", False)
+        ):
+            return replica.sync_engine
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+
+# Viewers that wrote recently, their reads stay on the primary
+# Lookups go to the in-process dict first, then to the Redis-compatible backend
+# shared by every worker
+class RecentWriters:
+    def __init__(
+        self,
+        redis_url: str = REPLICA_STICKY_REDIS_URL,
+        sticky_seconds: float = REPLICA_STICKY_SECONDS,
+    ):
+        self.local = {}  # user_id -> time their reads may use replicas again
+        self.sticky_seconds = sticky_seconds
+        self.redis = None
+        if redis_url:
+            import redis.asyncio as redis
+
+            self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+
+    async def record(self, user_id: int):
+        now = time.monotonic()
+        if len(self.local) > 10000:
+            for key, until in list(self.local.items()):
+                if until <= now:
+                    self.local.pop(key, None)
+        self.local[user_id] = now + self.sticky_seconds
+        if self.redis is not None:
+            try:
+                await self.redis.set(
+                    f"replica:writer:{user_id}", 1, px=int(self.sticky_seconds * 1000)
+                )
+            except Exception as e:
+                logger.error(f"[{RecentWriters.__name__}] Redis set failed: {e}")
+
+    async def wrote_recently(self, user_id: int) -> bool:
+        if self.local.get(user_id, 0) > time.monotonic():
+            return True
+        if self.redis is None:
+            return False
+        try:
+            return bool(await self.redis.exists(f"replica:writer:{user_id}"))
+        except Exception as e:
+            # Reading from the primary is always consistent
+            logger.error(f"[{RecentWriters.__name__}] Redis get failed: {e}")
+            return True
+
+
+recent_writers = RecentWriters()
+
+
+# Keep the reads of a viewer on the primary until the replicas caught up
+async def record_write(user_id: int):
+    await recent_writers.record(user_id)
+
+
+# Route the reads of a session to a healthy replica
+# Returns False when the session keeps reading from the primary
+async def use_replica(db: AsyncSession, user_id: int = None) -> bool:
+    if user_id is not None and await recent_writers.wrote_recently(user_id):
+        return False
+    replica = replicas.choose()
+    if replica is None:
+        return False
+    db.sync_session.info["replica"] = replica
+    return True
+
 # Create a session factory and configure scoped session
-db_session = scoped_session(
-    sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+db_session = scoped_session(SessionLocal)
+
+# Async session factory
+# Attributes stay loaded after commit since expired attributes cannot be lazy loaded
+async_session = sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    sync_session_class=RoutingSession,  # Reads can be routed to a replica
+    autoflush=False,
+    expire_on_commit=False,
 )
 
 # Base class for models
@@ -51,14 +329,96 @@ Base.query = db_session.query_property()
 
 
 # Dependency for FastAPI to get the database session in routes
+# Every request gets its own session, closed when the route returns
 def get_db():
-    db = db_session()
+    db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
 
+# Async sessions of the current HTTP request, set by RequestSessionMiddleware
+_request_sessions: ContextVar[dict] = ContextVar("request_sessions", default=None)
+
+
+# Async session shared by everything running for the current HTTP request
+# Created on first use and closed by RequestSessionMiddleware
+def request_db() -> AsyncSession:
+    sessions = _request_sessions.get()
+    if sessions is None:
+        raise RuntimeError("request_db() used outside of an HTTP request")
+    if "db" not in sessions:
+        sessions["db"] = async_session()
+    return sessions["db"]
+
+
+# ASGI middleware that closes the request session when the request ends,
+# closing rolls back anything left uncommitted and returns the connection
+class RequestSessionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        sessions = {}
+        token = _request_sessions.set(sessions)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_sessions.reset(token)
+            if "db" in sessions:
+                await sessions["db"].close()
+
+
+# Open DB_POOL_WARMUP connections in every pool so the first requests
+# do not pay for connection setup
+async def warm_up_pools(connections: int = DB_POOL_WARMUP):
+    if connections <= 0:
+        return
+
+    def warm_up_sync():
+        opened = [engine.connect() for _ in range(connections)]
+        for connection in opened:
+            connection.close()
+
+    async def warm_up_async(async_engine):
+        opened = [await async_engine.connect() for _ in range(connections)]
+        for connection in opened:
+            await connection.close()
+
+    await asyncio.gather(
+        asyncio.to_thread(warm_up_sync),
+        warm_up_async(async_engine),
+        *(warm_up_async(replica) for replica in replicas.engines),
+    )
+
+
+# Connection counts and checkout wait percentiles of an engine's pool
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__, "status": pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+        )
+    if isinstance(pool, InstrumentedQueuePool):
+        waits = sorted(pool.wait_times)
+        for percentile in (50, 95, 99):
+            stats[f"wait_p{percentile}_ms"] = (
+                round(waits[int(len(waits) * percentile / 100)] * 1000, 3)
+                if waits
+                else 0.0
+            )
+    return stats
+
+
 # Function to set up the database (if needed)
 def init_db():
     db = db_session()
@@ -1,6 +1,7 @@
 # app/graphql/__init__.py
 from app.graphql.queries import Query
 from app.graphql.mutations import Mutation
+from app.graphql.subscriptions import Subscription
 from app.graphql.schemas import (
     UserModel,
     RoleModel,
@@ -8,11 +9,14 @@ from app.graphql.schemas import (
     PostModel,
     CommentModel,
     MediaModel,
+    UserConnection,
+    PostConnection,
+    CommentConnection,
 )
 import graphene
 
 # Define the main GraphQL schema
-schema = graphene.Schema(query=Query, mutation=Mutation)
+schema = graphene.Schema(query=Query, mutation=Mutation, subscription=Subscription)
 # Export the models for use in the schema and GraphQL schema
 __all__ = [
     "schema",
@@ -22,4 +26,7 @@ __all__ = [
     "PostModel",
     "CommentModel",
     "MediaModel",
+    "UserConnection",
+    "PostConnection",
+    "CommentConnection",
 ]
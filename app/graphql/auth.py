@@ -0,0 +1,25 @@
+# app/graphql/auth.py
+from fastapi import HTTPException
+
+from app.user_cache import get_user
+from app.utils import check_auth, logger
+
+
+# Authenticated user of the current request
+# Resolved once per request from the user_id of the token and kept in the context
+async def get_viewer(info):
+    context = info.context
+    if context.get("viewer") is None:
+        authorization = context["request"].headers.get("Authorization")
+        # Check if the user is authenticated
+        token_data = check_auth(authorization)
+        user_id = token_data.get("user_id")
+        user = await get_user(context["db"], user_id) if user_id else None
+        # If user is not found, return an error
+        if not user:
+            logger.error("User not found or invalid token")
+            raise HTTPException(
+                status_code=401, detail="User not found or invalid token"
+            )
+        context["viewer"] = user
+    return context["viewer"]
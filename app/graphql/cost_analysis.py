@@ -0,0 +1,160 @@
+# app/graphql/cost_analysis.py
+import os
+from graphql import (
+    DocumentNode,
+    FieldNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLSchema,
+    InlineFragmentNode,
+    IntValueNode,
+    OperationDefinitionNode,
+    VariableNode,
+    get_named_type,
+    is_leaf_type,
+    is_list_type,
+    get_nullable_type,
+)
+from graphql.utilities import get_operation_ast
+
+from app.graphql.pagination import DEFAULT_LIST_SIZE, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+# Query limits
+MAX_QUERY_DEPTH = int(os.getenv("GRAPHQL_MAX_DEPTH", 10))
+MAX_QUERY_COST = int(os.getenv("GRAPHQL_MAX_COST", 10000))
+
+QUERY_TOO_COMPLEX = "QUERY_TOO_COMPLEX"
+
+
+# Static depth and cost of an operation
+# Object fields cost 1, leaf fields are free and list fields multiply the cost
+# of their selection by the page size (`first`) or DEFAULT_LIST_SIZE, the number
+# of items the loaders return for list fields without `first`
+class QueryCostAnalyzer:
+    def __init__(self, schema: GraphQLSchema, document: DocumentNode, variables=None):
+        self.schema = schema
+        self.variables = variables if isinstance(variables, dict) else {}
+        self.fragments = {
+            definition.name.value: definition
+            for definition in document.definitions
+            if not isinstance(definition, OperationDefinitionNode)
+        }
+
+    # Return the (depth, cost) of an operation
+    def analyze(self, operation: OperationDefinitionNode):
+        root_type = self.schema.get_root_type(operation.operation)
+        return self._selection_cost(root_type, operation.selection_set, set(), {})
+
+    # `bounds` holds the page size of paged list types, by type name, for the
+    # recursive lists below them (e.g. commentThread replies)
+    def _selection_cost(self, parent_type, selection_set, visited_fragments, bounds):
+        depth, cost = 0, 0
+        if selection_set is None:
+            return depth, cost
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                field_depth, field_cost = self._field_cost(
+                    parent_type, selection, bounds
+                )
+            elif isinstance(selection, InlineFragmentNode):
+                fragment_type = (
+                    self.schema.get_type(selection.type_condition.name.value)
+                    if selection.type_condition
+                    else parent_type
+                )
+                field_depth, field_cost = self._selection_cost(
+                    fragment_type, selection.selection_set, visited_fragments, bounds
+                )
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                fragment = self.fragments.get(name)
+                if fragment is None or name in visited_fragments:
+                    continue
+                field_depth, field_cost = self._selection_cost(
+                    self.schema.get_type(fragment.type_condition.name.value),
+                    fragment.selection_set,
+                    visited_fragments | {name},
+                    bounds,
+                )
+            else:
+                continue
+            depth = max(depth, field_depth)
+            cost += field_cost
+        return depth, cost
+
+    def _field_cost(self, parent_type, field: FieldNode, bounds):
+        name = field.name.value
+        # Introspection fields are not charged
+        if name.startswith("__"):
+            return 0, 0
+        field_def = parent_type.fields.get(name)
+        if field_def is None:
+            return 0, 0
+        field_type = field_def.type
+        named_type = get_named_type(field_type)
+        if is_leaf_type(named_type):
+            return 1, 0
+
+        multiplier = self._multiplier(parent_type, field, field_def, bounds)
+        if "first" in field_def.args and is_list_type(get_nullable_type(field_type)):
+            bounds = {**bounds, named_type.name: multiplier}
+        child_depth, child_cost = self._selection_cost(
+            named_type, field.selection_set, set(), bounds
+        )
+        return child_depth + 1, 1 + multiplier * child_cost
+
+    # Number of items a field is expected to return
+    def _multiplier(self, parent_type, field: FieldNode, field_def, bounds):
+        for argument in field.arguments:
+            if argument.name.value == "first":
+                first = self._argument_value(argument.value)
+                if first is None:
+                    return DEFAULT_PAGE_SIZE
+                return max(0, min(first, MAX_PAGE_SIZE))
+        # Paged fields return DEFAULT_PAGE_SIZE items without `first`
+        if "first" in field_def.args:
+            return DEFAULT_PAGE_SIZE
+        field_type = get_nullable_type(field_def.type)
+        if not is_list_type(field_type):
+            return 1
+        # Connection edges are already charged on the connection field
+        if field.name.value == "edges" and "pageInfo" in parent_type.fields:
+            return 1
+        # Recursive lists of a paged list share its page size
+        return bounds.get(get_named_type(field_type).name, DEFAULT_LIST_SIZE)
+
+    def _argument_value(self, value):
+        if isinstance(value, IntValueNode):
+            return int(value.value)
+        if isinstance(value, VariableNode):
+            variable = self.variables.get(value.name.value)
+            return variable if isinstance(variable, int) else None
+        return None
+
+
+# Compute the cost of the executed operation and reject it if over the limits
+# Returns the cost report added to the response `extensions`
+def check_query_cost(
+    schema: GraphQLSchema,
+    document: DocumentNode,
+    operation_name: str = None,
+    variables=None,
+    max_depth: int = MAX_QUERY_DEPTH,
+    max_cost: int = MAX_QUERY_COST,
+):
+    operation = get_operation_ast(document, operation_name)
+    if operation is None:
+        return None
+    depth, cost = QueryCostAnalyzer(schema, document, variables).analyze(operation)
+    report = {"depth": depth, "cost": cost, "maxDepth": max_depth, "maxCost": max_cost}
+    if depth > max_depth:
+        raise GraphQLError(
+            f"Query depth {depth} exceeds the maximum depth of {max_depth}",
+            extensions={"code": QUERY_TOO_COMPLEX, "cost": report},
+        )
+    if cost > max_cost:
+        raise GraphQLError(
+            f"Query cost {cost} exceeds the maximum cost of {max_cost}",
+            extensions={"code": QUERY_TOO_COMPLEX, "cost": report},
+        )
+    return report
@@ -0,0 +1,107 @@
+# app/graphql/loaders.py
+from collections import defaultdict
+from aiodataloader import DataLoader
+from sqlalchemy import func, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.graphql.pagination import DEFAULT_LIST_SIZE
+from app.models import User, Role, UserProfile, Post, Comment, Media
+
+
+# DataLoader that fetches rows whose column matches any of the batched keys
+# with a single IN (...) query per execution tick
+# Lists hold the first DEFAULT_LIST_SIZE rows of each key by ID, the size the
+# query cost analysis charges for them
+class ColumnLoader(DataLoader):
+    def __init__(self, db: AsyncSession, model, column, many=False):
+        super().__init__()
+        self.db = db
+        self.model = model
+        self.column = column
+        self.many = many  # Return a list of rows per key instead of a single row
+        self.limit = DEFAULT_LIST_SIZE if many else None  # Rows per key
+
+    async def batch_load_fn(self, keys):
+        result = await self.db.execute(self._query(set(keys)))
+        rows = result.scalars().all()
+        # Group the rows by the loaded column
+        grouped = defaultdict(list)
+        for row in rows:
+            grouped[getattr(row, self.column.key)].append(row)
+        # Return the results in the same order as the keys
+        if self.many:
+            return [grouped.get(key, []) for key in keys]
+        return [grouped[key][0] if grouped.get(key) else None for key in keys]
+
+    def _query(self, keys):
+        if self.limit is None:
+            return select(self.model).where(self.column.in_(keys))
+        # Number the rows of each key and keep the first `limit`
+        numbered = (
+            select(
+                self.model,
+                func.row_number()
+                .over(partition_by=self.column, order_by=self.model.id)
+                .label("position"),
+            )
+            .where(self.column.in_(keys))
+            .subquery()
+        )
+        row = aliased(self.model, numbered)
+        return (
+            select(row).where(numbered.c.position <= self.limit).order_by(numbered.c.id)
+        )
+
+
+# Per-request set of loaders, created once for every GraphQL request
+# Every relationship exposed by the schema goes through a loader since
+# relationships cannot be lazy loaded from an AsyncSession
+class Loaders:
+    def __init__(self, db: AsyncSession):
+        self.user_by_id = ColumnLoader(
+            db, User, User.id
+        )  # Post.user, Comment.user, UserProfile.user
+        self.users_by_role_id = ColumnLoader(
+            db, User, User.role_id, many=True
+        )  # Role.users
+        self.role_by_id = ColumnLoader(db, Role, Role.id)  # User.role
+        self.profile_by_user_id = ColumnLoader(
+            db, UserProfile, UserProfile.user_id
+        )  # User.profile
+        self.post_by_id = ColumnLoader(db, Post, Post.id)  # Comment.post, Media.post
+        self.posts_by_user_id = ColumnLoader(
+            db, Post, Post.user_id, many=True
+        )  # User.posts
+        self.comment_by_id = ColumnLoader(
+            db, Comment, Comment.id
+        )  # Comment.parent_comment
+        self.comments_by_user_id = ColumnLoader(
+            db, Comment, Comment.user_id, many=True
+        )  # User.comments
+        self.comments_by_post_id = ColumnLoader(
+            db, Comment, Comment.post_id, many=True
+        )  # Post.comments
+        self.replies_by_comment_id = ColumnLoader(
+            db, Comment, Comment.parent_comment_id, many=True
+        )  # Comment.replies
+        self.media_by_post_id = ColumnLoader(
+            db, Media, Media.post_id, many=True
+        )  # Post.media
+
+
+# Resolve a relationship of `root` through the given loader
+# Relationships already eager loaded by the CRUD layer are returned as is
+# and primed into the loader so other parents referencing them skip the query
+async def load(root, attribute: str, loader: DataLoader, key):
+    if attribute in inspect(root).dict:
+        value = getattr(root, attribute)
+        if loader.many:
+            return value[: loader.limit]
+        if key is not None:
+            loader.prime(key, value)
+        return value
+    # Skip empty foreign keys
+    if key is None:
+        return None
+    return await loader.load(key)
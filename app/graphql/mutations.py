@@ -1,7 +1,8 @@
+import asyncio
 import graphene
 from fastapi import HTTPException, UploadFile, Depends
 from graphene_file_upload.scalars import Upload
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta, timezone
 import jwt
@@ -13,16 +14,25 @@ from pathlib import Path
 # Import custom modules
 from app.db_configuration import get_db
 from app.utils import (
-    hash_password,
-    authenticate_user,
+    hash_password_async,
+    authenticate_user_async,
     generate_access_token,
-    check_auth,
-    handle_file_upload,
+    stream_upload,
 )
+from app.utils.file_upload import store_upload
 import app.models as models
-from app.models import PostVisibility, PostType, MediaType
-import app.crud as crud
+from app.models import PostVisibility, PostType, MediaType, MediaStatus
+import app.async_crud as async_crud
+import app.like_counters as like_counters
 from app.utils import logger
+from app.graphql.auth import get_viewer
+from app.tasks.media_tasks import process_media, process_profile_photo
+from app.graphql.pubsub import (
+    pubsub,
+    post_created_channel,
+    comment_created_channel,
+    reply_created_channel,
+)
 
 
 # GraphQL Mutations
@@ -37,15 +47,15 @@ class Login(graphene.Mutation):
 
     @staticmethod
     async def mutate(root, info, username, password):
-        db: Session = info.context["db"]
+        db: AsyncSession = info.context["db"]
         # Authenticate the user
-        user = authenticate_user(db, username, password)
-        # Generate access token
-        access_token = generate_access_token(user)
-        # update last_login field
+        user = await authenticate_user_async(db, username, password)
+        # Generate access token, the role it includes is lazy loaded
+        access_token = await db.run_sync(lambda _: generate_access_token(user))
+        # update last_login field, the save also stores a rehashed password
         # user.last_login = datetime.utcnow()
         user.last_login = datetime.now(timezone.utc)
-        crud.save_to_db(db, user)
+        await async_crud.save_to_db(db, user)
         # Log the successful login
         logger.info(f"[{Login.__name__}] User {username} logged in successfully")
         # Return the access token
@@ -64,20 +74,20 @@ class CreateUser(graphene.Mutation):
     user_id = graphene.Int()  # Return the created user's ID
 
     @staticmethod
-    def mutate(root, info, username, email, role_id, password):
-        db: Session = info.context["db"]
+    async def mutate(root, info, username, email, role_id, password):
+        db: AsyncSession = info.context["db"]
         # Check if the role exists
-        role = crud.find_role_by_id(db, role_id)
+        role = await async_crud.find_role_by_id(db, role_id)
         if not role:
             # create a new role
             role = models.Role(name="user", description="Default user role")
-            role_id = crud.save_to_db(db, role)
-            role = crud.find_role_by_id(db, role_id)
+            role_id = await async_crud.save_to_db(db, role, refresh=False)
+            role = await async_crud.find_role_by_id(db, role_id)
             if not role:
                 logger.error(f"[{CreateUser.__name__}] Role with ID {role_id} not found")
                 raise HTTPException(status_code=404, detail="Role not found")
         # Hash the password
-        hashed_password = hash_password(password)
+        hashed_password = await hash_password_async(password)
         # Create a new User instance
         db_user = models.User(
             username=username,
@@ -87,18 +97,18 @@ class CreateUser(graphene.Mutation):
         )
         # Add user to the session and commit
         try:
-            user_id = crud.save_to_db(db, db_user)
-            db_user.profile = models.UserProfile(
-                first_name=username, last_name=username
+            user_id = await async_crud.save_to_db(db, db_user, refresh=False)
+            db_profile = models.UserProfile(
+                first_name=username, last_name=username, user_id=user_id
             )
-            crud.save_to_db(db, db_user.profile)
+            await async_crud.save_to_db(db, db_profile, refresh=False)
             ok = True
             # Log the successful user creation
             logger.info(f"[{CreateUser.__name__}] User {username} created successfully")
             return CreateUser(ok=ok, user_id=user_id)  # Return created user's ID
         # Handle any IntegrityError exceptions
         except IntegrityError as e:
-            db.rollback()  # Roll back the session on error
+            await db.rollback()  # Roll back the session on error
             # Log the error
             logger.error(f"[{CreateUser.__name__}] Error creating user: {str(e.orig)}")
             raise HTTPException(
@@ -116,19 +126,19 @@ class CreateRole(graphene.Mutation):
     role_id = graphene.Int()  # Return the created role's ID
 
     @staticmethod
-    def mutate(root, info, name, description=None):
-        db: Session = info.context["db"]
+    async def mutate(root, info, name, description=None):
+        db: AsyncSession = info.context["db"]
         # Create new role instance
         db_role = models.Role(name=name, description=description)
         # Add role to the session and commit
         try:
-            role_id = crud.save_to_db(db, db_role)
+            role_id = await async_crud.save_to_db(db, db_role, refresh=False)
             # Log the successful role creation
             logger.info(f"[{CreateRole.__name__}] Role {name} created successfully")
             return CreateRole(ok=True, role_id=role_id)  # Return created role's ID
         # Handle any IntegrityError exceptions
         except IntegrityError as e:
-            db.rollback()
+            await db.rollback()
             logger.error(f"[{CreateRole.__name__}] Error creating role: {str(e.orig)}")
             raise HTTPException(
                 status_code=400, detail="Error creating role: " + str(e.orig)
@@ -148,40 +158,31 @@ class UpdateUserProfile(graphene.Mutation):
     profile_photo_url = graphene.String()  # Return the profile photo URL
 
     @staticmethod
-    def mutate(
+    async def mutate(
         root, info, first_name=None, last_name=None, bio=None, profile_photo=None
     ):
-        db: Session = info.context["db"]
+        db: AsyncSession = info.context["db"]
         # db: Session = next(get_db())
-        # Get the Authorization header from the request
-        request = info.context["request"]
-        authorization = request.headers.get("Authorization")
-        # Check if the user is authenticated
-        token_data = check_auth(authorization)
-        # Fetch the user based on token
-        user = crud.find_user_by_username(db, token_data["username"])
-        # If user is not found, return an error
-        if not user:
-            logger.error(
-                f"[{UpdateUserProfile.__name__}] User not found or invalid token"
-            )
-            raise HTTPException(
-                status_code=401, detail="User not found or invalid token"
-            )
+        # Authenticated user of the request
+        user = await get_viewer(info)
         # Fetch the user profile
-        db_profile = user.profile
+        db_profile = await async_crud.find_user_profile(db, user.id)
         # If user profile is not found, return an error
         if not db_profile:
             logger.error(
                 f"[{UpdateUserProfile.__name__}] User profile not found for user {user.username}"
             )
             raise HTTPException(status_code=404, detail="User profile not found")
-        # Update profile picture if provided
-        profile_picture_path, content_type = (
-            handle_file_upload(profile_photo, "profile_pictures")
-            if profile_photo
-            else None
-        )
+        # Store the profile picture raw if provided, it is compressed by a worker
+        # unless the same picture is already in the media store
+        profile_picture_path = variants = None
+        previous_photo = db_profile.profile_photo
+        previous_variants = db_profile.profile_photo_variants
+        if profile_photo:
+            profile_picture_path, content_type, variants = await store_upload(
+                profile_photo, "profile_pictures"
+            )
+            db_profile.profile_photo_variants = variants
         # Update profile attributes
         updated_attributes = {
             "first_name": first_name,
@@ -195,7 +196,12 @@ class UpdateUserProfile(graphene.Mutation):
                 setattr(db_profile, attr, value)
         # Save the updated profile to the database
         try:
-            user_id = crud.save_to_db(db, db_profile)
+            user_id = await async_crud.save_to_db(db, db_profile)
+            if profile_picture_path and variants is None:
+                enqueue(process_profile_photo, db_profile.id, profile_picture_path)
+            # The replaced photo is removed when nothing else references it
+            if previous_photo and profile_picture_path not in (None, previous_photo):
+                await async_crud.release_file(db, previous_photo, previous_variants)
             # Log the successful profile update
             logger.info(
                 f"[{UpdateUserProfile.__name__}] User profile updated successfully for user {user.username}"
@@ -205,7 +211,7 @@ class UpdateUserProfile(graphene.Mutation):
             )
         # Handle any exceptions
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error(
                 f"[{UpdateUserProfile.__name__}] Error updating user profile: {str(e)}"
             )
@@ -214,6 +220,34 @@ class UpdateUserProfile(graphene.Mutation):
             )
 
 
+# Media type of an uploaded file from its content type
+def get_media_type(content_type: str):
+    if content_type.startswith("image"):
+        return MediaType.IMAGE
+    elif content_type.startswith("video"):
+        return MediaType.VIDEO
+    elif content_type.startswith("audio"):
+        return MediaType.AUDIO
+    elif content_type.startswith("document"):
+        return MediaType.DOCUMENT
+
+
+# Remove the raw media files of a post that was not saved, processed files
+# are shared in the media store and stay
+def remove_media_files(media: list):
+    for values in media:
+        if values["source_url"]:
+            Path(values["source_url"]).unlink(missing_ok=True)
+
+
+# Queue a media processing task, a missing broker leaves the media pending
+def enqueue(task, *args):
+    try:
+        task.delay(*args)
+    except Exception as e:
+        logger.error(f"Could not queue {task.name}{args}: {str(e)}")
+
+
 # Create post mutation
 class CreatePost(graphene.Mutation):
     class Arguments:
@@ -226,26 +260,17 @@ class CreatePost(graphene.Mutation):
     post_id = graphene.Int()  # Return the created post's ID
 
     @staticmethod
-    def mutate(root, info, content, visibility=None, post_type=None, media_files=None):
-        db: Session = info.context["db"]
+    async def mutate(
+        root, info, content, visibility=None, post_type=None, media_files=None
+    ):
+        db: AsyncSession = info.context["db"]
         # db: Session = next(get_db())
         # Log the post creation details
         logger.info(
             f"CreatePost: Content: {content}, Visibility: {visibility}, Post Type: {post_type}"
         )
-        # Get the Authorization header from the request
-        request = info.context["request"]
-        authorization = request.headers.get("Authorization")
-        # Check if the user is authenticated
-        token_data = check_auth(authorization)
-        # Fetch the user based on token
-        user = crud.find_user_by_username(db, token_data["username"])
-        # If user is not found, return an error
-        if not user:
-            logger.error("User not found or invalid token")
-            raise HTTPException(
-                status_code=401, detail="User not found or invalid token"
-            )
+        # Authenticated user of the request
+        user = await get_viewer(info)
         # if visibility is not provided, set it to public by default
         # if visibility is "public" or "private" or "followers", set it to the provided value
         # if visibility is not one of the above, set it to public by default
@@ -271,46 +296,58 @@ class CreatePost(graphene.Mutation):
             post_type=post_type,
             user_id=user.id,
         )
-        # Add post to the session and commit
-        try:
-            post_id = crud.save_to_db(db, db_post)
-            # Log the successful post creation
+        # Store the media files raw before opening the transaction, all files
+        # at once with the results kept in upload order
+        results = await asyncio.gather(
+            *(store_upload(url, "posts") for url in media_files or []),
+            return_exceptions=True,
+        )
+        media = []
+        for result in results:
+            if isinstance(result, BaseException):
+                continue
+            media_path, media_type, variants = result
             logger.info(
-                f"CreatePost: New post created by user {user.username} with post_id {post_id}"
+                f"Media stored: Media path: {media_path}, Media type: {media_type}"
             )
-            # Handle media if any URLs are provided
-            if media_files:
-                for url in media_files:
-                    # Save the media file to the uploads/posts directory
-                    media_path, media_type = handle_file_upload(url, "posts")
-                    logger.info(
-                        f"Media saved: Media path: {media_path}, Media type: {media_type}"
-                    )
-                    # Set the media type based on the content type
-                    if media_type.startswith("image"):
-                        media_type = MediaType.IMAGE
-                    elif media_type.startswith("video"):
-                        media_type = MediaType.VIDEO
-                    elif media_type.startswith("audio"):
-                        media_type = MediaType.AUDIO
-                    elif media_type.startswith("document"):
-                        media_type = MediaType.DOCUMENT
-                    db_media = models.Media(
-                        file_url=media_path, media_type=media_type, post_id=post_id
-                    )
-                    crud.save_to_db(db, db_media)
+            # Duplicates of processed uploads are ready right away
+            pending = variants is None
+            media.append(
+                {
+                    "file_url": media_path,
+                    "source_url": media_path if pending else None,
+                    "media_type": get_media_type(media_type),
+                    "status": MediaStatus.PENDING if pending else MediaStatus.READY,
+                    "variants": variants,
+                }
+            )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            remove_media_files(media)
+            raise errors[0]
+        # Save the post and its media with a single commit
+        try:
+            post_id = await async_crud.save_post_with_media(db, db_post, media)
             # Log the successful post creation
             logger.info(
-                f"CreatePost: New post created by user {user.username} with post_id {post_id}"
+                f"CreatePost: New post created by user {user.username} with post_id {post_id} and {len(media)} media"
             )
-            return CreatePost(ok=True, post_id=post_id)
         # Handle any exceptions
         except Exception as e:
-            db.rollback()
+            # Nothing was saved, the stored files are not referenced
+            remove_media_files(media)
             logger.error(f"CreatePost: Error creating post - {str(e)}")
             raise HTTPException(
                 status_code=400, detail="Error creating post: " + str(e)
             )
+        # Transcode the media in the background, mediaStatus reports progress
+        if any(values["status"] == MediaStatus.PENDING for values in media):
+            for db_media in await async_crud.find_all_media_by_post_id(db, post_id):
+                if db_media.status == MediaStatus.PENDING:
+                    enqueue(process_media, db_media.id)
+        # Notify postCreated subscribers
+        pubsub.publish(post_created_channel(), {"id": post_id})
+        return CreatePost(ok=True, post_id=post_id)
 
 
 # Create comment mutation
@@ -323,26 +360,15 @@ class CreateComment(graphene.Mutation):
     comment_id = graphene.Int()  # Return the created comment's ID
 
     @staticmethod
-    def mutate(root, info, post_id, content):
-        db: Session = info.context["db"]
+    async def mutate(root, info, post_id, content):
+        db: AsyncSession = info.context["db"]
         # db: Session = next(get_db())
         # Log the comment creation details
         logger.info(f"CreateComment: Post ID: {post_id}, Content: {content}")
-        # Get the Authorization header from the request
-        request = info.context["request"]
-        authorization = request.headers.get("Authorization")
-        # Check if the user is authenticated
-        token_data = check_auth(authorization)
-        # Fetch the user based on token
-        user = crud.find_user_by_username(db, token_data["username"])
-        # If user is not found, return an error
-        if not user:
-            logger.error("User not found or invalid token")
-            raise HTTPException(
-                status_code=401, detail="User not found or invalid token"
-            )
+        # Authenticated user of the request
+        user = await get_viewer(info)
         # If post is not found, return an error
-        post = crud.find_post_by_id(db, post_id)
+        post = await async_crud.find_post_by_id(db, post_id)
         if not post:
             logger.error("Post not found")
             raise HTTPException(status_code=404, detail="Post not found")
@@ -350,15 +376,17 @@ class CreateComment(graphene.Mutation):
         db_comment = models.Comment(content=content, post_id=post_id, user_id=user.id)
         # Add comment to the session and commit
         try:
-            comment_id = crud.save_to_db(db, db_comment)
+            comment_id = await async_crud.save_to_db(db, db_comment, refresh=False)
             # Log the successful comment creation
             logger.info(
                 f"CreateComment: New comment created by user {user.username} with comment_id {comment_id}"
             )
+            # Notify commentCreated subscribers
+            pubsub.publish(comment_created_channel(post_id), {"id": comment_id})
             return CreateComment(ok=True, comment_id=comment_id)
         # Handle any exceptions
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error(f"CreateComment: Error creating comment - {str(e)}")
             raise HTTPException(
                 status_code=400, detail="Error creating comment: " + str(e)
@@ -375,26 +403,15 @@ class CreateReply(graphene.Mutation):
     comment_id = graphene.Int()  # Return the created comment's ID
 
     @staticmethod
-    def mutate(root, info, comment_id, content):
-        db: Session = info.context["db"]
+    async def mutate(root, info, comment_id, content):
+        db: AsyncSession = info.context["db"]
         # db: Session = next(get_db())
         # Log the comment creation details
         logger.info(f"CreateComment: Comment ID: {comment_id}, Content: {content}")
-        # Get the Authorization header from the request
-        request = info.context["request"]
-        authorization = request.headers.get("Authorization")
-        # Check if the user is authenticated
-        token_data = check_auth(authorization)
-        # Fetch the user based on token
-        user = crud.find_user_by_username(db, token_data["username"])
-        # If user is not found, return an error
-        if not user:
-            logger.error("User not found or invalid token")
-            raise HTTPException(
-                status_code=401, detail="User not found or invalid token"
-            )
+        # Authenticated user of the request
+        user = await get_viewer(info)
         # Find parent comment
-        parent_comment = crud.find_comment_by_id(db, comment_id)
+        parent_comment = await async_crud.find_comment_by_id(db, comment_id)
         if not parent_comment:
             logger.error("Parent comment not found")
             raise HTTPException(status_code=404, detail="Parent comment not found")
@@ -407,15 +424,20 @@ class CreateReply(graphene.Mutation):
         )
         # Add comment to the session and commit
         try:
-            comment_id = crud.save_to_db(db, db_comment)
+            comment_id = await async_crud.save_to_db(db, db_comment, refresh=False)
             # Log the successful comment creation
             logger.info(
                 f"CreateComment: New comment created by user {user.username} with comment_id {comment_id}"
             )
+            # Notify replyCreated and commentCreated subscribers
+            pubsub.publish(reply_created_channel(parent_comment.id), {"id": comment_id})
+            pubsub.publish(
+                comment_created_channel(parent_comment.post_id), {"id": comment_id}
+            )
             return CreateComment(ok=True, comment_id=comment_id)
         # Handle any exceptions
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error(f"CreateComment: Error creating comment - {str(e)}")
             raise HTTPException(
                 status_code=400, detail="Error creating comment: " + str(e)
@@ -430,6 +452,8 @@ class FileUpload(graphene.Mutation):
     ok = graphene.Boolean()
     filename = graphene.String()  # Return the file name
     filepath = graphene.String()  # Return the file path
+    size = graphene.Int()  # Return the file size in bytes
+    sha256 = graphene.String()  # Return the SHA-256 digest of the file
 
     async def mutate(self, info, file: UploadFile):
         # upload_dir = Path("uploads")
@@ -439,19 +463,79 @@ class FileUpload(graphene.Mutation):
         filename = file.filename.split("/")[-1]
         try:
             file_location = f"uploads/{filename}"  # Specify your upload directory
-            with open(file_location, "wb") as f:
-                f.write(await file.read())  # Save the uploaded file
+            # Stream the uploaded file to disk in chunks
+            size, sha256 = await stream_upload(file, file_location)
             # Log the successful file upload
             logger.info(
                 f"[{FileUpload.__name__}] File uploaded successfully: {filename}"
             )
-            return FileUpload(ok=True, filename=filename, filepath=file_location)
+            return FileUpload(
+                ok=True,
+                filename=filename,
+                filepath=file_location,
+                size=size,
+                sha256=sha256,
+            )
+        # Size limit errors are returned as they are
+        except HTTPException:
+            raise
         # Handle any exceptions
         except Exception as e:
             logger.error(f"[{FileUpload.__name__}] Error uploading file: {str(e)}")
             raise HTTPException(status_code=500, detail=f"File upload failed: {str(e)}")
 
 
+# Like a post or comment and return its like count
+# The count is the cached stored count plus the likes not written yet
+async def like(info, model, row_id: int, **target):
+    db: AsyncSession = info.context["db"]
+    # Authenticated user of the request
+    user = await get_viewer(info)
+    # If the post or comment is not found, return an error
+    stored = await like_counters.stored_count(db, model, row_id)
+    if stored is None:
+        logger.error(f"{model.__name__} not found")
+        raise HTTPException(status_code=404, detail=f"{model.__name__} not found")
+    try:
+        liked = await async_crud.add_like(db, user.id, **target)
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Like: Error liking {model.__name__} {row_id} - {str(e)}")
+        raise HTTPException(status_code=400, detail="Error liking: " + str(e))
+    # Liking again does not count twice
+    if liked:
+        like_counters.add(model, row_id)
+    return like_counters.count(model, row_id, stored)
+
+
+# Like post mutation
+class LikePost(graphene.Mutation):
+    class Arguments:
+        post_id = graphene.Int(required=True)  # Required post ID
+
+    ok = graphene.Boolean()  # Return True if the post is liked
+    likes = graphene.Int()  # Return the like count of the post
+
+    @staticmethod
+    async def mutate(root, info, post_id):
+        likes = await like(info, models.Post, post_id, post_id=post_id)
+        return LikePost(ok=True, likes=likes)
+
+
+# Like comment mutation
+class LikeComment(graphene.Mutation):
+    class Arguments:
+        comment_id = graphene.Int(required=True)  # Required comment ID
+
+    ok = graphene.Boolean()  # Return True if the comment is liked
+    likes = graphene.Int()  # Return the like count of the comment
+
+    @staticmethod
+    async def mutate(root, info, comment_id):
+        likes = await like(info, models.Comment, comment_id, comment_id=comment_id)
+        return LikeComment(ok=True, likes=likes)
+
+
 # Mutation class to add all mutations
 class Mutation(graphene.ObjectType):
     create_role = CreateRole.Field()  # Create role mutation
@@ -462,3 +546,5 @@ class Mutation(graphene.ObjectType):
     create_comment = CreateComment.Field()  # Create comment mutation
     create_reply = CreateReply.Field()  # Create reply mutation
     file_upload = FileUpload.Field()  # File upload mutation
+    like_post = LikePost.Field()  # Like post mutation
+    like_comment = LikeComment.Field()  # Like comment mutation
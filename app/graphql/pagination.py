@@ -0,0 +1,71 @@
+# app/graphql/pagination.py
+import base64
+import os
+from datetime import datetime
+import graphene
+from graphene import relay
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 20  # Page size when `first` is not provided
+MAX_PAGE_SIZE = 100  # Upper bound for `first`
+# Items returned per parent by list fields without `first` (e.g. Post.comments),
+# the connection queries page through the rest
+DEFAULT_LIST_SIZE = int(os.getenv("GRAPHQL_DEFAULT_LIST_SIZE", 10))
+
+
+# Relay connection with an optional total count
+# The count query only runs when `totalCount` is part of the selection
+class CountableConnection(relay.Connection):
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int()
+
+    def resolve_total_count(root, info):
+        return root.count()
+
+
+# Encode a cursor from the (created_at, id) keyset of a row
+def encode_cursor(row):
+    created_at = row.created_at.isoformat() if row.created_at else ""
+    return base64.urlsafe_b64encode(f"{created_at}|{row.id}".encode()).decode()
+
+
+# Decode a cursor back into a (created_at, id) keyset
+def decode_cursor(cursor: str):
+    if not cursor:
+        return None
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# Clamp the requested page size
+def page_size(first: int = None):
+    if first is None:
+        return DEFAULT_PAGE_SIZE
+    if first < 0:
+        raise HTTPException(status_code=400, detail="`first` must not be negative")
+    return min(first, MAX_PAGE_SIZE)
+
+
+# Build a connection from rows fetched with one extra row to detect the next page
+def make_connection(connection_type, rows, limit: int, count):
+    has_next_page = len(rows) > limit
+    rows = rows[:limit]
+    edges = [
+        connection_type.Edge(node=row, cursor=encode_cursor(row)) for row in rows
+    ]
+    connection = connection_type(
+        edges=edges,
+        page_info=relay.PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_previous_page=False,
+            has_next_page=has_next_page,
+        ),
+    )
+    connection.count = count  # Called lazily by resolve_total_count
+    return connection
@@ -0,0 +1,92 @@
+# app/graphql/persisted_queries.py
+import hashlib
+import os
+from graphql import GraphQLError
+
+from app.utils import LRUCache, logger
+
+# Persisted query store configuration
+PERSISTED_QUERY_CACHE_SIZE = int(os.getenv("APQ_CACHE_SIZE", 5000))
+PERSISTED_QUERY_REDIS_URL = os.getenv("APQ_REDIS_URL")  # Optional shared backend
+PERSISTED_QUERY_TTL = int(os.getenv("APQ_TTL", 7 * 24 * 3600))  # Redis key TTL
+
+PERSISTED_QUERY_NOT_FOUND = "PERSISTED_QUERY_NOT_FOUND"
+INVALID_PERSISTED_QUERY = "INVALID_PERSISTED_QUERY"
+
+
+# Store of query texts keyed by their sha256 hash
+# Lookups go to the in-process LRU first, then to the Redis-compatible backend
+class PersistedQueryStore:
+    def __init__(
+        self,
+        max_entries: int = PERSISTED_QUERY_CACHE_SIZE,
+        redis_url: str = PERSISTED_QUERY_REDIS_URL,
+        ttl: int = PERSISTED_QUERY_TTL,
+    ):
+        self.local = LRUCache(max_entries=max_entries)
+        self.ttl = ttl
+        self.redis = None
+        if redis_url:
+            import redis.asyncio as redis
+
+            self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+
+    async def get(self, query_hash: str):
+        query = self.local.get(query_hash)
+        if query is None and self.redis is not None:
+            try:
+                query = await self.redis.get(f"apq:{query_hash}")
+            except Exception as e:
+                logger.error(f"[{PersistedQueryStore.__name__}] Redis get failed: {e}")
+            if query is not None:
+                self.local.set(query_hash, query)
+        return query
+
+    async def set(self, query_hash: str, query: str):
+        self.local.set(query_hash, query)
+        if self.redis is not None:
+            try:
+                await self.redis.set(f"apq:{query_hash}", query, ex=self.ttl)
+            except Exception as e:
+                logger.error(f"[{PersistedQueryStore.__name__}] Redis set failed: {e}")
+
+    def stats(self):
+        return self.local.stats()
+
+
+# Resolve the query text of an operation using automatic persisted queries
+# Returns the operation query, registering it when both query and hash are sent
+async def resolve_persisted_query(store: PersistedQueryStore, operation: dict):
+    query = operation.get("query")
+    extensions = operation.get("extensions")
+    persisted_query = (
+        extensions.get("persistedQuery") if isinstance(extensions, dict) else None
+    )
+    if not isinstance(persisted_query, dict):
+        return query
+
+    query_hash = persisted_query.get("sha256Hash")
+    if persisted_query.get("version") != 1 or not isinstance(query_hash, str):
+        raise GraphQLError(
+            "Unsupported persisted query version",
+            extensions={"code": INVALID_PERSISTED_QUERY},
+        )
+
+    if query is None:
+        # Hash only request, look the query up
+        query = await store.get(query_hash)
+        if query is None:
+            raise GraphQLError(
+                "PersistedQueryNotFound",
+                extensions={"code": PERSISTED_QUERY_NOT_FOUND},
+            )
+        return query
+
+    # Query and hash, register the query after checking the hash
+    if hashlib.sha256(query.encode("utf-8")).hexdigest() != query_hash:
+        raise GraphQLError(
+            "provided sha does not match query",
+            extensions={"code": INVALID_PERSISTED_QUERY},
+        )
+    await store.set(query_hash, query)
+    return query
@@ -0,0 +1,90 @@
+# app/graphql/pubsub.py
+import asyncio
+import json
+import os
+from collections import defaultdict
+
+from app.utils import logger
+
+PUBSUB_REDIS_URL = os.getenv("PUBSUB_REDIS_URL")  # Optional shared backend
+PUBSUB_QUEUE_SIZE = int(os.getenv("PUBSUB_QUEUE_SIZE", 100))  # Per subscriber
+
+
+# In-process publish/subscribe for GraphQL subscriptions
+# Only delivers events to subscribers in the same worker
+class LocalPubSub:
+    def __init__(self, queue_size: int = PUBSUB_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.channels = defaultdict(set)  # channel -> subscriber queues
+
+    # Publish a message without blocking the caller
+    def publish(self, channel: str, message: dict):
+        for queue in list(self.channels.get(channel, ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Slow subscribers lose events instead of holding memory
+                logger.warning(f"[{LocalPubSub.__name__}] Dropped event on {channel}")
+
+    # Yield the messages published on a channel until the consumer stops
+    async def subscribe(self, channel: str):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.channels[channel].add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.channels[channel].discard(queue)
+            if not self.channels[channel]:
+                del self.channels[channel]
+
+
+# Publish/subscribe through a Redis-compatible server
+# Carries events across workers and hosts
+class RedisPubSub:
+    def __init__(self, redis_url: str):
+        import redis.asyncio as redis
+
+        self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.tasks = set()  # Pending publish tasks
+
+    # Publish a message without blocking the caller
+    def publish(self, channel: str, message: dict):
+        task = asyncio.get_running_loop().create_task(self._publish(channel, message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _publish(self, channel: str, message: dict):
+        try:
+            await self.redis.publish(channel, json.dumps(message))
+        except Exception as e:
+            logger.error(f"[{RedisPubSub.__name__}] Publish on {channel} failed: {e}")
+
+    # Yield the messages published on a channel until the consumer stops
+    async def subscribe(self, channel: str):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(channel)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield json.loads(message["data"])
+        finally:
+            await pubsub.unsubscribe(channel)
+            await pubsub.aclose()
+
+
+# Shared pub/sub instance used by mutations and subscriptions
+pubsub = RedisPubSub(PUBSUB_REDIS_URL) if PUBSUB_REDIS_URL else LocalPubSub()
+
+
+# Channel names
+def post_created_channel():
+    return "post_created"
+
+
+def comment_created_channel(post_id: int):
+    return f"comment_created:{post_id}"
+
+
+def reply_created_channel(comment_id: int):
+    return f"reply_created:{comment_id}"
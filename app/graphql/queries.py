@@ -1,7 +1,7 @@
 # GraphQL Queries
 import graphene
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.graphql.schemas import (
     UserModel,
@@ -10,14 +10,26 @@ from app.graphql.schemas import (
     PostModel,
     CommentModel,
     MediaModel,
+    MediaProcessingStatus,
+    UserConnection,
+    PostConnection,
+    CommentConnection,
+    CommentThreadNode,
 )
+from app.graphql.pagination import decode_cursor, page_size, make_connection
+from app.graphql.selections import get_selected_fields, get_recursive_selected_fields
 import app.models as models
-import app.crud as crud
+import app.async_crud as async_crud
+
+DEFAULT_THREAD_DEPTH = 3  # Reply levels loaded when `maxDepth` is not provided
+MAX_THREAD_DEPTH = 10  # Upper bound for `maxDepth`
 
 
 # Query class
 class Query(graphene.ObjectType):
-    all_users = graphene.List(UserModel)  # List of all users
+    all_users = graphene.Field(
+        UserConnection, first=graphene.Int(), after=graphene.String()
+    )  # Page of users, newest first
     user_by_id = graphene.Field(
         UserModel, user_id=graphene.Int(required=True)
     )  # User by ID
@@ -34,7 +46,9 @@ class Query(graphene.ObjectType):
         UserProfileModel, user_id=graphene.Int(required=True)
     )  # User profile by User ID
 
-    all_posts = graphene.List(PostModel)  # List of all postss
+    all_posts = graphene.Field(
+        PostConnection, first=graphene.Int(), after=graphene.String()
+    )  # Page of posts, newest first
     post_by_id = graphene.Field(
         PostModel, post_id=graphene.Int(required=True)
     )  # Post by ID
@@ -43,12 +57,22 @@ class Query(graphene.ObjectType):
         CommentModel, post_id=graphene.Int(required=True)
     )  # List of all parent comments by Post ID
 
-    all_comments_by_post_id = graphene.List(
-        CommentModel, post_id=graphene.Int(required=True)
-    )  # List of all comments by Post ID
+    all_comments_by_post_id = graphene.Field(
+        CommentConnection,
+        post_id=graphene.Int(required=True),
+        first=graphene.Int(),
+        after=graphene.String(),
+    )  # Page of comments by Post ID, oldest first
     comment_by_id = graphene.Field(
         CommentModel, comment_id=graphene.Int(required=True)
     )  # Comment by ID
+    comment_thread = graphene.List(
+        CommentThreadNode,
+        post_id=graphene.Int(required=True),
+        parent_comment_id=graphene.Int(),
+        max_depth=graphene.Int(),
+        first=graphene.Int(),
+    )  # Comment tree of a post, or of the replies to a comment, oldest first
 
     all_media_by_post_id = graphene.List(
         MediaModel, post_id=graphene.Int(required=True)
@@ -56,90 +80,189 @@ class Query(graphene.ObjectType):
     media_by_id = graphene.Field(
         MediaModel, media_id=graphene.Int(required=True)
     )  # Media by ID
+    media_status = graphene.Field(
+        MediaProcessingStatus, post_id=graphene.Int(required=True)
+    )  # Processing progress of the media of a post
 
     # Resolver functions
     # All users
-    def resolve_all_users(self, info):
-        db: Session = info.context["db"]
-        return crud.find_all_users(db)
+    async def resolve_all_users(self, info, first=None, after=None):
+        db: AsyncSession = info.context["db"]
+        limit = page_size(first)
+        # Fetch one extra row to know if there is a next page
+        users = await async_crud.find_all_users(
+            db,
+            limit + 1,
+            decode_cursor(after),
+            fields=get_selected_fields(info, "edges", "node"),
+        )
+        return make_connection(
+            UserConnection, users, limit, lambda: async_crud.count_all_users(db)
+        )
 
     # User by ID
-    def resolve_user_by_id(self, info, user_id):
-        db: Session = info.context["db"]
-        user = crud.find_user_by_id(db, user_id)
+    async def resolve_user_by_id(self, info, user_id):
+        db: AsyncSession = info.context["db"]
+        user = await async_crud.find_user_by_id(db, user_id, get_selected_fields(info))
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         return user
 
     # User by username
-    def resolve_user_by_username(self, info, username):
-        db: Session = info.context["db"]
-        user = crud.find_user_by_username(db, username)
+    async def resolve_user_by_username(self, info, username):
+        db: AsyncSession = info.context["db"]
+        user = await async_crud.find_user_by_username(
+            db, username, get_selected_fields(info)
+        )
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         return user
 
     # All roles
-    def resolve_all_roles(self, info):
-        db: Session = info.context["db"]
-        return crud.find_all_roles(db)
+    async def resolve_all_roles(self, info):
+        db: AsyncSession = info.context["db"]
+        return await async_crud.find_all_roles(db, get_selected_fields(info))
 
     # Role by ID
-    def resolve_role_by_id(self, info, role_id):
-        db: Session = info.context["db"]
-        role = crud.find_role_by_id(db, role_id)
+    async def resolve_role_by_id(self, info, role_id):
+        db: AsyncSession = info.context["db"]
+        role = await async_crud.find_role_by_id(db, role_id, get_selected_fields(info))
         if not role:
             raise HTTPException(status_code=404, detail="Role not found")
         return role
 
     # User profile by User ID
-    def resolve_user_profile(self, info, user_id):
-        db: Session = info.context["db"]
-        user_profile = crud.find_user_profile(db, user_id)
+    async def resolve_user_profile(self, info, user_id):
+        db: AsyncSession = info.context["db"]
+        user_profile = await async_crud.find_user_profile(
+            db, user_id, get_selected_fields(info)
+        )
         if not user_profile:
             raise HTTPException(status_code=404, detail="User not found")
         return user_profile
 
     # All posts
-    def resolve_all_posts(self, info):
-        db: Session = info.context["db"]
-        return crud.find_all_posts(db)
+    async def resolve_all_posts(self, info, first=None, after=None):
+        db: AsyncSession = info.context["db"]
+        limit = page_size(first)
+        # Fetch one extra row to know if there is a next page
+        posts = await async_crud.find_all_posts(
+            db,
+            limit + 1,
+            decode_cursor(after),
+            fields=get_selected_fields(info, "edges", "node"),
+        )
+        return make_connection(
+            PostConnection, posts, limit, lambda: async_crud.count_all_posts(db)
+        )
 
     # Post by ID
-    def resolve_post_by_id(self, info, post_id):
-        db: Session = info.context["db"]
-        post = crud.find_post_by_id(db, post_id)
+    async def resolve_post_by_id(self, info, post_id):
+        db: AsyncSession = info.context["db"]
+        post = await async_crud.find_post_by_id(db, post_id, get_selected_fields(info))
         if not post:
             raise HTTPException(status_code=404, detail="Post not found")
         return post
 
     # All parent comments by Post ID
-    def resolve_all_parent_comments_by_post_id(self, info, post_id):
-        db: Session = info.context["db"]
-        return crud.find_all_parent_comments_by_post_id(db, post_id)
+    async def resolve_all_parent_comments_by_post_id(self, info, post_id):
+        db: AsyncSession = info.context["db"]
+        return await async_crud.find_all_parent_comments_by_post_id(
+            db, post_id, get_selected_fields(info)
+        )
 
     # All comments by Post ID
-    def resolve_all_comments_by_post_id(self, info, post_id):
-        db: Session = info.context["db"]
-        return crud.find_all_comments_by_post_id(db, post_id)
+    async def resolve_all_comments_by_post_id(
+        self, info, post_id, first=None, after=None
+    ):
+        db: AsyncSession = info.context["db"]
+        limit = page_size(first)
+        # Fetch one extra row to know if there is a next page
+        comments = await async_crud.find_all_comments_by_post_id(
+            db,
+            post_id,
+            limit + 1,
+            decode_cursor(after),
+            fields=get_selected_fields(info, "edges", "node"),
+        )
+        return make_connection(
+            CommentConnection,
+            comments,
+            limit,
+            lambda: async_crud.count_all_comments_by_post_id(db, post_id),
+        )
 
     # Comment by ID
-    def resolve_comment_by_id(self, info, comment_id):
-        db: Session = info.context["db"]
-        comment = crud.find_comment_by_id(db, comment_id)
+    async def resolve_comment_by_id(self, info, comment_id):
+        db: AsyncSession = info.context["db"]
+        comment = await async_crud.find_comment_by_id(
+            db, comment_id, get_selected_fields(info)
+        )
         if not comment:
             raise HTTPException(status_code=404, detail="Comment not found")
         return comment
 
+    # Comment tree, `first` comments per parent down to `maxDepth` levels
+    async def resolve_comment_thread(
+        self, info, post_id, parent_comment_id=None, max_depth=None, first=None
+    ):
+        db: AsyncSession = info.context["db"]
+        if max_depth is None:
+            max_depth = DEFAULT_THREAD_DEPTH
+        if max_depth < 1:
+            raise HTTPException(status_code=400, detail="maxDepth must be positive")
+        rows = await async_crud.find_comment_thread(
+            db,
+            post_id,
+            min(max_depth, MAX_THREAD_DEPTH),
+            page_size(first),
+            parent_comment_id,
+            fields=get_recursive_selected_fields(info, "comment", "replies"),
+        )
+        # Rows come ordered by depth, so parents are placed before their replies
+        thread, nodes = [], {}
+        for comment, depth, reply_count in rows:
+            node = CommentThreadNode(
+                comment=comment, depth=depth, reply_count=reply_count, replies=[]
+            )
+            if depth == 1:
+                thread.append(node)
+            elif comment.parent_comment_id in nodes:
+                nodes[comment.parent_comment_id].replies.append(node)
+            else:
+                continue
+            nodes[comment.id] = node
+        return thread
+
     # All media by Post ID
-    def resolve_all_media_by_post_id(self, info, post_id):
-        db: Session = info.context["db"]
-        return crud.find_all_media_by_post_id(db, post_id)
+    async def resolve_all_media_by_post_id(self, info, post_id):
+        db: AsyncSession = info.context["db"]
+        return await async_crud.find_all_media_by_post_id(
+            db, post_id, get_selected_fields(info)
+        )
 
     # Media by ID
-    def resolve_media_by_id(self, info, media_id):
-        db: Session = info.context["db"]
-        media = crud.find_media_by_id(db, media_id)
+    async def resolve_media_by_id(self, info, media_id):
+        db: AsyncSession = info.context["db"]
+        media = await async_crud.find_media_by_id(
+            db, media_id, get_selected_fields(info)
+        )
         if not media:
             raise HTTPException(status_code=404, detail="Media not found")
         return media
+
+    # Processing progress of the media of a post
+    async def resolve_media_status(self, info, post_id):
+        db: AsyncSession = info.context["db"]
+        media = await async_crud.find_all_media_by_post_id(db, post_id)
+        statuses = [item.status for item in media]
+        ready = statuses.count(models.MediaStatus.READY)
+        failed = statuses.count(models.MediaStatus.FAILED)
+        return MediaProcessingStatus(
+            total=len(media),
+            pending=len(media) - ready - failed,
+            ready=ready,
+            failed=failed,
+            done=ready + failed == len(media),
+            media=media,
+        )
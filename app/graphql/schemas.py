@@ -1,8 +1,14 @@
 # app/graphql/schema.py
+import graphene
 from graphene_sqlalchemy import SQLAlchemyObjectType
 from app.models import User, Role, Post, Comment, Media, UserProfile
+from app.graphql.loaders import load
+import app.like_counters as like_counters
+from app.graphql.pagination import CountableConnection
 
 # GraphQL Schemas for the models
+# Relationships are resolved through the per-request loaders in info.context["loaders"]
+# so that sibling objects share a single IN (...) query per relationship
 
 
 class UserModel(SQLAlchemyObjectType):
@@ -10,28 +16,160 @@ class UserModel(SQLAlchemyObjectType):
         model = User
         exclude_fields = ("hashed_password",)  # Exclude sensitive fields
 
+    async def resolve_role(root, info):
+        return await load(
+            root, "role", info.context["loaders"].role_by_id, root.role_id
+        )
+
+    async def resolve_profile(root, info):
+        return await load(
+            root, "profile", info.context["loaders"].profile_by_user_id, root.id
+        )
+
+    async def resolve_posts(root, info):
+        return await load(
+            root, "posts", info.context["loaders"].posts_by_user_id, root.id
+        )
+
+    async def resolve_comments(root, info):
+        return await load(
+            root, "comments", info.context["loaders"].comments_by_user_id, root.id
+        )
+
 
 class RoleModel(SQLAlchemyObjectType):
     class Meta:
         model = Role
 
+    async def resolve_users(root, info):
+        return await load(
+            root, "users", info.context["loaders"].users_by_role_id, root.id
+        )
+
+
+# Resized copy of an uploaded image, clients fetch the size they display
+class MediaVariant(graphene.ObjectType):
+    name = graphene.String()  # Variant name of the IMAGE_VARIANTS ladder
+    url = graphene.String()
+    format = graphene.String()
+    width = graphene.Int()
+    height = graphene.Int()
+
 
 class UserProfileModel(SQLAlchemyObjectType):
     class Meta:
         model = UserProfile
 
+    profile_photo_variants = graphene.List(MediaVariant)
+
+    async def resolve_user(root, info):
+        return await load(
+            root, "user", info.context["loaders"].user_by_id, root.user_id
+        )
+
 
 class PostModel(SQLAlchemyObjectType):
     class Meta:
         model = Post
         # exclude_fields = ('user_id',)  # Exclude sensitive fields
 
+    async def resolve_user(root, info):
+        return await load(
+            root, "user", info.context["loaders"].user_by_id, root.user_id
+        )
+
+    async def resolve_comments(root, info):
+        return await load(
+            root, "comments", info.context["loaders"].comments_by_post_id, root.id
+        )
+
+    async def resolve_media(root, info):
+        return await load(
+            root, "media", info.context["loaders"].media_by_post_id, root.id
+        )
+
+    # Stored count plus the likes not written yet
+    def resolve_likes(root, info):
+        return like_counters.count(Post, root.id, root.likes)
+
 
 class CommentModel(SQLAlchemyObjectType):
     class Meta:
         model = Comment
 
+    async def resolve_user(root, info):
+        return await load(
+            root, "user", info.context["loaders"].user_by_id, root.user_id
+        )
+
+    async def resolve_post(root, info):
+        return await load(
+            root, "post", info.context["loaders"].post_by_id, root.post_id
+        )
+
+    async def resolve_replies(root, info):
+        return await load(
+            root, "replies", info.context["loaders"].replies_by_comment_id, root.id
+        )
+
+    # Stored count plus the likes not written yet
+    def resolve_likes(root, info):
+        return like_counters.count(Comment, root.id, root.likes)
+
+    async def resolve_parent_comment(root, info):
+        return await load(
+            root,
+            "parent_comment",
+            info.context["loaders"].comment_by_id,
+            root.parent_comment_id,
+        )
+
+
+# Comment of a thread loaded by the commentThread query
+# Replies beyond the requested depth or page can be loaded with another
+# commentThread query starting at this comment
+class CommentThreadNode(graphene.ObjectType):
+    comment = graphene.Field(CommentModel)
+    depth = graphene.Int()  # 1 for the top level comments of the thread
+    reply_count = graphene.Int()  # All replies, including the ones not loaded
+    replies = graphene.List(lambda: CommentThreadNode)
+
 
 class MediaModel(SQLAlchemyObjectType):
     class Meta:
         model = Media
+
+    variants = graphene.List(MediaVariant)  # Empty for videos
+
+    async def resolve_post(root, info):
+        return await load(
+            root, "post", info.context["loaders"].post_by_id, root.post_id
+        )
+
+
+# Processing progress of the media of a post, reported by the mediaStatus query
+class MediaProcessingStatus(graphene.ObjectType):
+    total = graphene.Int()  # Media of the post
+    pending = graphene.Int()  # Waiting for or being processed
+    ready = graphene.Int()  # Processed, file_url points to the result
+    failed = graphene.Int()  # Processing failed
+    done = graphene.Boolean()  # No media left to process
+    media = graphene.List(MediaModel)
+
+
+# Connections for keyset-paginated lists
+
+
+class UserConnection(CountableConnection):
+    class Meta:
+        node = UserModel
+
+
+class PostConnection(CountableConnection):
+    class Meta:
+        node = PostModel
+
+
+class CommentConnection(CountableConnection):
+    class Meta:
+        node = CommentModel
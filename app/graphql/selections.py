@@ -0,0 +1,51 @@
+# app/graphql/selections.py
+from graphene.utils.str_converters import to_snake_case
+from graphql import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+
+# Return the fields selected under the resolved field as a tree
+# {snake_case_name: {...sub fields}}, following `path` through wrapper types
+# e.g. get_selected_fields(info, "edges", "node") for connections
+def get_selected_fields(info, *path):
+    fields = {}
+    for field_node in info.field_nodes:
+        _merge(fields, _selection_tree(info, field_node.selection_set))
+    for name in path:
+        fields = fields.get(to_snake_case(name), {})
+    return fields
+
+
+def _selection_tree(info, selection_set):
+    tree = {}
+    if selection_set is None:
+        return tree
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            name = selection.name.value
+            if name.startswith("__"):
+                continue
+            subtree = tree.setdefault(to_snake_case(name), {})
+            _merge(subtree, _selection_tree(info, selection.selection_set))
+        elif isinstance(selection, InlineFragmentNode):
+            _merge(tree, _selection_tree(info, selection.selection_set))
+        elif isinstance(selection, FragmentSpreadNode):
+            fragment = info.fragments.get(selection.name.value)
+            if fragment is not None:
+                _merge(tree, _selection_tree(info, fragment.selection_set))
+    return tree
+
+
+def _merge(target, source):
+    for name, subtree in source.items():
+        _merge(target.setdefault(name, {}), subtree)
+
+
+# Merge the fields selected under `field` at every level of a recursive selection
+# e.g. commentThread { comment { ... } replies { comment { ... } replies { ... } } }
+def get_recursive_selected_fields(info, field, recursive_field):
+    fields = {}
+    tree = get_selected_fields(info)
+    while tree:
+        _merge(fields, tree.get(to_snake_case(field), {}))
+        tree = tree.get(to_snake_case(recursive_field))
+    return fields
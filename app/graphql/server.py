@@ -0,0 +1,469 @@
+# app/graphql/server.py
+import asyncio
+import hashlib
+import json
+import os
+from inspect import isawaitable
+from typing import Any, Dict, Optional
+from graphql import (
+    ExecutionResult,
+    FieldNode,
+    GraphQLError,
+    Node,
+    OperationType,
+    execute,
+    parse,
+    print_ast,
+    subscribe,
+    validate,
+)
+from graphql.utilities import get_operation_ast
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from starlette_graphene3 import GraphQLApp, _get_operation_from_request
+
+from fastapi import HTTPException
+
+from app.db_configuration import record_write, use_replica
+from app.graphql.cost_analysis import check_query_cost
+from app.graphql.persisted_queries import (
+    PersistedQueryStore,
+    resolve_persisted_query,
+)
+from app.metrics import (
+    GRAPHQL_RESOLVER_ERRORS,
+    current_request_metrics,
+    operation_label,
+)
+from app.response_cache import (
+    CACHEABLE_FIELDS,
+    UNCACHEABLE_TAG,
+    collecting_tags,
+    deferring_invalidations,
+    response_cache,
+)
+from app.utils import LRUCache, check_auth
+
+# Document cache limits
+DOCUMENT_CACHE_SIZE = int(os.getenv("GRAPHQL_DOCUMENT_CACHE_SIZE", 1000))
+DOCUMENT_CACHE_BYTES = int(os.getenv("GRAPHQL_DOCUMENT_CACHE_BYTES", 64 * 1024 * 1024))
+# Estimated memory of a parsed AST node with its location and source tokens
+DOCUMENT_NODE_BYTES = 512
+# Cache-Control max-age for anonymous GET queries (0 disables the header)
+GET_MAX_AGE = int(os.getenv("GRAPHQL_GET_MAX_AGE", 0))
+
+# WebSocket subprotocol of the graphql-ws library
+GRAPHQL_TRANSPORT_WS = "graphql-transport-ws"
+
+# Errors for the operation types a transport does not support
+GET_REJECTED_OPERATIONS = {
+    OperationType.MUTATION: "Can only perform a query operation from a GET request",
+    OperationType.SUBSCRIPTION: "Can only perform a query operation from a GET request",
+}
+HTTP_REJECTED_OPERATIONS = {
+    OperationType.SUBSCRIPTION: "Subscriptions are only supported over WebSocket",
+}
+WS_REJECTED_OPERATIONS = {}
+
+
+# Cache of parsed and validated documents keyed by a hash of the query text
+class DocumentCache(LRUCache):
+    def __init__(
+        self, max_entries: int = DOCUMENT_CACHE_SIZE, max_bytes=DOCUMENT_CACHE_BYTES
+    ):
+        super().__init__(max_entries=max_entries, max_bytes=max_bytes)
+
+    # Return the parsed document and the validation errors of a query
+    # Only documents that pass validation are cached
+    def get_document(self, schema, query: str):
+        key = hashlib.sha256(query.encode("utf-8")).hexdigest()
+        document = self.get(key)
+        if document is not None:
+            return document, []
+        try:
+            document = parse(query)
+        except GraphQLError as error:
+            return None, [error]
+        errors = validate(schema, document)
+        if not errors:
+            self.set(key, document, size=document_size(document))
+        return document, errors
+
+
+# Estimated memory of a parsed document, DOCUMENT_NODE_BYTES per AST node
+# The query text is small next to the node objects built from it
+def document_size(document) -> int:
+    nodes, stack = 0, [document]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        for key in node.keys:
+            value = getattr(node, key, None)
+            if isinstance(value, Node):
+                stack.append(value)
+            elif isinstance(value, (list, tuple)):
+                stack.extend(item for item in value if isinstance(item, Node))
+    return nodes * DOCUMENT_NODE_BYTES
+
+
+# GraphQL app that reuses parsed and validated documents across requests,
+# supports automatic persisted queries over POST and GET and enforces query cost limits
+class GraphQLServer(GraphQLApp):
+    def __init__(
+        self,
+        schema,
+        *,
+        document_cache: DocumentCache = None,
+        persisted_query_store: PersistedQueryStore = None,
+        response_cache=response_cache,
+        get_max_age: int = GET_MAX_AGE,
+        **kwargs,
+    ):
+        super().__init__(schema, **kwargs)
+        self.document_cache = document_cache or DocumentCache()
+        self.persisted_query_store = persisted_query_store or PersistedQueryStore()
+        self.response_cache = response_cache  # None disables response caching
+        self.get_max_age = get_max_age
+
+    # GET requests with a query or a persisted query hash are executed,
+    # any other GET falls back to the on_get handler (GraphiQL)
+    async def _get_on_get(self, request: Request) -> Optional[Response]:
+        params = request.query_params
+        if "query" not in params and "extensions" not in params:
+            return await super()._get_on_get(request)
+
+        try:
+            operation = {
+                "query": params.get("query"),
+                "operationName": params.get("operationName"),
+                "variables": json.loads(params.get("variables") or "null"),
+                "extensions": json.loads(params.get("extensions") or "null"),
+            }
+        except ValueError:
+            return JSONResponse(
+                {"errors": ["'variables' and 'extensions' must be valid JSON"]},
+                status_code=400,
+            )
+
+        context_value = await self._get_context_value(request)
+        result = await self._execute_operation(
+            operation, context_value, query_only=True
+        )
+        response = self._make_response(result, context_value)
+        # Anonymous query results may be cached by intermediaries
+        if (
+            self.get_max_age
+            and not result.errors
+            and "Authorization" not in request.headers
+        ):
+            response.headers["Cache-Control"] = f"public, max-age={self.get_max_age}"
+        return response
+
+    async def _handle_http_request(self, request: Request) -> JSONResponse:
+        try:
+            operations = await _get_operation_from_request(request)
+        except ValueError as e:
+            return JSONResponse({"errors": [e.args[0]]}, status_code=400)
+
+        if isinstance(operations, list):
+            return JSONResponse(
+                {"errors": ["This server does not support batching"]}, status_code=400
+            )
+        else:
+            operation = operations
+
+        context_value = await self._get_context_value(request)
+        result = await self._execute_operation(operation, context_value)
+        return self._make_response(result, context_value)
+
+    def _make_response(self, result: ExecutionResult, context_value) -> JSONResponse:
+        response: Dict[str, Any] = {"data": result.data}
+        if result.errors:
+            for error in result.errors:
+                if error.original_error:
+                    self.logger.error(
+                        "An exception occurred in resolvers",
+                        exc_info=error.original_error,
+                    )
+            response["errors"] = [
+                self.error_formatter(error) for error in result.errors
+            ]
+        if result.extensions:
+            response["extensions"] = result.extensions
+
+        return JSONResponse(
+            response,
+            status_code=200,
+            background=context_value.get("background"),
+        )
+
+    # Resolve, parse, validate and cost-check an operation
+    # Returns (document, cost report, errors)
+    async def _prepare_operation(self, operation, rejected_operations):
+        try:
+            query = await resolve_persisted_query(self.persisted_query_store, operation)
+        except GraphQLError as error:
+            return None, None, [error]
+        if not isinstance(query, str):
+            return None, None, [GraphQLError("Must provide query string.")]
+
+        schema = self.schema.graphql_schema
+        document, errors = self.document_cache.get_document(schema, query)
+        if errors:
+            return None, None, errors
+
+        operation_ast = get_operation_ast(document, operation.get("operationName"))
+        # Label the request metrics with the executed operation
+        metrics = current_request_metrics()
+        if metrics is not None and operation_ast is not None:
+            metrics.operation_name = operation_label(
+                operation_ast.name.value if operation_ast.name else None
+            )
+            metrics.operation_type = operation_ast.operation.value
+
+        if operation_ast and operation_ast.operation in rejected_operations:
+            message = rejected_operations[operation_ast.operation]
+            return None, None, [GraphQLError(message)]
+
+        # Reject operations that are too deep or too expensive before executing
+        try:
+            cost = check_query_cost(
+                schema,
+                document,
+                operation.get("operationName"),
+                operation.get("variables"),
+            )
+        except GraphQLError as error:
+            return None, None, [error]
+        return document, cost, []
+
+    # Execute a query or mutation through the document cache
+    # GET requests are limited to query operations
+    async def _execute_operation(
+        self, operation, context_value, query_only=False
+    ) -> ExecutionResult:
+        rejected = GET_REJECTED_OPERATIONS if query_only else HTTP_REJECTED_OPERATIONS
+        document, cost, errors = await self._prepare_operation(operation, rejected)
+        if errors:
+            return ExecutionResult(data=None, errors=errors)
+
+        # Serve public read queries from the response cache
+        cache_key = self._response_cache_key(document, operation, context_value)
+
+        # Queries read from a replica unless the viewer wrote recently
+        # Cacheable queries read from the primary, a lagging replica would put
+        # rows a write just invalidated back into the shared cache
+        operation_ast = get_operation_ast(document, operation.get("operationName"))
+        operation_type = operation_ast.operation if operation_ast else None
+        viewer_id = self._viewer_id(context_value)
+        if operation_type == OperationType.QUERY and cache_key is None:
+            await use_replica(context_value["db"], viewer_id)
+
+        if cache_key is not None:
+            data = await self.response_cache.get(cache_key)
+            if data is not None:
+                return ExecutionResult(data=data, extensions={"cost": cost})
+
+        # The cached responses invalidated by the writes of a mutation are
+        # dropped before its response is sent
+        async with deferring_invalidations():
+            with collecting_tags() as tags:
+                result = execute(
+                    self.schema.graphql_schema,
+                    document,
+                    root_value=self.root_value,
+                    context_value=context_value,
+                    variable_values=operation.get("variables"),
+                    operation_name=operation.get("operationName"),
+                    middleware=self.middleware,
+                    execution_context_class=self.execution_context_class,
+                )
+                if isawaitable(result):
+                    result = await result
+        cacheable = not result.errors and UNCACHEABLE_TAG not in tags
+        if cache_key is not None and cacheable:
+            await self.response_cache.set(cache_key, result.data, tags)
+        if operation_type == OperationType.MUTATION and viewer_id:
+            await record_write(viewer_id)
+        metrics = current_request_metrics()
+        if result.errors and metrics is not None and metrics.operation_type:
+            resolver_errors = [e for e in result.errors if e.original_error]
+            if resolver_errors:
+                GRAPHQL_RESOLVER_ERRORS.labels(
+                    metrics.operation_name or "anonymous", metrics.operation_type
+                ).inc(len(resolver_errors))
+        if cost is not None:
+            result.extensions = {**(result.extensions or {}), "cost": cost}
+        return result
+
+    # User ID of the request token, None for anonymous requests and invalid tokens
+    @staticmethod
+    def _viewer_id(context_value):
+        authorization = context_value["request"].headers.get("Authorization")
+        if not authorization:
+            return None
+        try:
+            return check_auth(authorization).get("user_id")
+        except HTTPException:
+            return None
+
+    # Key of a cacheable operation: a query selecting only cacheable root fields
+    # Returns None for operations that must not be cached
+    def _response_cache_key(self, document, operation, context_value):
+        if self.response_cache is None:
+            return None
+        operation_ast = get_operation_ast(document, operation.get("operationName"))
+        if operation_ast is None or operation_ast.operation != OperationType.QUERY:
+            return None
+        for selection in operation_ast.selection_set.selections:
+            if not isinstance(selection, FieldNode):
+                return None
+            if selection.name.value not in CACHEABLE_FIELDS:
+                return None
+        # Viewers that send credentials never share entries with anonymous ones
+        request = context_value.get("request")
+        viewer = "authenticated" if "Authorization" in request.headers else "public"
+        key = json.dumps(
+            [
+                print_ast(document),
+                operation.get("operationName"),
+                operation.get("variables"),
+                viewer,
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    # Only graphql-transport-ws is served, the legacy graphql-ws protocol of the
+    # base class skips the query limits and caches of _prepare_operation
+    async def _run_websocket_server(self, websocket: WebSocket) -> None:
+        if GRAPHQL_TRANSPORT_WS not in websocket.scope.get("subprotocols", []):
+            await websocket.accept()
+            return await websocket.close(4406, "Subprotocol not acceptable")
+
+        await websocket.accept(GRAPHQL_TRANSPORT_WS)
+        operations: Dict[str, asyncio.Task] = {}
+        acknowledged = False
+        try:
+            while True:
+                message = await websocket.receive_json()
+                message_type = message.get("type")
+                operation_id = message.get("id")
+                if message_type == "connection_init":
+                    if acknowledged:
+                        return await websocket.close(
+                            4429, "Too many initialisation requests"
+                        )
+                    websocket.scope["connection_params"] = message.get("payload")
+                    acknowledged = True
+                    await websocket.send_json({"type": "connection_ack"})
+                elif message_type == "ping":
+                    await websocket.send_json({"type": "pong"})
+                elif message_type == "pong":
+                    pass
+                elif message_type == "subscribe":
+                    if not acknowledged:
+                        return await websocket.close(4401, "Unauthorized")
+                    if not isinstance(operation_id, str):
+                        return await websocket.close(4400, "Invalid message")
+                    running = operations.get(operation_id)
+                    if running is not None and not running.done():
+                        return await websocket.close(
+                            4409, f"Subscriber for {operation_id} already exists"
+                        )
+                    operations[operation_id] = asyncio.create_task(
+                        self._ws_run_operation(
+                            websocket, operation_id, message.get("payload") or {}
+                        )
+                    )
+                elif message_type == "complete":
+                    task = operations.pop(operation_id, None)
+                    if task is not None:
+                        task.cancel()
+                else:
+                    return await websocket.close(4400, "Invalid message type")
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for task in operations.values():
+                task.cancel()
+
+    # Run one graphql-transport-ws operation and stream its results
+    async def _ws_run_operation(self, websocket: WebSocket, operation_id, payload):
+        context_value = await self._get_context_value(websocket)
+        try:
+            document, cost, errors = await self._prepare_operation(
+                payload, WS_REJECTED_OPERATIONS
+            )
+            if errors:
+                return await websocket.send_json(
+                    {
+                        "type": "error",
+                        "id": operation_id,
+                        "payload": [self.error_formatter(e) for e in errors],
+                    }
+                )
+
+            operation_ast = get_operation_ast(document, payload.get("operationName"))
+            if operation_ast.operation == OperationType.SUBSCRIPTION:
+                results = await subscribe(
+                    self.schema.graphql_schema,
+                    document,
+                    root_value=self.root_value,
+                    context_value=context_value,
+                    variable_values=payload.get("variables"),
+                    operation_name=payload.get("operationName"),
+                )
+            else:
+                results = execute(
+                    self.schema.graphql_schema,
+                    document,
+                    root_value=self.root_value,
+                    context_value=context_value,
+                    variable_values=payload.get("variables"),
+                    operation_name=payload.get("operationName"),
+                    middleware=self.middleware,
+                    execution_context_class=self.execution_context_class,
+                )
+                if isawaitable(results):
+                    results = await results
+
+            if isinstance(results, ExecutionResult):
+                if results.data is None and results.errors:
+                    return await websocket.send_json(
+                        {
+                            "type": "error",
+                            "id": operation_id,
+                            "payload": [
+                                self.error_formatter(e) for e in results.errors
+                            ],
+                        }
+                    )
+                await self._ws_send_result(websocket, operation_id, results)
+            else:
+                async for result in results:
+                    await self._ws_send_result(websocket, operation_id, result)
+                    # Release the database connection between events
+                    if isinstance(context_value, dict) and "db" in context_value:
+                        await context_value["db"].close()
+            await websocket.send_json({"type": "complete", "id": operation_id})
+        except WebSocketDisconnect:
+            pass
+        finally:
+            if isinstance(context_value, dict) and "db" in context_value:
+                await context_value["db"].close()
+
+    async def _ws_send_result(self, websocket, operation_id, result):
+        payload: Dict[str, Any] = {"data": result.data}
+        if result.errors:
+            for error in result.errors:
+                if error.original_error:
+                    self.logger.error(
+                        "An exception occurred in resolvers",
+                        exc_info=error.original_error,
+                    )
+            payload["errors"] = [self.error_formatter(error) for error in result.errors]
+        await websocket.send_json(
+            {"type": "next", "id": operation_id, "payload": payload}
+        )
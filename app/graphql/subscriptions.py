@@ -0,0 +1,68 @@
+# GraphQL Subscriptions
+import graphene
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.graphql.schemas import PostModel, CommentModel
+from app.graphql.loaders import Loaders
+from app.graphql.pubsub import (
+    pubsub,
+    post_created_channel,
+    comment_created_channel,
+    reply_created_channel,
+)
+from app.graphql.selections import get_selected_fields
+import app.async_crud as async_crud
+
+
+# Prepare the context for resolving one event
+# Every event gets fresh loaders so cached rows from previous events are not reused
+def event_db(info) -> AsyncSession:
+    db: AsyncSession = info.context["db"]
+    info.context["loaders"] = Loaders(db)
+    return db
+
+
+# Subscription class
+class Subscription(graphene.ObjectType):
+    post_created = graphene.Field(PostModel)  # New posts
+    comment_created = graphene.Field(
+        CommentModel, post_id=graphene.Int(required=True)
+    )  # New comments and replies on a post
+    reply_created = graphene.Field(
+        CommentModel, comment_id=graphene.Int(required=True)
+    )  # New replies to a comment
+
+    # Event sources, every event carries the ID of the created row
+    async def subscribe_post_created(root, info):
+        async for event in pubsub.subscribe(post_created_channel()):
+            yield event
+
+    async def subscribe_comment_created(root, info, post_id):
+        async for event in pubsub.subscribe(comment_created_channel(post_id)):
+            yield event
+
+    async def subscribe_reply_created(root, info, comment_id):
+        async for event in pubsub.subscribe(reply_created_channel(comment_id)):
+            yield event
+
+    # Resolver functions, `root` is the published event
+    # New post
+    async def resolve_post_created(root, info):
+        db = event_db(info)
+        return await async_crud.find_post_by_id(
+            db, root["id"], get_selected_fields(info)
+        )
+
+    # New comment on a post
+    async def resolve_comment_created(root, info, post_id):
+        db = event_db(info)
+        return await async_crud.find_comment_by_id(
+            db, root["id"], get_selected_fields(info)
+        )
+
+    # New reply to a comment
+    async def resolve_reply_created(root, info, comment_id):
+        db = event_db(info)
+        return await async_crud.find_comment_by_id(
+            db, root["id"], get_selected_fields(info)
+        )
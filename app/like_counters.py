@@ -0,0 +1,106 @@
+# app/like_counters.py
+# Like counts of posts and comments with coalesced writes
+# Likes add to an in-memory delta per row instead of updating the row, the deltas
+# are written every LIKE_FLUSH_INTERVAL seconds with one batched UPDATE per table
+import asyncio
+import os
+import time
+from collections import defaultdict
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import app.models as models
+from app.db_configuration import async_engine
+from app.response_cache import entity_tag, response_cache
+from app.utils import LRUCache, logger
+
+# Like counter configuration
+LIKE_FLUSH_INTERVAL = float(os.getenv("LIKE_FLUSH_INTERVAL", 1))  # Seconds
+LIKE_COUNT_CACHE_SIZE = int(os.getenv("LIKE_COUNT_CACHE_SIZE", 10000))
+LIKE_COUNT_TTL = int(os.getenv("LIKE_COUNT_TTL", 30))  # Max staleness across workers
+
+# Models with a `likes` counter column
+COUNTED_MODELS = (models.Post, models.Comment)
+
+_pending = defaultdict(int)  # (model, id) -> likes not written yet
+_counts = LRUCache(max_entries=LIKE_COUNT_CACHE_SIZE)  # (model, id) -> (expires, likes)
+_flush_lock = asyncio.Lock()  # One flush at a time, each writes the buffered deltas
+
+
+# Buffer likes of a row
+def add(model, row_id: int, delta: int = 1):
+    _pending[(model, row_id)] += delta
+
+
+# Like count of a row: the stored count plus the likes not written yet
+def count(model, row_id: int, stored: int):
+    return (stored or 0) + _pending.get((model, row_id), 0)
+
+
+# Last known stored count of a row, loaded from the database on a cache miss
+# Returns None when the row does not exist
+async def stored_count(db: AsyncSession, model, row_id: int):
+    entry = _counts.get((model, row_id))
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    result = await db.execute(select(model.likes).where(model.id == row_id))
+    row = result.first()
+    if row is None:
+        return None
+    _counts.set((model, row_id), (time.monotonic() + LIKE_COUNT_TTL, row[0] or 0))
+    return row[0] or 0
+
+
+# Write the buffered deltas, rows are updated in ID order so concurrent
+# flushes of several workers lock them in the same order
+# The deltas stay buffered until the UPDATE commits, so counts never dip
+async def flush():
+    async with _flush_lock:
+        await _flush()
+
+
+async def _flush():
+    deltas = {key: delta for key, delta in _pending.items() if delta}
+    if not deltas:
+        return
+    try:
+        async with async_engine.begin() as connection:
+            for model in COUNTED_MODELS:
+                table = model.__table__
+                rows = sorted(
+                    (row_id, delta)
+                    for (target, row_id), delta in deltas.items()
+                    if target is model
+                )
+                if not rows:
+                    continue
+                await connection.execute(
+                    update(table)
+                    .where(table.c.id == bindparam("row_id"))
+                    .values(likes=func.coalesce(table.c.likes, 0) + bindparam("delta")),
+                    [{"row_id": row_id, "delta": delta} for row_id, delta in rows],
+                )
+    except Exception as e:
+        # The deltas are written by the next flush
+        logger.error(f"[{flush.__name__}] Writing like counts failed: {e}")
+        return
+
+    # Move the written deltas from the buffer to the cached counts, likes added
+    # during the flush stay buffered
+    for key, delta in deltas.items():
+        _pending[key] -= delta
+        if not _pending[key]:
+            del _pending[key]
+        entry = _counts.get(key)
+        if entry is not None:
+            _counts.set(key, (entry[0], entry[1] + delta))
+    response_cache.invalidate(
+        {entity_tag(model.__tablename__, row_id) for model, row_id in deltas}
+    )
+
+
+# Flush the buffered deltas every LIKE_FLUSH_INTERVAL seconds
+async def run_flusher(interval: float = LIKE_FLUSH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        await flush()
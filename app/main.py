@@ -6,17 +6,35 @@ import json
 import os
 from fastapi import FastAPI, Request, UploadFile, HTTPException, Depends, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from starlette_graphene3 import GraphQLApp, make_graphiql_handler
+from starlette_graphene3 import make_graphiql_handler
 from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import HTTPConnection
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 from contextlib import asynccontextmanager
 from pathlib import Path
 
 # Custom imports
-from app.db_configuration import get_db, init_db
+from app.db_configuration import (
+    RequestSessionMiddleware,
+    async_engine,
+    async_session,
+    engine,
+    get_db,
+    init_db,
+    pool_stats,
+    replicas,
+    request_db,
+    warm_up_pools,
+)
 from app.graphql import schema
+from app.graphql.loaders import Loaders
+from app.graphql.server import GraphQLServer
+import app.like_counters as like_counters
+from app.metrics import MetricsMiddleware, render_metrics
+from app.utils import RequestSizeLimitMiddleware, stream_upload
 
 
 # Lifespan context manager for database session
@@ -24,11 +42,23 @@ from app.graphql import schema
 async def lifespan(app: FastAPI):
     try:
         init_db()
+        await warm_up_pools()  # Open the pool connections before serving
+        # Keep checking the read replicas while the app runs
+        if replicas.engines:
+            app.state.replica_monitor = asyncio.create_task(replicas.monitor())
+        # Write the buffered like counts periodically
+        app.state.like_flusher = asyncio.create_task(like_counters.run_flusher())
         """FastAPI başlatıldığında UDP server başlasın"""
         # app.state.db_session = get_db()  # Get a new session
         yield
     finally:
-        pass
+        monitor = getattr(app.state, "replica_monitor", None)
+        if monitor is not None:
+            monitor.cancel()
+        flusher = getattr(app.state, "like_flusher", None)
+        if flusher is not None:
+            flusher.cancel()
+            await like_counters.flush()  # Write the likes buffered since the last flush
         # app.state.db_session.close()  # Close the session
         # await app.state.db_session.close()
 
@@ -48,6 +78,16 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+# Reject request bodies over UPLOAD_MAX_REQUEST_BYTES while they stream in
+app.add_middleware(RequestSizeLimitMiddleware)
+
+# Close the request-scoped db session at the end of every request
+app.add_middleware(RequestSessionMiddleware)
+
+# Add Prometheus metrics middleware (per-operation latency, SQL and pool usage)
+# Added last so it wraps the session middleware and sees connections returned
+app.add_middleware(MetricsMiddleware)
+
 
 # Favicon route
 @app.get("/favicon.ico")
@@ -63,11 +103,18 @@ async def create_upload_file(file: UploadFile):
     UPLOAD_DIR = Path("uploads")
     UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
     try:
-        file_location = UPLOAD_DIR / file.filename
-        # Save the file with a unique name to avoid collisions
-        with open(file_location, "wb") as f:
-            f.write(await file.read())
-        return {"filename": file.filename, "filepath": str(file_location)}
+        # Drop any directory part of the client file name
+        file_location = UPLOAD_DIR / Path(file.filename).name
+        # Stream the file to disk in chunks, hashing it on the way
+        size, sha256 = await stream_upload(file, file_location)
+        return {
+            "filename": file.filename,
+            "filepath": str(file_location),
+            "size": size,
+            "sha256": sha256,
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"File upload failed: {str(e)}")
 
@@ -80,18 +127,63 @@ async def create_upload_file(file: UploadFile):
 #     }
 
 
-app.mount(
-    "/graphql",
-    GraphQLApp(
-        schema=schema,
-        # context_value=graphql_context,  # Include the request object and db session
-        context_value=lambda request: {
-            "request": request,  # Include the request object
-            "db": next(get_db()),  # Include the db session
-        },
-        on_get=make_graphiql_handler(),  # Enable GraphiQL on GET requests
-    ),
+# Build the GraphQL context with an async db session and fresh per-request dataloaders
+# HTTP requests use the request session closed by RequestSessionMiddleware,
+# WebSocket operations own their session and the server closes it when they end
+def graphql_context(request: HTTPConnection):
+    db = request_db() if request.scope["type"] == "http" else async_session()
+    return {
+        "request": request,  # Include the request object
+        "db": db,  # Include the async db session
+        "loaders": Loaders(db),  # Batch relationship lookups for this request
+    }
+
+
+# GraphQL app with a cache of parsed and validated documents and persisted queries
+graphql_app = GraphQLServer(
+    schema=schema,
+    context_value=graphql_context,  # Include the request object and db session
+    on_get=make_graphiql_handler(),  # Enable GraphiQL on GET requests
 )
+app.mount("/graphql", graphql_app)
+
+
+# GraphQL document cache, persisted query and response cache statistics route
+@app.get("/stats/graphql")
+def graphql_stats():
+    return {
+        "document_cache": graphql_app.document_cache.stats(),
+        "persisted_queries": graphql_app.persisted_query_store.stats(),
+        "response_cache": graphql_app.response_cache.stats(),
+    }
+
+
+# Database health route with connection pool usage
+# Answers 503 when the database cannot be reached
+@app.get("/health/db")
+async def database_health():
+    try:
+        async with async_engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+        status, error = "ok", None
+    except Exception as e:
+        status, error = "unavailable", str(e)
+    content = {
+        "status": status,
+        "pools": {"sync": pool_stats(engine), "async": pool_stats(async_engine)},
+        "replicas": replicas.stats(),
+    }
+    if error is not None:
+        content["error"] = error
+    return JSONResponse(status_code=200 if error is None else 503, content=content)
+
+
+# Prometheus metrics route
+@app.get("/metrics")
+def metrics():
+    content, media_type = render_metrics()
+    return Response(content=content, media_type=media_type)
+
 
 # CELERY EXAMPLE ROUTE
 # @app.get("/test")
@@ -0,0 +1,244 @@
+# Prometheus metrics
+# When PROMETHEUS_MULTIPROC_DIR is set, every uvicorn worker writes its samples
+# to that directory and /metrics aggregates them across workers
+import os
+import time
+from contextvars import ContextVar
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+# GraphQL request latency by operation
+GRAPHQL_REQUEST_LATENCY = Histogram(
+    "graphql_request_duration_seconds",
+    "GraphQL request latency",
+    ["operation_name", "operation_type"],
+)
+# Errors raised inside resolvers by operation
+GRAPHQL_RESOLVER_ERRORS = Counter(
+    "graphql_resolver_errors_total",
+    "GraphQL resolver errors",
+    ["operation_name", "operation_type"],
+)
+# SQL statements executed per operation
+GRAPHQL_SQL_QUERIES = Histogram(
+    "graphql_sql_queries",
+    "SQL statements executed per GraphQL request",
+    ["operation_name", "operation_type"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+# Time spent in SQL per operation
+GRAPHQL_SQL_DURATION = Histogram(
+    "graphql_sql_duration_seconds",
+    "Time spent executing SQL per GraphQL request",
+    ["operation_name", "operation_type"],
+)
+# GraphQL response cache lookups by result (hit / miss)
+GRAPHQL_RESPONSE_CACHE_REQUESTS = Counter(
+    "graphql_response_cache_requests_total",
+    "GraphQL response cache lookups",
+    ["result"],
+)
+# Verified JWT cache lookups by result (hit / miss)
+JWT_CACHE_REQUESTS = Counter(
+    "jwt_cache_requests_total",
+    "Verified JWT cache lookups",
+    ["result"],
+)
+# Upload processing (compression / transcoding) duration
+UPLOAD_PROCESSING_DURATION = Histogram(
+    "upload_processing_duration_seconds",
+    "Uploaded file processing duration",
+    ["media_type"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+# Media store lookups of processed uploads by result (hit / miss)
+MEDIA_STORE_REQUESTS = Counter(
+    "media_store_requests_total",
+    "Media store lookups of processed uploads",
+    ["result"],
+)
+# Time spent waiting for a connection from the DB pool
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a database pool connection",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30),
+)
+# Connections currently checked out from the database pools
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out_connections",
+    "Database connections checked out from the pools",
+    multiprocess_mode="livesum",
+)
+# Time a connection stays checked out before it is returned to the pool
+DB_CONNECTION_HOLD_DURATION = Histogram(
+    "db_connection_hold_seconds",
+    "Time database connections stay checked out",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30, 120),
+)
+# Pool checkouts per operation
+GRAPHQL_DB_CHECKOUTS = Histogram(
+    "graphql_db_checkouts",
+    "Database pool checkouts per GraphQL request",
+    ["operation_name", "operation_type"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50),
+)
+# Most connections held at the same time per operation
+GRAPHQL_DB_CONNECTIONS_HELD = Histogram(
+    "graphql_db_connections_held",
+    "Most database connections held at once per GraphQL request",
+    ["operation_name", "operation_type"],
+    buckets=(0, 1, 2, 3, 5, 10),
+)
+# Password hashing operations queued or running in the password pool
+PASSWORD_POOL_PENDING = Gauge(
+    "password_pool_pending",
+    "Password operations queued or running",
+    multiprocess_mode="livesum",
+)
+# Password operations rejected because the password pool queue was full
+PASSWORD_POOL_REJECTIONS = Counter(
+    "password_pool_rejections_total",
+    "Password operations rejected by the password pool",
+)
+
+
+# Operation names are chosen by clients, so only the first
+# METRICS_MAX_OPERATIONS names seen by a process become label values and later
+# ones are recorded as "other", keeping the number of series bounded
+METRICS_MAX_OPERATIONS = int(os.getenv("METRICS_MAX_OPERATIONS", 200))
+METRICS_MAX_OPERATION_NAME_LENGTH = 64
+
+_operation_labels = set()
+
+
+# Label value of an operation name
+def operation_label(operation_name: str = None):
+    if not operation_name:
+        return "anonymous"
+    operation_name = operation_name[:METRICS_MAX_OPERATION_NAME_LENGTH]
+    if operation_name in _operation_labels:
+        return operation_name
+    if len(_operation_labels) < METRICS_MAX_OPERATIONS:
+        _operation_labels.add(operation_name)
+        return operation_name
+    return "other"
+
+
+# Metrics collected while serving a single request
+class RequestMetrics:
+    def __init__(self):
+        self.operation_name = None  # Set by the GraphQL server
+        self.operation_type = None  # Set by the GraphQL server
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.db_checkouts = 0  # Connections checked out from the pool
+        self.db_connections_held = 0  # Connections currently checked out
+        self.db_connections_peak = 0  # Most connections checked out at once
+
+
+_request_metrics: ContextVar[RequestMetrics] = ContextVar(
+    "request_metrics", default=None
+)
+
+
+# Return the metrics of the current request (None outside of a request)
+def current_request_metrics():
+    return _request_metrics.get()
+
+
+# ASGI middleware that records per-operation latency and SQL usage
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        metrics = RequestMetrics()
+        token = _request_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_metrics.reset(token)
+            # Only GraphQL operations are recorded
+            if metrics.operation_type is not None:
+                labels = (metrics.operation_name or "anonymous", metrics.operation_type)
+                GRAPHQL_REQUEST_LATENCY.labels(*labels).observe(
+                    time.perf_counter() - start
+                )
+                GRAPHQL_SQL_QUERIES.labels(*labels).observe(metrics.sql_queries)
+                GRAPHQL_SQL_DURATION.labels(*labels).observe(metrics.sql_seconds)
+                GRAPHQL_DB_CHECKOUTS.labels(*labels).observe(metrics.db_checkouts)
+                GRAPHQL_DB_CONNECTIONS_HELD.labels(*labels).observe(
+                    metrics.db_connections_peak
+                )
+
+
+# Count SQL statements and their duration for the current request,
+# and the pool connections it checks out
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        start = conn.info["query_start_time"].pop()
+        metrics = _request_metrics.get()
+        if metrics is not None:
+            metrics.sql_queries += 1
+            metrics.sql_seconds += time.perf_counter() - start
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # after_cursor_execute is not called for failed statements
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start_time")
+            if starts:
+                starts.pop()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKED_OUT.inc()
+        metrics = _request_metrics.get()
+        # Checkin may run outside of the request, so remember who checked it out
+        connection_record.info["checkout"] = (time.perf_counter(), metrics)
+        if metrics is not None:
+            metrics.db_checkouts += 1
+            metrics.db_connections_held += 1
+            metrics.db_connections_peak = max(
+                metrics.db_connections_peak, metrics.db_connections_held
+            )
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        checkout = connection_record.info.pop("checkout", None)
+        if checkout is None:
+            return
+        start, metrics = checkout
+        DB_POOL_CHECKED_OUT.dec()
+        DB_CONNECTION_HOLD_DURATION.observe(time.perf_counter() - start)
+        if metrics is not None:
+            metrics.db_connections_held -= 1
+
+
+# Render the metrics in the Prometheus text format
+def render_metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
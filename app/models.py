@@ -7,11 +7,15 @@ from sqlalchemy import (
     UniqueConstraint,
     Boolean,
     Table,
+    Index,
+    CheckConstraint,
+    JSON,
 )
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from sqlalchemy import Enum as SQLAlchemyEnum
 import enum
+import os
 
 from app.db_configuration import Base
 
@@ -38,6 +42,14 @@ class MediaType(enum.Enum):
     DOCUMENT = "document"
 
 
+# Enum for media processing status
+class MediaStatus(enum.Enum):
+    PENDING = "pending"  # Stored raw, waiting for a worker
+    PROCESSING = "processing"  # Being transcoded
+    READY = "ready"  # file_url points to the processed file
+    FAILED = "failed"  # Processing failed, see error
+
+
 # ROLE MODEL
 class Role(Base):
     __tablename__ = "roles"
@@ -64,7 +76,7 @@ class User(Base):
     )  # Email address
     hashed_password = Column(String(255), nullable=False)  # Hashed password
     role_id = Column(
-        Integer, ForeignKey("roles.id", ondelete="CASCADE"), nullable=False
+        Integer, ForeignKey("roles.id", ondelete="CASCADE"), nullable=False, index=True
     )  # Foreign key linking to roles table
     created_at = Column(
         DateTime(timezone=True), server_default=func.now()
@@ -87,8 +99,11 @@ class User(Base):
     comments = relationship(
         "Comment", back_populates="user", cascade="all, delete-orphan"
     )  # Relationship with comments
-    # Unique constraint for username and email
-    __table_args__ = (UniqueConstraint("username", "email", name="uq_username_email"),)
+    # Unique constraint for username and email, keyset pagination index
+    __table_args__ = (
+        UniqueConstraint("username", "email", name="uq_username_email"),
+        Index("ix_users_created_at_id", "created_at", "id"),
+    )
 
     # __repr__ method to return a string representation of the object
     def __repr__(self):
@@ -101,12 +116,17 @@ class UserProfile(Base):
 
     id = Column(Integer, primary_key=True, index=True)  # Profile ID
     user_id = Column(
-        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
     )  # Foreign key linking to users table
     first_name = Column(String(50), nullable=False)  # First name
     last_name = Column(String(50), nullable=False)  # Last name
     bio = Column(String(250), nullable=True)  # Bio
-    profile_photo = Column(String(255), nullable=True)  # Profile photo URL
+    profile_photo = Column(
+        String(255), nullable=True, index=True
+    )  # Profile photo URL, indexed to count media store references
+    profile_photo_variants = Column(
+        JSON, nullable=True
+    )  # Resized copies of the profile photo: name, url, format, width, height
     created_at = Column(
         DateTime(timezone=True), server_default=func.now()
     )  # Created timestamp
@@ -114,6 +134,15 @@ class UserProfile(Base):
         DateTime(timezone=True), onupdate=func.now()
     )  # Updated timestamp
 
+    # Responses containing a profile photo still being processed are not cached,
+    # the raw upload (uploads/profile_pictures/raw, see store_upload) is removed
+    # once the worker compressed it
+    @property
+    def response_cacheable(self):
+        if self.profile_photo is None:
+            return True
+        return os.path.basename(os.path.dirname(self.profile_photo)) != "raw"
+
     user = relationship("User", back_populates="profile")  # Relationship with users
 
     # __repr__ method to return a string representation of the object
@@ -136,7 +165,7 @@ class Post(Base):
         DateTime(timezone=True), onupdate=func.now()
     )  # Updated timestamp
     user_id = Column(
-        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
     )  # Foreign key linking to users table
 
     likes = Column(Integer, default=0)  # Like count for posts
@@ -145,7 +174,7 @@ class Post(Base):
     )  # Post visibility (public, private, followers)
     post_type = Column(SQLAlchemyEnum(PostType))  # Post type (post, share, promotion)
     parent_post_id = Column(
-        Integer, ForeignKey("posts.id"), nullable=True
+        Integer, ForeignKey("posts.id"), nullable=True, index=True
     )  # For shared posts
 
     user = relationship("User", back_populates="posts")  # Relationship with users
@@ -156,6 +185,9 @@ class Post(Base):
         "Media", back_populates="post", cascade="all, delete-orphan"
     )  # Relationship with media
 
+    # Keyset pagination index of the feed
+    __table_args__ = (Index("ix_posts_created_at_id", "created_at", "id"),)
+
     # __repr__ method to return a string representation of the object
     def __repr__(self):
         return f"<Post(content={self.content}, user_id={self.user_id}, visibility={self.visibility})>"
@@ -173,14 +205,14 @@ class Comment(Base):
         DateTime(timezone=True), onupdate=func.now()
     )  # Updated timestamp
     user_id = Column(
-        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
     )  # Foreign key linking to users table
     post_id = Column(
         Integer, ForeignKey("posts.id", ondelete="CASCADE"), nullable=False
     )  # Foreign key linking to posts table
     likes = Column(Integer, default=0)  # Like count for comments
     parent_comment_id = Column(
-        Integer, ForeignKey("comments.id"), nullable=True
+        Integer, ForeignKey("comments.id"), nullable=True, index=True
     )  # For threaded comments (replies)
 
     user = relationship("User", back_populates="comments")  # Relationship with users
@@ -192,6 +224,11 @@ class Comment(Base):
         "Comment", remote_side=[id]
     )  # Self-referencing for threaded comments
 
+    # Comments of a post in keyset pagination order, also serves post_id lookups
+    __table_args__ = (
+        Index("ix_comments_post_id_created_at_id", "post_id", "created_at", "id"),
+    )
+
     # __repr__ method to return a string representation of the object
     def __repr__(self):
         return f"<Comment(content={self.content}, user_id={self.user_id})>"
@@ -202,21 +239,74 @@ class Media(Base):
     __tablename__ = "media"
 
     id = Column(Integer, primary_key=True, index=True)  # Media ID
-    file_url = Column(String, nullable=False)  # URL or path to the media file
+    file_url = Column(
+        String, nullable=False, index=True
+    )  # URL or path to the media file, indexed to count media store references
     media_type = Column(
         SQLAlchemyEnum(MediaType)
     )  # Media type (image, video, audio, document)
     post_id = Column(
-        Integer, ForeignKey("posts.id"), nullable=False
+        Integer, ForeignKey("posts.id"), nullable=False, index=True
     )  # Foreign key linking to posts table
+    status = Column(
+        SQLAlchemyEnum(MediaStatus),
+        nullable=False,
+        default=MediaStatus.READY,
+        server_default=MediaStatus.READY.name,
+    )  # Processing status
+    source_url = Column(String, nullable=True)  # Raw upload while processing
+    error = Column(String(255), nullable=True)  # Processing error message
+    variants = Column(
+        JSON, nullable=True
+    )  # Resized copies of an image: name, url, format, width, height
 
     post = relationship("Post", back_populates="media")  # Relationship with posts
 
+    # Responses containing a media still being processed are not cached, its
+    # file URL is replaced once it is READY
+    @property
+    def response_cacheable(self):
+        return self.status == MediaStatus.READY
+
     # __repr__ method to return a string representation of the object
     def __repr__(self):
         return f"<Media(file_url={self.file_url}, media_type={self.media_type})>"
 
 
+# LIKE MODEL
+# One row per user and liked post or comment, the counts live in Post.likes and
+# Comment.likes and are updated in batches by app/like_counters.py
+class Like(Base):
+    __tablename__ = "likes"
+
+    id = Column(Integer, primary_key=True, index=True)  # Like ID
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )  # Foreign key linking to users table
+    post_id = Column(
+        Integer, ForeignKey("posts.id", ondelete="CASCADE"), nullable=True
+    )  # Liked post
+    comment_id = Column(
+        Integer, ForeignKey("comments.id", ondelete="CASCADE"), nullable=True
+    )  # Liked comment
+    created_at = Column(
+        DateTime(timezone=True), server_default=func.now()
+    )  # Created timestamp
+
+    # A user likes a target once, every like has exactly one target
+    __table_args__ = (
+        UniqueConstraint("user_id", "post_id", name="uq_likes_user_id_post_id"),
+        UniqueConstraint("user_id", "comment_id", name="uq_likes_user_id_comment_id"),
+        CheckConstraint(
+            "(post_id IS NULL) <> (comment_id IS NULL)", name="ck_likes_one_target"
+        ),
+    )
+
+    # __repr__ method to return a string representation of the object
+    def __repr__(self):
+        return f"<Like(user_id={self.user_id}, post_id={self.post_id}, comment_id={self.comment_id})>"
+
+
 # Voice room participants association table
 voice_room_participants = Table(
     "voice_room_participants",
@@ -225,6 +315,7 @@ voice_room_participants = Table(
     Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE")),
     Column("is_muted", Boolean, default=False),
     Column("joined_at", DateTime(timezone=True), server_default=func.now()),
+    Index("ix_voice_room_participants_room_id_user_id", "room_id", "user_id"),
 )
 
 class VoiceRoom(Base):
@@ -255,6 +346,11 @@ class VoiceMessage(Base):
     duration = Column(Integer)  # Duration in seconds
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    # Messages of a room in chronological order
+    __table_args__ = (
+        Index("ix_voice_messages_room_id_created_at", "room_id", "created_at"),
+    )
+
     # Relationships
     room = relationship("VoiceRoom", backref="messages")
     user = relationship("User", backref="voice_messages")
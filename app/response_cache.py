@@ -0,0 +1,260 @@
+# app/response_cache.py
+# Cache of GraphQL read responses tagged with the entities they contain
+# Writes through crud.save_to_db invalidate the tags of the saved row
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event, inspect
+
+from app.db_configuration import Base
+from app.metrics import GRAPHQL_RESPONSE_CACHE_REQUESTS
+from app.utils import LRUCache, logger
+
+# Response cache configuration
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 10000))
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL")  # Shared backend
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))  # Max staleness
+
+# Root query fields whose responses may be cached
+CACHEABLE_FIELDS = {"postById", "allMediaByPostId", "userProfile", "roleById"}
+
+# Tags of the rows loaded while executing the current cacheable operation
+_response_tags: ContextVar[set] = ContextVar("response_tags", default=None)
+
+# Tags invalidated while executing the current operation, deleted before its
+# response is sent, see deferring_invalidations
+_deferred_tags: ContextVar[set] = ContextVar("deferred_tags", default=None)
+
+# Tag of a response that must not be cached, see _tag_loaded_row
+UNCACHEABLE_TAG = "uncacheable"
+
+
+# Tag of a single row, e.g. "posts:12"
+def entity_tag(table_name: str, entity_id):
+    return f"{table_name}:{entity_id}"
+
+
+# Tags invalidated by a write: the row itself and every row it references,
+# so a new comment or media invalidates the cached responses of its post
+def write_tags(model):
+    mapper = inspect(model).mapper
+    tags = {entity_tag(mapper.local_table.name, model.id)}
+    for column in mapper.local_table.columns:
+        # Only foreign keys are read, other columns may not be loaded
+        if not column.foreign_keys:
+            continue
+        value = getattr(model, mapper.get_property_by_column(column).key, None)
+        if value is None:
+            continue
+        for foreign_key in column.foreign_keys:
+            tags.add(entity_tag(foreign_key.column.table.name, value))
+    return tags
+
+
+# Add tags to the response being cached, outside of a cacheable operation it is a no-op
+def tag_response(*tags):
+    collected = _response_tags.get()
+    if collected is not None:
+        collected.update(tags)
+
+
+# Every row loaded from the database tags the response being cached
+# Rows whose `response_cacheable` is False make the response uncacheable
+@event.listens_for(Base, "load", propagate=True)
+def _tag_loaded_row(target, context):
+    state = inspect(target)
+    tag_response(entity_tag(state.mapper.local_table.name, state.identity[0]))
+    if not getattr(target, "response_cacheable", True):
+        tag_response(UNCACHEABLE_TAG)
+
+
+# Hit-rate accounting shared by the cache backends
+class ResponseCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        GRAPHQL_RESPONSE_CACHE_REQUESTS.labels("hit" if hit else "miss").inc()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# In-process response cache, entries are dropped on invalidation or after the TTL
+class LocalResponseCache(ResponseCacheStats):
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        super().__init__()
+        self.entries = LRUCache(max_entries=max_entries)  # key -> (expires, data)
+        self.ttl = ttl
+        self.tags = defaultdict(set)  # tag -> keys
+        self.lock = threading.Lock()
+
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.record(False)
+            return None
+        self.record(True)
+        return entry[1]
+
+    async def set(self, key: str, data, tags):
+        self.entries.set(key, (time.monotonic() + self.ttl, data))
+        with self.lock:
+            for tag in tags:
+                self.tags[tag].add(key)
+            # Drop the keys of evicted entries once the index outgrows the cache
+            if len(self.tags) > 4 * self.entries.max_entries:
+                self._prune()
+
+    def _prune(self):
+        for tag in list(self.tags):
+            self.tags[tag] = {key for key in self.tags[tag] if key in self.entries}
+            if not self.tags[tag]:
+                del self.tags[tag]
+
+    def invalidate(self, tags):
+        with self.lock:
+            keys = set().union(*(self.tags.pop(tag, ()) for tag in tags))
+        for key in keys:
+            self.entries.pop(key)
+
+    async def invalidate_async(self, tags):
+        self.invalidate(tags)
+
+    def stats(self):
+        return {**super().stats(), "entries": len(self.entries)}
+
+
+# Response cache shared by every worker through a Redis-compatible server
+# Each tag is a set of the keys it invalidates
+class RedisResponseCache(ResponseCacheStats):
+    def __init__(self, redis_url: str, ttl: int = RESPONSE_CACHE_TTL):
+        import redis.asyncio as redis
+
+        super().__init__()
+        self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.redis_url = redis_url
+        self.sync_redis = None  # Client of the callers without a loop
+        self.ttl = ttl
+        self.tasks = set()  # Pending invalidation tasks
+
+    async def get(self, key: str):
+        try:
+            data = await self.redis.get(f"gqlcache:{key}")
+        except Exception as e:
+            logger.error(f"[{RedisResponseCache.__name__}] Redis get failed: {e}")
+            data = None
+        self.record(data is not None)
+        return None if data is None else json.loads(data)
+
+    async def set(self, key: str, data, tags):
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.set(f"gqlcache:{key}", json.dumps(data), ex=self.ttl)
+                for tag in tags:
+                    pipe.sadd(f"gqlcache:tag:{tag}", key)
+                    pipe.expire(f"gqlcache:tag:{tag}", self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"[{RedisResponseCache.__name__}] Redis set failed: {e}")
+
+    # Invalidate without blocking the caller
+    # Inside deferring_invalidations the tags are deleted before the response is
+    # sent. Outside of an event loop (Celery workers, scripts) they are deleted
+    # synchronously, the web workers share the same Redis keys
+    def invalidate(self, tags):
+        deferred = _deferred_tags.get()
+        if deferred is not None:
+            deferred.update(tags)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._invalidate_sync(tags)
+            return
+        task = loop.create_task(self._invalidate(tags))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def invalidate_async(self, tags):
+        await self._invalidate(tags)
+
+    async def _invalidate(self, tags):
+        try:
+            for tag in tags:
+                keys = await self.redis.smembers(f"gqlcache:tag:{tag}")
+                await self.redis.delete(
+                    f"gqlcache:tag:{tag}", *(f"gqlcache:{key}" for key in keys)
+                )
+        except Exception as e:
+            logger.error(f"[{RedisResponseCache.__name__}] Invalidation failed: {e}")
+
+    def _invalidate_sync(self, tags):
+        try:
+            if self.sync_redis is None:
+                import redis
+
+                self.sync_redis = redis.Redis.from_url(
+                    self.redis_url, decode_responses=True
+                )
+            for tag in tags:
+                keys = self.sync_redis.smembers(f"gqlcache:tag:{tag}")
+                self.sync_redis.delete(
+                    f"gqlcache:tag:{tag}", *(f"gqlcache:{key}" for key in keys)
+                )
+        except Exception as e:
+            logger.error(f"[{RedisResponseCache.__name__}] Invalidation failed: {e}")
+
+
+# Shared response cache used by the GraphQL server and the CRUD layer
+response_cache = (
+    RedisResponseCache(RESPONSE_CACHE_REDIS_URL)
+    if RESPONSE_CACHE_REDIS_URL
+    else LocalResponseCache()
+)
+
+
+# Invalidate the cached responses that contain a saved row
+def invalidate_model(model):
+    response_cache.invalidate(write_tags(model))
+
+
+# Collect the tags of the rows loaded inside the block
+@contextmanager
+def collecting_tags():
+    tags = set()
+    token = _response_tags.set(tags)
+    try:
+        yield tags
+    finally:
+        _response_tags.reset(token)
+
+
+# Delay the invalidations of the writes made inside the block until it exits,
+# then wait for them, so a client reading right after the response never gets
+# an entry the write invalidated
+@asynccontextmanager
+async def deferring_invalidations():
+    tags = set()
+    token = _deferred_tags.set(tags)
+    try:
+        yield
+    finally:
+        _deferred_tags.reset(token)
+        if tags:
+            await response_cache.invalidate_async(tags)
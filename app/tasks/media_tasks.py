@@ -0,0 +1,70 @@
+# app/tasks/media_tasks.py
+# Media processing tasks run by the Celery worker
+# Uploads are stored raw by the API, these tasks transcode them and record the
+# result on the Media row (or the user profile for profile photos)
+from pathlib import Path
+
+from app.celery_worker import celery
+from app.db_configuration import SessionLocal
+import app.crud as crud
+import app.models as models
+from app.models import MediaStatus
+from app.utils import logger
+from app.utils.file_upload import process_media_file
+
+
+# Transcode the raw upload of a Media row
+@celery.task(name="process_media")
+def process_media(media_id: int):
+    with SessionLocal() as db:
+        media = db.get(models.Media, media_id)
+        # Deleted, or already processed by a previous delivery
+        if media is None or media.status == MediaStatus.READY:
+            return
+        media.status = MediaStatus.PROCESSING
+        crud.save_to_db(db, media, refresh=False)
+        try:
+            media.file_url, media.variants = process_media_file(
+                media.source_url, media.media_type.value
+            )
+            media.status = MediaStatus.READY
+            media.source_url = None
+            media.error = None
+        except Exception as e:
+            logger.error(f"[{process_media.name}] Media {media_id} failed: {e}")
+            media.status = MediaStatus.FAILED
+            media.error = str(e)[:255]
+        crud.save_to_db(db, media, refresh=False)
+
+
+# Compress a raw profile photo and point the profile to the result
+@celery.task(name="process_profile_photo")
+def process_profile_photo(profile_id: int, raw_file_path: str):
+    with SessionLocal() as db:
+        profile = db.get(models.UserProfile, profile_id)
+        # Replaced by a photo uploaded after this one, skip transcoding it
+        if profile is None or profile.profile_photo != raw_file_path:
+            Path(raw_file_path).unlink(missing_ok=True)
+            return
+        db.rollback()  # Release the connection while transcoding
+        try:
+            output_file_path, variants = process_media_file(raw_file_path, "image")
+        except Exception as e:
+            logger.error(
+                f"[{process_profile_photo.name}] Profile {profile_id} failed: {e}"
+            )
+            Path(raw_file_path).unlink(missing_ok=True)
+            db.refresh(profile)
+            # Unset the photo, unless a newer upload replaced it meanwhile
+            if profile.profile_photo == raw_file_path:
+                profile.profile_photo = None
+                profile.profile_photo_variants = None
+                crud.save_to_db(db, profile, refresh=False)
+            return
+        db.refresh(profile)
+        if profile.profile_photo != raw_file_path:
+            crud.release_file(db, output_file_path, variants)
+            return
+        profile.profile_photo = output_file_path
+        profile.profile_photo_variants = variants
+        crud.save_to_db(db, profile, refresh=False)
@@ -0,0 +1,56 @@
+# app/user_cache.py
+# Short-lived cache of user rows shared across requests
+# Rows are cached as column values and attached to the requesting session
+# without a query, saved users and profiles evict their user
+import os
+import time
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+
+import app.models as models
+from app.utils import LRUCache
+
+# User cache configuration
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 30))  # Max staleness across workers
+
+_users = LRUCache(max_entries=USER_CACHE_SIZE)  # user_id -> (expires, columns)
+
+
+# Column values of a user row, None when some columns are not loaded
+def _columns(user: models.User):
+    state = inspect(user)
+    keys = [attr.key for attr in state.mapper.column_attrs]
+    if state.unloaded.intersection(keys):
+        return None
+    return {key: state.dict[key] for key in keys}
+
+
+# Get a user by ID, from the cache when possible
+async def get_user(db: AsyncSession, user_id: int):
+    entry = _users.get(user_id)
+    if entry is not None and entry[0] > time.monotonic():
+        user = models.User(**entry[1])
+        make_transient_to_detached(user)
+        # Attach the cached row to the session without loading it
+        return await db.merge(user, load=False)
+
+    user = await db.get(models.User, user_id)
+    columns = _columns(user) if user is not None else None
+    if columns is not None:
+        _users.set(user_id, (time.monotonic() + USER_CACHE_TTL, columns))
+    return user
+
+
+# Evict the user of a saved user or user profile
+def evict_user(model):
+    if isinstance(model, models.User):
+        _users.pop(model.id)
+    elif isinstance(model, models.UserProfile):
+        _users.pop(model.user_id)
+
+
+# Cache statistics
+def stats():
+    return _users.stats()
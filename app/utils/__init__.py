@@ -1,24 +1,48 @@
 # app/utils/__init__.py
-from .password_utils import hash_password, check_password, authenticate_user
-from .jwt_utils import create_access_token, decode_access_token, generate_access_token, check_auth
+from .password_utils import (
+    hash_password,
+    check_password,
+    authenticate_user,
+    hash_password_async,
+    check_password_async,
+    authenticate_user_async,
+)
+from .jwt_utils import (
+    create_access_token,
+    decode_access_token,
+    generate_access_token,
+    check_auth,
+    add_revocation_hook,
+    evict_token,
+    evict_tokens,
+)
 from .image_utils import compress_image, convert_to_webp
 # from .video_utils import compress_video, convert_to_webm
-from .file_upload import handle_file_upload
+from .file_upload import stream_upload, RequestSizeLimitMiddleware
 from .logger import logger
+from .lru_cache import LRUCache
 
 # Export the utilities
 __all__ = [
     "hash_password",
     "check_password",
     "authenticate_user",
+    "hash_password_async",
+    "check_password_async",
+    "authenticate_user_async",
     "create_access_token",
     "decode_access_token",
     "generate_access_token",
     "check_auth",
+    "add_revocation_hook",
+    "evict_token",
+    "evict_tokens",
     "compress_image",
     "convert_to_webp",
     # "compress_video",
     # "convert_to_webm",
-    "handle_file_upload",
+    "stream_upload",
+    "RequestSizeLimitMiddleware",
     "logger",
+    "LRUCache",
 ]
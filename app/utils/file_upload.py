@@ -1,75 +1,209 @@
+import hashlib
 import os
-import shutil
+import time
+import anyio
 from fastapi import HTTPException
 from datetime import datetime
+from pathlib import Path
+from starlette.responses import JSONResponse
 
 from app.utils.video_utils import compress_video, is_ffmpeg_installed
-from app.utils.image_utils import compress_image
-
-
-# Define a function to handle file uploads
-def handle_file_upload(uploaded_file, upload_folder):
-    # Check if the file was uploaded
-    if uploaded_file is None:
-        return None
-
-    # Create an uploads directory if it doesn't exist
-    upload_directory = os.path.join("./uploads", upload_folder)
-    os.makedirs(
-        upload_directory, exist_ok=True
-    )  # Create the directory if it doesn't exist
-    # Create a temp directory to store the uploaded file
-    os.makedirs(os.path.join(upload_directory, "temp"), exist_ok=True)
+from app.utils.image_utils import (
+    IMAGE_VARIANTS,
+    generate_image_variants,
+    image_size,
+)
+from app.utils.media_store import file_sha256, find_artifacts, store_artifacts
+from app.metrics import UPLOAD_PROCESSING_DURATION
+
+# Upload limits, peak memory per upload is bounded by the chunk size
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", 512 * 1024 * 1024))
+UPLOAD_MAX_REQUEST_BYTES = int(
+    os.getenv("UPLOAD_MAX_REQUEST_BYTES", 1024 * 1024 * 1024)
+)
+
+
+# Copy an uploaded file to `destination` in UPLOAD_CHUNK_SIZE chunks with async
+# file I/O, hashing it in the same pass
+# Returns (size, sha256 hex digest), the partial file is removed on errors
+async def stream_upload(uploaded_file, destination, max_bytes: int = None):
+    max_bytes = max_bytes or UPLOAD_MAX_FILE_BYTES
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with await anyio.open_file(destination, "wb") as file:
+            while chunk := await uploaded_file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File is larger than {max_bytes} bytes",
+                    )
+                digest.update(chunk)
+                await file.write(chunk)
+    except BaseException:
+        Path(destination).unlink(missing_ok=True)
+        raise
+    return size, digest.hexdigest()
+
+
+# ASGI middleware rejecting request bodies over UPLOAD_MAX_REQUEST_BYTES
+# The declared Content-Length is checked first, streamed bodies while they arrive
+class RequestSizeLimitMiddleware:
+    def __init__(self, app, max_bytes: int = None):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        max_bytes = self.max_bytes or UPLOAD_MAX_REQUEST_BYTES
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and int(content_length) > max_bytes:
+            response = JSONResponse(
+                {"detail": f"Request body is larger than {max_bytes} bytes"},
+                status_code=413,
+            )
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Request body is larger than {max_bytes} bytes",
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# CPU budget of a node: media files processed at once (the size of the Celery
+# worker's process pool) and the ffmpeg threads of each, so several large posts
+# processed together do not oversubscribe the CPU
+MEDIA_WORKER_CONCURRENCY = int(
+    os.getenv("MEDIA_WORKER_CONCURRENCY", os.cpu_count() or 1)
+)
+VIDEO_THREADS = max(1, (os.cpu_count() or 1) // MEDIA_WORKER_CONCURRENCY)
+
+# Media kinds that can be uploaded, the first part of the content type
+SUPPORTED_MEDIA_KINDS = ("image", "video")
+
+# Processing parameters by media kind, one set per stored file
+# The last file is the one the media row points to
+PROCESSING_PARAMETERS = {
+    "image": IMAGE_VARIANTS,
+    "video": [
+        {
+            "format": "webm",
+            "quality": 35,
+            "speed": 8,
+            "max_width": 1920,
+            "max_height": 1080,
+        }
+    ],
+}
+
+
+# Store an uploaded file unprocessed in uploads/<folder>/raw
+# Returns (file path, content type, variants), variants is None when the file
+# still needs processing: content already in the media store is not kept and
+# its stored file and variants are returned instead
+async def store_upload(uploaded_file, upload_folder):
+    content_type = uploaded_file.content_type or ""
+    media_kind = content_type.split("/")[0]
+    if media_kind not in SUPPORTED_MEDIA_KINDS:
+        raise HTTPException(
+            status_code=400,
+            detail="Unsupported file type. Please upload an image or video.",
+        )
+    raw_directory = os.path.join("./uploads", upload_folder, "raw")
+    os.makedirs(raw_directory, exist_ok=True)
     # Create a unique filename using the current date and time
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    original_filename = uploaded_file.filename
-
-    # Extract the base filename and extension
-    base_filename, extension = os.path.splitext(original_filename)
+    base_filename, extension = os.path.splitext(uploaded_file.filename)
     base_filename = base_filename.split("/")[-1]
-
-    # Define a temporary file path
-    temp_file_path = os.path.join(
-        upload_directory, "temp", f"{timestamp}_{base_filename}"
+    raw_file_path = os.path.join(
+        raw_directory, f"{timestamp}_{base_filename}{extension}"
     )
+    size, sha256 = await stream_upload(uploaded_file, raw_file_path)
+    # Duplicate upload, skip processing
+    paths = find_artifacts(sha256, PROCESSING_PARAMETERS[media_kind])
+    if paths is not None:
+        os.remove(raw_file_path)
+        return paths[-1], content_type, describe_variants(media_kind, paths)
+    return raw_file_path, content_type, None
+
 
-    # Save the uploaded file to the temp directory
-    with open(temp_file_path, "wb") as destination:
-        shutil.copyfileobj(uploaded_file.file, destination)
+# Variants of a processed file as recorded on its row
+# Sizes of files stored before are read from the image headers
+def describe_variants(media_kind: str, paths: list, sizes: list = None):
+    if media_kind != "image":
+        return []
+    sizes = sizes or [image_size(path) for path in paths]
+    return [
+        {
+            "name": parameters["name"],
+            "url": path,
+            "format": parameters["format"],
+            "width": width,
+            "height": height,
+        }
+        for parameters, path, (width, height) in zip(
+            PROCESSING_PARAMETERS[media_kind], paths, sizes
+        )
+    ]
 
-    # Define the output file path based on file type
-    output_file_path = None
 
+# Process a stored file: images to the IMAGE_VARIANTS ladder from one decode,
+# videos to VP9 WebM
+# Returns the (width, height) of the image variants
+def transcode(input_file_path, output_file_paths: list, media_kind: str):
+    start = time.perf_counter()
     try:
         # Check file type to determine processing
-        if uploaded_file.content_type.startswith("image/"):
-            # Define the output file path with the WebP extension
-            output_file_path = os.path.join(
-                upload_directory, f"{timestamp}_{base_filename}.webp"
+        if media_kind == "image":
+            return generate_image_variants(
+                input_file_path, IMAGE_VARIANTS, output_file_paths
             )
-            compress_image(temp_file_path, output_file_path)  # Convert to WebP
-        elif is_ffmpeg_installed() and uploaded_file.content_type.startswith("video/"):
-            output_file_path = os.path.join(
-                upload_directory, f"{timestamp}_{base_filename}.webm"
-            )
-            compress_video(
-                temp_file_path,
-                output_file_path,
-                quality=35,
-                speed=8,
-                max_width=1920,
-                max_height=1080,
-            )  # Compress video
-        else:
-            raise HTTPException(
-                status_code=400,
-                detail="Unsupported file type. Please upload an image or video.",
-            )
-    except Exception as e:
-        print(f"Error processing file: {e}")
-        raise HTTPException(status_code=500, detail="File processing failed.")
-
-    # Remove the temporary file after processing
-    os.remove(temp_file_path)
-    # return output file path and media type
-    return output_file_path, uploaded_file.content_type
+        if not is_ffmpeg_installed():
+            raise RuntimeError("ffmpeg is not installed")
+        parameters = dict(PROCESSING_PARAMETERS[media_kind][0])
+        del parameters["format"]  # Given by the output file extension
+        compress_video(
+            input_file_path, output_file_paths[0], threads=VIDEO_THREADS, **parameters
+        )
+    finally:
+        # Record the processing duration by media type (image, video, ...)
+        UPLOAD_PROCESSING_DURATION.labels(media_kind).observe(
+            time.perf_counter() - start
+        )
+
+
+# Process a stored upload into the media store, content that was processed
+# before is not transcoded again
+# The raw file is removed, returns (file path, variants)
+def process_media_file(raw_file_path, media_kind: str):
+    if media_kind not in SUPPORTED_MEDIA_KINDS:
+        raise ValueError(f"Unsupported media kind {media_kind}")
+    parameter_sets = PROCESSING_PARAMETERS[media_kind]
+    source_sha256 = file_sha256(raw_file_path)
+    paths, sizes = find_artifacts(source_sha256, parameter_sets), None
+    if paths is None:
+        paths, sizes = store_artifacts(
+            source_sha256,
+            parameter_sets,
+            lambda temp_paths: transcode(raw_file_path, temp_paths, media_kind),
+        )
+
+    # Remove the raw file after processing
+    os.remove(raw_file_path)
+    return paths[-1], describe_variants(media_kind, paths, sizes)
+
@@ -1,4 +1,31 @@
-from PIL import Image
+import os
+from PIL import Image, ImageOps
+
+
+# Parse an image variant ladder "name:max side:format:quality,..."
+# A max side of 0 keeps the original size
+def parse_image_variants(ladder: str):
+    variants = []
+    for entry in ladder.split(","):
+        name, max_size, image_format, quality = entry.strip().split(":")
+        variants.append(
+            {
+                "name": name,
+                "max_size": int(max_size),
+                "format": (
+                    "jpeg" if image_format.lower() == "jpg" else image_format.lower()
+                ),
+                "quality": int(quality),
+            }
+        )
+    return variants
+
+
+# Image variants generated from every uploaded image, smallest to largest
+# The last variant is the one stored as the media file URL
+IMAGE_VARIANTS = parse_image_variants(
+    os.getenv("IMAGE_VARIANTS", "thumb:160:webp:70,feed:1080:webp:75,full:0:webp:75")
+)
 
 
 # Function to compress an image using the WebP format
@@ -12,6 +39,52 @@ def compress_image(
     # print(f"Successfully converted {input_image_path} to {output_image_path} with quality={quality}, lossless={lossless}, effort={effort}")
 
 
+# Generate the variants of an image from a single decode
+# JPEGs are decoded at the smallest scale covering every variant (draft), the
+# EXIF orientation is applied and each variant is reduced from the next larger
+# one. Returns the (width, height) of each variant
+def generate_image_variants(input_image_path, variants, output_image_paths, effort=4):
+    max_sizes = [variant["max_size"] for variant in variants]
+    sizes = [None] * len(variants)
+    with Image.open(input_image_path) as img:
+        if img.format == "JPEG" and 0 not in max_sizes:
+            largest = max(max_sizes)
+            img.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(img)
+        # Largest first, 0 (original size) is the largest
+        order = sorted(
+            range(len(variants)),
+            key=lambda i: max_sizes[i] or float("inf"),
+            reverse=True,
+        )
+        for i in order:
+            variant = variants[i]
+            # In place, the larger variants are already saved
+            if variant["max_size"]:
+                image.thumbnail(
+                    (variant["max_size"], variant["max_size"]),
+                    Image.Resampling.LANCZOS,
+                    reducing_gap=3.0,
+                )
+            output = image
+            if variant["format"] == "jpeg" and image.mode not in ("RGB", "L"):
+                output = image.convert("RGB")
+            output.save(
+                output_image_paths[i],
+                variant["format"],
+                quality=variant["quality"],
+                method=effort,
+            )
+            sizes[i] = image.size
+    return sizes
+
+
+# (width, height) of an image, only its header is read
+def image_size(image_path):
+    with Image.open(image_path) as img:
+        return img.size
+
+
 # Function to convert an image to WebP format
 def convert_to_webp(input_path, output_path):
     # Open an image file
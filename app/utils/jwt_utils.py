@@ -1,9 +1,14 @@
+import hashlib
 import os
+import time
 from datetime import datetime, timedelta, timezone
 import jwt
 from dotenv import load_dotenv
 from fastapi import HTTPException
 
+from app.metrics import JWT_CACHE_REQUESTS
+from app.utils.lru_cache import LRUCache
+
 # load environment variables
 load_dotenv(".env")
 
@@ -19,6 +24,15 @@ algorithm = (
 issuer = "serkankorkut.dev"  # Set your app name or domain
 audience = "serkankorkut.dev/users"  # Define the expected audience, e.g., your users
 
+# Claims of verified tokens keyed by a digest of the token
+# Entries are used until the token's own expiry
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+verified_tokens = LRUCache(max_entries=TOKEN_CACHE_SIZE)
+
+# Revocation hooks, called with the claims of every newly verified token
+# A hook returning True rejects the token (e.g. a denylist lookup)
+revocation_hooks = []
+
 
 # Create a JWT access token
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -73,6 +87,44 @@ def generate_access_token(user):
     return access_token
 
 
+# Digest of a token used as cache key, so raw tokens are not kept in memory
+def _token_digest(token: str):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+# Decode a token, reusing the claims of tokens already verified
+def _verify_token(token: str):
+    key = _token_digest(token)
+    token_data = verified_tokens.get(key)
+    if token_data is not None and token_data["exp"] > time.time():
+        JWT_CACHE_REQUESTS.labels("hit").inc()
+        return token_data
+    JWT_CACHE_REQUESTS.labels("miss").inc()
+    token_data = decode_access_token(token)
+    if any(hook(token_data) for hook in revocation_hooks):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    verified_tokens.set(key, token_data)
+    return token_data
+
+
+# Register a revocation hook, see `revocation_hooks`
+def add_revocation_hook(hook):
+    revocation_hooks.append(hook)
+
+
+# Evict a token from the verified token cache
+# Call it once a revocation hook rejects the token, cached tokens skip the hooks
+def evict_token(token: str):
+    verified_tokens.pop(_token_digest(token))
+
+
+# Evict every cached token whose claims match, e.g. all tokens of a user
+def evict_tokens(predicate):
+    for key, token_data in verified_tokens.items():
+        if predicate(token_data):
+            verified_tokens.pop(key)
+
+
 # Check the authorization header
 def check_auth(authorization: str):
     # Ensure the Authorization header is present
@@ -82,7 +134,7 @@ def check_auth(authorization: str):
     # Extract and decode the JWT token
     try:
         token = authorization.split(" ")[1]  # 'Bearer <token>'
-        token_data = decode_access_token(token)
+        token_data = _verify_token(token)
     # Handle common JWT errors
     except (IndexError, AttributeError):
         raise HTTPException(status_code=401, detail="Invalid Authorization format")
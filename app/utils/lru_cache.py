@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+
+# Thread-safe LRU cache bounded by entry count and (optionally) total bytes
+class LRUCache:
+    def __init__(self, max_entries: int = 1024, max_bytes: int = None):
+        self.max_entries = max_entries  # Maximum number of entries
+        self.max_bytes = max_bytes  # Maximum total size of the entries (optional)
+        self.hits = 0  # Number of successful lookups
+        self.misses = 0  # Number of failed lookups
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    # Get a value and mark it as recently used
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # Set a value, evicting the least recently used entries if needed
+    def set(self, key, value, size: int = 0):
+        # Values bigger than the whole cache are never stored
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    # Remove a value if present
+    def pop(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    # Remove all values
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # Snapshot of the (key, value) pairs, least recently used first
+    def items(self):
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    # Cache statistics
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._bytes -= entry[1]
+        return entry[0]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
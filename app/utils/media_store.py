@@ -0,0 +1,99 @@
+# app/utils/media_store.py
+# Content-addressed store of processed media
+# An artifact is keyed by the sha256 of its source bytes and the processing
+# parameters and sharded as <root>/<key[:2]>/<key[2:4]>/<key>.<ext>, so the same
+# upload is transcoded once and shared by every row referencing it
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+from app.metrics import MEDIA_STORE_REQUESTS
+
+# Media store configuration
+MEDIA_STORE_ROOT = os.getenv("MEDIA_STORE_ROOT", "./uploads/store")
+# Unreferenced artifacts used this recently are kept, an upload of the same
+# content may be about to reference them
+MEDIA_STORE_GRACE_SECONDS = int(os.getenv("MEDIA_STORE_GRACE_SECONDS", 60))
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+# sha256 hex digest of a file, read in chunks
+def file_sha256(file_path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        while chunk := file.read(_HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Key of the artifact made from a source with a set of processing parameters
+def artifact_key(source_sha256: str, parameters: dict) -> str:
+    parameters = json.dumps(parameters, sort_keys=True)
+    return hashlib.sha256(f"{source_sha256}:{parameters}".encode()).hexdigest()
+
+
+# Sharded path of the artifact made from a source, the file extension is the
+# "format" parameter
+def artifact_path(source_sha256: str, parameters: dict) -> str:
+    key = artifact_key(source_sha256, parameters)
+    return os.path.join(
+        MEDIA_STORE_ROOT, key[:2], key[2:4], f"{key}.{parameters['format']}"
+    )
+
+
+# Stored artifacts of a source, one per parameter set
+# Returns None when any of them was not processed yet
+def find_artifacts(source_sha256: str, parameter_sets: list):
+    paths = []
+    for parameters in parameter_sets:
+        path = artifact_path(source_sha256, parameters)
+        try:
+            os.utime(path)  # Mark it as used, see release()
+        except FileNotFoundError:
+            MEDIA_STORE_REQUESTS.labels("miss").inc()
+            return None
+        paths.append(path)
+    MEDIA_STORE_REQUESTS.labels("hit").inc()
+    return paths
+
+
+# Store the artifacts of a source, one per parameter set
+# `write(paths)` creates them under temporary names that are renamed in place,
+# so readers never see a partial file
+# Returns (artifact paths, result of write)
+def store_artifacts(source_sha256: str, parameter_sets: list, write):
+    paths = [artifact_path(source_sha256, p) for p in parameter_sets]
+    # Same extension, the encoders pick the format from it
+    temp_paths = [
+        os.path.join(os.path.dirname(path), f".{os.getpid()}_{os.path.basename(path)}")
+        for path in paths
+    ]
+    try:
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        result = write(temp_paths)
+        for temp_path, path in zip(temp_paths, paths):
+            os.replace(temp_path, path)
+    except BaseException:
+        for temp_path in temp_paths:
+            Path(temp_path).unlink(missing_ok=True)
+        raise
+    return paths, result
+
+
+# Remove an artifact the caller found unreferenced
+# Files outside of the store and artifacts used within MEDIA_STORE_GRACE_SECONDS
+# are kept, returns True when the file was removed
+def release(file_url: str):
+    if Path(MEDIA_STORE_ROOT).resolve() not in Path(file_url).resolve().parents:
+        return False
+    try:
+        if time.time() - os.stat(file_url).st_mtime < MEDIA_STORE_GRACE_SECONDS:
+            return False
+        os.remove(file_url)
+    except FileNotFoundError:
+        return False
+    return True
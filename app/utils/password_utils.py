@@ -1,13 +1,32 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 import bcrypt
 from fastapi import HTTPException
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import app.models as models
+from app.metrics import PASSWORD_POOL_PENDING, PASSWORD_POOL_REJECTIONS
+
+# bcrypt cost factor, existing hashes with another cost are rehashed on login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# Threads hashing passwords, bcrypt releases the GIL while hashing
+PASSWORD_POOL_SIZE = int(os.getenv("PASSWORD_POOL_SIZE", os.cpu_count() or 2))
+# Password operations waiting or running before new ones are rejected
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", 64))
+
+# Dedicated pool so password work never runs on the event loop thread
+_password_pool = ThreadPoolExecutor(
+    max_workers=PASSWORD_POOL_SIZE, thread_name_prefix="password"
+)
+_pending = 0  # Only changed from the event loop thread
 
 
 # Function to hash a password
 def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt(rounds=12)
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode("utf-8"), salt)
     return hashed.decode("utf-8")
 
@@ -19,6 +38,47 @@ def check_password(entered_password: str, stored_hashed_password: str) -> bool:
     )
 
 
+# Check if a hash was made with another cost factor than BCRYPT_ROUNDS
+def needs_rehash(stored_hashed_password: str) -> bool:
+    try:
+        return int(stored_hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+# Run a password function in the password pool
+# Rejects the call when too many password operations are already queued
+async def _run_in_password_pool(function, *args):
+    global _pending
+    if _pending >= PASSWORD_QUEUE_LIMIT:
+        PASSWORD_POOL_REJECTIONS.inc()
+        raise HTTPException(
+            status_code=503, detail="Server busy, please try again later"
+        )
+    _pending += 1
+    PASSWORD_POOL_PENDING.inc()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_pool, function, *args)
+    finally:
+        _pending -= 1
+        PASSWORD_POOL_PENDING.dec()
+
+
+# Hash a password without blocking the event loop
+async def hash_password_async(password: str) -> str:
+    return await _run_in_password_pool(hash_password, password)
+
+
+# Verify a password without blocking the event loop
+async def check_password_async(
+    entered_password: str, stored_hashed_password: str
+) -> bool:
+    return await _run_in_password_pool(
+        check_password, entered_password, stored_hashed_password
+    )
+
+
 # Authenticate user
 def authenticate_user(db: Session, username: str, password: str):
     user = db.query(models.User).filter(models.User.username == username).first()
@@ -26,3 +86,18 @@ def authenticate_user(db: Session, username: str, password: str):
     if user and check_password(password, user.hashed_password):
         return user
     raise HTTPException(status_code=401, detail="Incorrect username or password")
+
+
+# Authenticate user from an async session, hashing in the password pool
+# Hashes made with an outdated cost are replaced, the caller saves the user
+async def authenticate_user_async(db: AsyncSession, username: str, password: str):
+    result = await db.execute(
+        select(models.User).where(models.User.username == username)
+    )
+    user = result.scalars().first()
+    # Check if user exists and password is correct
+    if user and await check_password_async(password, user.hashed_password):
+        if needs_rehash(user.hashed_password):
+            user.hashed_password = await hash_password_async(password)
+        return user
+    raise HTTPException(status_code=401, detail="Incorrect username or password")
@@ -33,6 +33,7 @@ def compress_video(
     speed=5,
     max_width=1920,
     max_height=1080,
+    threads=0,
 ):
     """
     Compresses a video using ffmpeg with the specified quality and preset.
@@ -44,6 +45,7 @@ def compress_video(
     -The speed option takes values from 0 (slowest, best quality) to 8 (fastest, lower quality). A value of 2 to 5 is often a good balance.
     - max_width: The maximum width for the output video.
     - max_height: The maximum height for the output video.
+    - threads: Encoder threads, 0 lets ffmpeg use every core.
     """
     probe = ffmpeg.probe(input_video_path)
     video_stream = next(
@@ -80,6 +82,7 @@ def compress_video(
         # preset=preset,
         speed=speed,
         s=f"{new_width}x{new_height}",  # Set the output resolution
+        threads=threads,
     ).run()
 
     # print(
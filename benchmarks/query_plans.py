@@ -0,0 +1,212 @@
+# benchmarks/query_plans.py
+# Query plans and timings of the list queries without and with the indexes of
+# migration 5b8d2f4c9e1a, on a seeded database
+#
+# Usage: python -m benchmarks.query_plans [--url URL] [--posts N] [--comments N]
+# The default URL is a throwaway SQLite file, a PostgreSQL URL must point to an
+# empty scratch database since the tables are created and dropped
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.orm import sessionmaker
+
+os.environ.setdefault("IS_TEST", "true")
+
+import app.crud as crud  # noqa: E402
+import app.models as models  # noqa: E402
+from app.db_configuration import Base  # noqa: E402
+
+# Indexes added by the migration, dropped for the "before" run
+INDEXES = {
+    index.name: index
+    for table in Base.metadata.sorted_tables
+    for index in table.indexes
+    if index.name
+    in {
+        "ix_posts_created_at_id",
+        "ix_posts_user_id",
+        "ix_comments_post_id_created_at_id",
+        "ix_comments_parent_comment_id",
+        "ix_media_post_id",
+    }
+}
+
+
+# Seed users, posts, comments (a third of them replies) and media
+def seed(engine, users: int, posts: int, comments: int, media: int):
+    start = datetime(2024, 1, 1)
+    random.seed(42)
+    with engine.begin() as connection:
+        connection.execute(insert(models.Role), [{"id": 1, "name": "user"}])
+        connection.execute(
+            insert(models.User),
+            [
+                {
+                    "id": i,
+                    "username": f"user{i}",
+                    "email": f"user{i}@example.com",
+                    "hashed_password": "x",
+                    "role_id": 1,
+                    "created_at": start + timedelta(minutes=i),
+                }
+                for i in range(1, users + 1)
+            ],
+        )
+        connection.execute(
+            insert(models.Post),
+            [
+                {
+                    "id": i,
+                    "content": f"Post {i}",
+                    "user_id": random.randint(1, users),
+                    "created_at": start + timedelta(seconds=i),
+                }
+                for i in range(1, posts + 1)
+            ],
+        )
+        rows = []
+        for i in range(1, comments + 1):
+            parent = rows[random.randrange(len(rows))] if rows and i % 3 == 0 else None
+            rows.append(
+                {
+                    "id": i,
+                    "content": f"Comment {i}",
+                    "user_id": random.randint(1, users),
+                    "post_id": (
+                        parent["post_id"] if parent else random.randint(1, posts)
+                    ),
+                    "parent_comment_id": parent["id"] if parent else None,
+                    "created_at": start + timedelta(seconds=i),
+                }
+            )
+        connection.execute(insert(models.Comment), rows)
+        connection.execute(
+            insert(models.Media),
+            [
+                {
+                    "id": i,
+                    "file_url": f"media/{i}.webp",
+                    "post_id": random.randint(1, posts),
+                }
+                for i in range(1, media + 1)
+            ],
+        )
+
+
+# Statements run by a crud function, with their parameters
+def capture(engine, function):
+    statements = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", collect)
+    try:
+        function()
+    finally:
+        event.remove(engine, "before_cursor_execute", collect)
+    return statements
+
+
+# Query plan of a statement in the dialect's EXPLAIN form
+def explain(engine, statement, parameters):
+    if engine.dialect.name == "sqlite":
+        prefix, column = "EXPLAIN QUERY PLAN ", -1
+    else:
+        prefix, column = "EXPLAIN (ANALYZE, COSTS OFF, TIMING OFF) ", 0
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(prefix + statement, parameters).fetchall()
+    return [str(row[column]) for row in rows]
+
+
+# Median duration of a function in milliseconds
+def median_ms(function, repeat: int):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def run(engine, session_factory, posts: int, repeat: int):
+    post_id = posts // 2
+    cases = {
+        "find_all_posts": lambda db: crud.find_all_posts(db, 20),
+        "find_all_comments_by_post_id": lambda db: crud.find_all_comments_by_post_id(
+            db, post_id, 20
+        ),
+        "count_all_comments_by_post_id": lambda db: crud.count_all_comments_by_post_id(
+            db, post_id
+        ),
+        "find_comment_thread": lambda db: crud.find_comment_thread(db, post_id, 3, 10),
+        "find_all_media_by_post_id": lambda db: crud.find_all_media_by_post_id(
+            db, post_id
+        ),
+    }
+    results = {}
+    for name, case in cases.items():
+        with session_factory() as db:
+            statement, parameters = capture(engine, lambda: case(db))[-1]
+            plan = explain(engine, statement, parameters)
+            duration = median_ms(lambda: case(db), repeat)
+        results[name] = (duration, plan)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query plans before and after indexing"
+    )
+    parser.add_argument("--url", help="Scratch database URL (default: temp SQLite)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--comments", type=int, default=200000)
+    parser.add_argument("--media", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    url = args.url or f"sqlite:///{directory.name}/query_plans.db"
+    engine = create_engine(url)
+    session_factory = sessionmaker(bind=engine)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    try:
+        seed(engine, args.users, args.posts, args.comments, args.media)
+
+        for index in INDEXES.values():
+            index.drop(engine)
+        with engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE")
+        before = run(engine, session_factory, args.posts, args.repeat)
+
+        for index in INDEXES.values():
+            index.create(engine)
+        with engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE")
+        after = run(engine, session_factory, args.posts, args.repeat)
+
+        print(f"{engine.dialect.name}: {args.posts} posts, {args.comments} comments")
+        for name in before:
+            (before_ms, before_plan), (after_ms, after_plan) = before[name], after[name]
+            print(f"\n{name}: {before_ms:.2f} ms -> {after_ms:.2f} ms")
+            print("  before:")
+            for line in before_plan:
+                print(f"    {line}")
+            print("  after:")
+            for line in after_plan:
+                print(f"    {line}")
+    finally:
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+        directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
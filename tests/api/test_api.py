@@ -33,3 +33,169 @@ def test_create_upload_file_api(client):
 #     response = client.post('/api/users/', json={"name": "Test User"})
 #     assert response.status_code == 201
 #     assert response.json()["name"] == "Test User"
+
+
+# Metrics API test
+def test_metrics_api(client):
+    # Run a named GraphQL operation to record metrics for it
+    response = client.post(
+        "/graphql/", json={"query": "query MetricsRoles { allRoles { id } }"}
+    )
+    assert response.status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "text/plain" in response.headers["content-type"]
+    assert (
+        'graphql_request_duration_seconds_count{operation_name="MetricsRoles",operation_type="query"} 1.0'
+        in response.text
+    )
+    assert (
+        'graphql_sql_queries_count{operation_name="MetricsRoles",operation_type="query"} 1.0'
+        in response.text
+    )
+    assert (
+        'graphql_db_checkouts_sum{operation_name="MetricsRoles",operation_type="query"} 1.0'
+        in response.text
+    )
+    # The request session returned its connection when the request ended
+    assert "db_pool_checked_out_connections 0.0" in response.text
+
+
+# Operation name labels are bounded and truncated
+def test_operation_label_bounded(monkeypatch):
+    from app import metrics
+
+    monkeypatch.setattr(metrics, "_operation_labels", set())
+    monkeypatch.setattr(metrics, "METRICS_MAX_OPERATIONS", 2)
+    assert metrics.operation_label(None) == "anonymous"
+    assert metrics.operation_label("First") == "First"
+    assert metrics.operation_label("x" * 100) == "x" * 64
+    assert metrics.operation_label("Third") == "other"
+    assert metrics.operation_label("First") == "First"
+
+
+# Password hashes with an outdated cost are detected for rehashing
+def test_password_needs_rehash():
+    import bcrypt
+    from app.utils.password_utils import BCRYPT_ROUNDS, hash_password, needs_rehash
+
+    outdated = bcrypt.hashpw(b"secret", bcrypt.gensalt(rounds=4)).decode("utf-8")
+    assert needs_rehash(outdated) is (BCRYPT_ROUNDS != 4)
+    assert needs_rehash(hash_password("secret")) is False
+
+
+# Password operations over the queue limit are rejected
+def test_password_pool_rejects_over_limit(monkeypatch):
+    import asyncio
+    from fastapi import HTTPException
+    from app.utils import password_utils
+
+    monkeypatch.setattr(password_utils, "PASSWORD_QUEUE_LIMIT", 0)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(password_utils.hash_password_async("secret"))
+    assert error.value.status_code == 503
+
+
+# Verified tokens are served from the cache until evicted
+def test_check_auth_token_cache():
+    from fastapi import HTTPException
+    from app.utils import jwt_utils
+
+    token = jwt_utils.create_access_token({"username": "cached"})
+    authorization = f"Bearer {token}"
+    hits = jwt_utils.verified_tokens.hits
+    assert jwt_utils.check_auth(authorization)["username"] == "cached"
+    assert jwt_utils.check_auth(authorization)["username"] == "cached"
+    assert jwt_utils.verified_tokens.hits == hits + 1
+
+    # Revoked tokens are rejected once evicted from the cache
+    revoke = lambda token_data: token_data["username"] == "cached"
+    jwt_utils.add_revocation_hook(revoke)
+    try:
+        jwt_utils.evict_tokens(revoke)
+        with pytest.raises(HTTPException) as error:
+            jwt_utils.check_auth(authorization)
+        assert error.value.status_code == 401
+    finally:
+        jwt_utils.revocation_hooks.remove(revoke)
+
+
+# Database health API test
+def test_database_health_api(client):
+    response = client.get("/health/db")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ok"
+    assert set(response.json()["pools"]) == {"sync", "async"}
+    assert "status" in response.json()["pools"]["async"]
+
+
+# Pool stats report connection counts and checkout wait percentiles
+def test_pool_stats_queue_pool():
+    from sqlalchemy import create_engine
+    from app.db_configuration import InstrumentedQueuePool, pool_stats
+
+    engine = create_engine(
+        "sqlite://", poolclass=InstrumentedQueuePool, pool_size=2, max_overflow=1
+    )
+    connections = [engine.connect() for _ in range(3)]
+    stats = pool_stats(engine)
+    assert stats["checked_out"] == 3
+    assert stats["overflow"] == 1
+    assert stats["wait_p99_ms"] >= 0
+    for connection in connections:
+        connection.close()
+    stats = pool_stats(engine)
+    assert stats["checked_out"] == 0
+    assert stats["idle"] == 2
+    engine.dispose()
+
+
+# Streaming upload API test, the file is hashed while it is written
+def test_upload_file_streaming(client, monkeypatch):
+    import hashlib
+    from app.utils import file_upload
+
+    content = b"0123456789" * 1000
+    monkeypatch.setattr(file_upload, "UPLOAD_CHUNK_SIZE", 1024)
+    files = {"file": ("stream.bin", content, "application/octet-stream")}
+    response = client.post("/uploadfile/", files=files)
+    assert response.status_code == 200
+    assert response.json()["size"] == len(content)
+    assert response.json()["sha256"] == hashlib.sha256(content).hexdigest()
+    uploaded = Path(response.json()["filepath"])
+    assert uploaded.read_bytes() == content
+    uploaded.unlink()
+
+
+# Uploads over the per-file limit are rejected and not kept
+def test_upload_file_too_large(client, monkeypatch):
+    from app.utils import file_upload
+
+    monkeypatch.setattr(file_upload, "UPLOAD_MAX_FILE_BYTES", 1000)
+    files = {"file": ("large.bin", b"x" * 1001, "application/octet-stream")}
+    response = client.post("/uploadfile/", files=files)
+    assert response.status_code == 413
+    assert not Path("uploads/large.bin").exists()
+
+
+# Request bodies over the per-request limit are rejected
+def test_request_too_large(client, monkeypatch):
+    from app.utils import file_upload
+
+    monkeypatch.setattr(file_upload, "UPLOAD_MAX_REQUEST_BYTES", 1000)
+    files = {"file": ("large.bin", b"x" * 2000, "application/octet-stream")}
+    response = client.post("/uploadfile/", files=files)
+    assert response.status_code == 413
+
+    # Bodies without a Content-Length are counted while they stream in
+    def body():
+        yield b"x" * 600
+        yield b"x" * 600
+
+    response = client.post(
+        "/uploadfile/",
+        content=body(),
+        headers={"Content-Type": "multipart/form-data; boundary=xyz"},
+    )
+    assert response.status_code == 413
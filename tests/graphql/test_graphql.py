@@ -2,6 +2,7 @@ from pathlib import Path
 import pytest
 import os
 import json
+import hashlib
 import mimetypes
 import logging
 
@@ -354,10 +355,8 @@ class TestUserProfile:
         )
         assert response.json()["data"]["userProfile"]["bio"] == USER_PROFILE.bio
         if USER_PROFILE.profile_photo is not None:
-            # Check if the profile photo exists
+            # Check if the profile photo exists, identical photos share the file
             assert Path(response.json()["data"]["userProfile"]["profilePhoto"]).exists()
-            # Optionally delete the file after the test
-            os.remove(response.json()["data"]["userProfile"]["profilePhoto"])
 
 
 # Test File Upload
@@ -613,3 +612,1338 @@ class TestCreateComment:
         assert response.status_code == 200
         comment_data = response.json()["data"]["commentById"]
         assert comment_data["content"] == COMMENT.content
+
+
+# Test batched relationship loading
+@pytest.mark.usefixtures("client")
+class TestRelationshipBatching:
+
+    # Test that nested relationships are loaded with one query per relationship
+    def test_query_all_posts_relationships(self, client):
+        from sqlalchemy import event
+        from app.db_configuration import async_engine
+
+        statements = []
+
+        def count_selects(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append(statement)
+
+        query = """
+        query {
+            allPosts {
+                edges {
+                    node {
+                        id,
+                        user { username },
+                        comments { content, user { username } },
+                        media { fileUrl }
+                    }
+                }
+            }
+        }
+        """
+        event.listen(async_engine.sync_engine, "before_cursor_execute", count_selects)
+        try:
+            response = client.post("/graphql/", json={"query": query})
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", count_selects)
+        # Check the response
+        assert response.status_code == 200
+        posts = [e["node"] for e in response.json()["data"]["allPosts"]["edges"]]
+        assert len(posts) >= 2
+        post_1 = next(post for post in posts if int(post["id"]) == POST_1.id)
+        assert post_1["user"]["username"] == USER_1.username
+        assert len(post_1["media"]) == len(POST_1.medias)
+        assert COMMENT_1.content in [c["content"] for c in post_1["comments"]]
+        # posts + users + comments + media
+        assert len(statements) <= 4
+
+
+    # Test lists without `first` return at most DEFAULT_LIST_SIZE rows per parent
+    def test_relationship_lists_bounded(self, client, monkeypatch):
+        import app.graphql.loaders as loaders
+
+        for content in ("Bounded 1", "Bounded 2"):
+            mutation = f"""
+            mutation {{
+                createComment(postId: {POST_2.id}, content: "{content}") {{ ok }}
+            }}
+            """
+            client.post(
+                "/graphql/",
+                json={"query": mutation},
+                headers={"Authorization": f"Bearer {USER_1.access_token}"},
+            )
+        monkeypatch.setattr(loaders, "DEFAULT_LIST_SIZE", 1)
+        query = f"""
+        query {{
+            postById(postId: {POST_2.id}) {{ comments {{ id }} }}
+            allPosts {{ edges {{ node {{ id, comments {{ id }} }} }} }}
+        }}
+        """
+        response = client.post("/graphql/", json={"query": query})
+        data = response.json()["data"]
+        assert len(data["postById"]["comments"]) == 1
+        for edge in data["allPosts"]["edges"]:
+            assert len(edge["node"]["comments"]) <= 1
+
+
+# Test keyset pagination
+@pytest.mark.usefixtures("client")
+class TestPagination:
+
+    # Test walking all posts one page at a time
+    def test_paginate_all_posts(self, client):
+        query = """
+        query($after: String) {
+            allPosts(first: 1, after: $after) {
+                edges { cursor, node { id } }
+                pageInfo { hasNextPage, endCursor }
+                totalCount
+            }
+        }
+        """
+        seen = []
+        after = None
+        while True:
+            response = client.post(
+                "/graphql/", json={"query": query, "variables": {"after": after}}
+            )
+            assert response.status_code == 200
+            page = response.json()["data"]["allPosts"]
+            assert len(page["edges"]) <= 1
+            seen += [int(edge["node"]["id"]) for edge in page["edges"]]
+            if not page["pageInfo"]["hasNextPage"]:
+                break
+            after = page["pageInfo"]["endCursor"]
+        # Every post is returned exactly once, newest first
+        assert len(seen) == len(set(seen)) == page["totalCount"]
+        assert seen.index(POST_2.id) < seen.index(POST_1.id)
+
+    # Test comments by post id are returned oldest first
+    def test_paginate_comments_by_post_id(self, client):
+        query = f"""
+        query {{
+            allCommentsByPostId(postId: {POST_1.id}, first: 10) {{
+                edges {{ node {{ id }} }}
+                pageInfo {{ hasNextPage }}
+            }}
+        }}
+        """
+        response = client.post("/graphql/", json={"query": query})
+        assert response.status_code == 200
+        page = response.json()["data"]["allCommentsByPostId"]
+        ids = [int(edge["node"]["id"]) for edge in page["edges"]]
+        assert ids == [COMMENT_1.id, REPLY_1.id]
+        assert page["pageInfo"]["hasNextPage"] is False
+
+    # Test rows sharing a created_at are paged by id without gaps, whether the
+    # timestamp was stored by the server default or by SQLAlchemy
+    def test_paginate_duplicate_created_at(self, client):
+        from datetime import datetime
+        from sqlalchemy import text
+        import app.crud as crud
+        import app.models as models
+        from app.db_configuration import SessionLocal
+
+        created_at = datetime(2020, 1, 1, 0, 1)
+        with SessionLocal() as db:
+            posts = [
+                models.Post(content=f"Same time {i}", user_id=USER_1.id)
+                for i in range(4)
+            ]
+            for post in posts:
+                post.created_at = created_at
+            db.add_all(posts)
+            db.commit()
+            ids = sorted(post.id for post in posts)
+            # Server default form, without fractional seconds
+            db.execute(
+                text("UPDATE posts SET created_at = :value WHERE id IN (:a, :b)"),
+                {"value": "2020-01-01 00:01:00", "a": ids[0], "b": ids[2]},
+            )
+            db.commit()
+
+            seen = []
+            after = (created_at, ids[-1] + 1)
+            while page := crud.find_all_posts(db, 1, after):
+                seen.append(page[0].id)
+                after = (created_at, page[0].id)
+            assert seen == ids[::-1]
+
+            for post in posts:
+                db.delete(post)
+            db.commit()
+
+    # Test an invalid cursor is rejected
+    def test_invalid_cursor(self, client):
+        query = """
+        query {
+            allUsers(after: "not-a-cursor") { edges { node { id } } }
+        }
+        """
+        response = client.post("/graphql/", json={"query": query})
+        assert response.status_code == 200
+        assert response.json()["errors"]
+
+
+# Test the parsed document cache
+@pytest.mark.usefixtures("client")
+class TestDocumentCache:
+
+    # Test that repeated queries are served from the document cache
+    def test_repeated_query_hits_cache(self, client):
+        query = "query { allRoles { id, name } }"
+        client.post("/graphql/", json={"query": query})
+        before = client.get("/stats/graphql").json()["document_cache"]
+        response = client.post("/graphql/", json={"query": query})
+        after = client.get("/stats/graphql").json()["document_cache"]
+        assert response.status_code == 200
+        assert len(response.json()["data"]["allRoles"]) >= 2
+        assert after["hits"] == before["hits"] + 1
+        assert after["misses"] == before["misses"]
+
+    # Test the byte budget is charged by the size of the parsed document
+    def test_document_size(self, client):
+        from app.graphql import schema
+        from app.graphql.server import DOCUMENT_NODE_BYTES, DocumentCache
+
+        query = "query { allRoles { id, name } }"
+        cache = DocumentCache(max_bytes=1024 * 1024)
+        _, errors = cache.get_document(schema.graphql_schema, query)
+        assert errors == []
+        # Document, operation, 2 selection sets and 3 fields with their names
+        assert cache.stats()["bytes"] == 10 * DOCUMENT_NODE_BYTES
+
+        # Documents bigger than the budget are parsed but never cached
+        small = DocumentCache(max_bytes=len(query) * 4)
+        assert small.get_document(schema.graphql_schema, query)[1] == []
+        assert small.stats()["entries"] == 0
+
+    # Test that invalid queries still return validation errors
+    def test_invalid_query(self, client):
+        response = client.post("/graphql/", json={"query": "query { unknownField }"})
+        assert response.status_code == 200
+        assert response.json()["errors"]
+
+
+# Test automatic persisted queries
+@pytest.mark.usefixtures("client")
+class TestPersistedQueries:
+    query = "query { allRoles { name } }"
+    extensions = {
+        "persistedQuery": {
+            "version": 1,
+            "sha256Hash": hashlib.sha256(query.encode("utf-8")).hexdigest(),
+        }
+    }
+
+    # Test the register-on-miss flow over POST
+    def test_persisted_query_post(self, client):
+        # Unknown hash
+        response = client.post(
+            "/graphql/", json={"query": None, "extensions": self.extensions}
+        )
+        assert response.status_code == 200
+        error = response.json()["errors"][0]
+        assert error["extensions"]["code"] == "PERSISTED_QUERY_NOT_FOUND"
+        # Register the query with its hash
+        response = client.post(
+            "/graphql/", json={"query": self.query, "extensions": self.extensions}
+        )
+        assert response.status_code == 200
+        assert response.json()["data"]["allRoles"]
+        # Hash only
+        response = client.post("/graphql/", json={"extensions": self.extensions})
+        assert response.status_code == 200
+        assert response.json()["data"]["allRoles"]
+
+    # Test hashed queries over GET
+    def test_persisted_query_get(self, client):
+        response = client.get(
+            "/graphql/", params={"extensions": json.dumps(self.extensions)}
+        )
+        assert response.status_code == 200
+        assert response.json()["data"]["allRoles"]
+
+    # Test a query that does not match its hash is rejected
+    def test_persisted_query_hash_mismatch(self, client):
+        response = client.post(
+            "/graphql/",
+            json={"query": "query { allRoles { id } }", "extensions": self.extensions},
+        )
+        assert response.status_code == 200
+        error = response.json()["errors"][0]
+        assert error["extensions"]["code"] == "INVALID_PERSISTED_QUERY"
+
+    # Test mutations are not allowed over GET
+    def test_get_mutation_rejected(self, client):
+        mutation = 'mutation { createRole(name: "get") { ok } }'
+        response = client.get("/graphql/", params={"query": mutation})
+        assert response.status_code == 200
+        assert response.json()["data"] is None
+        assert response.json()["errors"]
+
+
+# Test query cost and depth limits
+@pytest.mark.usefixtures("client")
+class TestQueryCost:
+
+    # Test the computed cost is returned in the extensions
+    def test_cost_in_extensions(self, client):
+        query = """
+        query {
+            allPosts(first: 5) { edges { node { id, media { fileUrl } } } }
+        }
+        """
+        response = client.post("/graphql/", json={"query": query})
+        assert response.status_code == 200
+        cost = response.json()["extensions"]["cost"]
+        # allPosts + 5 * (edges + node + media), leaf fields are free
+        assert cost["cost"] == 1 + 5 * (1 + 1 + 1)
+        assert cost["depth"] == 5
+
+    # Cost reported for a query
+    def cost(self, client, query):
+        response = client.post("/graphql/", json={"query": query})
+        assert response.status_code == 200
+        return response.json()["extensions"]["cost"]["cost"]
+
+    # Test paged fields without `first` cost their default page size
+    def test_default_page_size(self, client):
+        from app.graphql.pagination import DEFAULT_PAGE_SIZE
+
+        selection = "{ edges { node { id, media { fileUrl } } } }"
+        assert self.cost(client, "query { allPosts %s }" % selection) == self.cost(
+            client, "query { allPosts(first: %d) %s }" % (DEFAULT_PAGE_SIZE, selection)
+        )
+
+    # Test comment thread replies are charged by the thread's `first`
+    def test_comment_thread_replies(self, client):
+        query = """
+        query {
+            commentThread(postId: 1, first: 2) {
+                comment { id }
+                replies { comment { id } }
+            }
+        }
+        """
+        # commentThread + 2 * (comment + replies + 2 * comment)
+        assert self.cost(client, query) == 1 + 2 * (1 + 1 + 2 * 1)
+
+    # Test recursive queries over the depth limit are rejected
+    def test_depth_limit(self, client):
+        query = "query { commentById(commentId: 1) { %s id %s } }" % (
+            "replies { " * 12,
+            "} " * 12,
+        )
+        response = client.post("/graphql/", json={"query": query})
+        assert response.status_code == 200
+        assert response.json()["data"] is None
+        error = response.json()["errors"][0]
+        assert error["extensions"]["code"] == "QUERY_TOO_COMPLEX"
+
+    # Test wide list queries over the cost limit are rejected
+    def test_cost_limit(self, client):
+        query = """
+        query($first: Int) {
+            allUsers(first: $first) {
+                edges { node { posts { comments { replies { user { username } } } } } }
+            }
+        }
+        """
+        response = client.post(
+            "/graphql/", json={"query": query, "variables": {"first": 100}}
+        )
+        assert response.status_code == 200
+        assert response.json()["data"] is None
+        error = response.json()["errors"][0]
+        assert error["extensions"]["code"] == "QUERY_TOO_COMPLEX"
+        assert error["extensions"]["cost"]["cost"] > error["extensions"]["cost"]["maxCost"]
+
+
+# Test selection-aware column projection
+@pytest.mark.usefixtures("client")
+class TestColumnProjection:
+
+    # Test unselected text columns are not loaded
+    def test_unselected_content_not_loaded(self, client):
+        from sqlalchemy import event
+        from app.db_configuration import async_engine
+
+        statements = []
+
+        def collect(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        query = "query { allPosts { edges { node { id, createdAt } } } }"
+        event.listen(async_engine.sync_engine, "before_cursor_execute", collect)
+        try:
+            response = client.post("/graphql/", json={"query": query})
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", collect)
+        assert response.status_code == 200
+        assert response.json()["data"]["allPosts"]["edges"]
+        assert len(statements) == 1
+        assert "posts.content" not in statements[0]
+
+    # Test selected text columns are still returned
+    def test_selected_content_loaded(self, client):
+        query = f"""
+        query {{
+            postById(postId: {POST_1.id}) {{ content, user {{ username }} }}
+        }}
+        """
+        response = client.post("/graphql/", json={"query": query})
+        assert response.status_code == 200
+        post = response.json()["data"]["postById"]
+        assert post["content"] == POST_1.content
+        assert post["user"]["username"] == USER_1.username
+
+
+# Test GraphQL subscriptions over graphql-transport-ws
+@pytest.mark.usefixtures("client")
+class TestSubscriptions:
+
+    # Test a new comment is pushed to subscribers of its post
+    def test_comment_created(self, client):
+        subscription = f"""
+        subscription {{
+            commentCreated(postId: {POST_1.id}) {{ content, user {{ username }} }}
+        }}
+        """
+        mutation = f"""
+        mutation {{
+            createComment(postId: {POST_1.id}, content: "Live comment") {{ ok }}
+        }}
+        """
+        with client.websocket_connect(
+            "/graphql/", subprotocols=["graphql-transport-ws"]
+        ) as websocket:
+            websocket.send_json({"type": "connection_init"})
+            assert websocket.receive_json() == {"type": "connection_ack"}
+            websocket.send_json(
+                {"id": "1", "type": "subscribe", "payload": {"query": subscription}}
+            )
+            websocket.send_json({"type": "ping"})
+            # The pong confirms the subscription was registered
+            assert websocket.receive_json() == {"type": "pong"}
+
+            response = client.post(
+                "/graphql/",
+                json={"query": mutation},
+                headers={"Authorization": f"Bearer {USER_1.access_token}"},
+            )
+            assert response.json()["data"]["createComment"]["ok"] is True
+
+            message = websocket.receive_json()
+            assert message["type"] == "next"
+            assert message["id"] == "1"
+            comment = message["payload"]["data"]["commentCreated"]
+            assert comment["content"] == "Live comment"
+            assert comment["user"]["username"] == USER_1.username
+
+            websocket.send_json({"id": "1", "type": "complete"})
+
+    # Test subscribing before the connection is acknowledged is refused
+    def test_subscribe_before_init(self, client):
+        from starlette.websockets import WebSocketDisconnect
+
+        with client.websocket_connect(
+            "/graphql/", subprotocols=["graphql-transport-ws"]
+        ) as websocket:
+            websocket.send_json(
+                {"id": "1", "type": "subscribe", "payload": {"query": "{ __typename }"}}
+            )
+            with pytest.raises(WebSocketDisconnect) as error:
+                websocket.receive_json()
+            assert error.value.code == 4401
+
+    # Test the legacy graphql-ws protocol is refused, it would skip the limits
+    def test_legacy_protocol_refused(self, client):
+        from starlette.websockets import WebSocketDisconnect
+
+        # Over the cost limit over HTTP
+        query = """
+        query {
+            allUsers(first: 100) {
+                edges { node { posts { comments { replies { user { username } } } } } }
+            }
+        }
+        """
+        with client.websocket_connect(
+            "/graphql/", subprotocols=["graphql-ws"]
+        ) as websocket:
+            websocket.send_json({"type": "connection_init"})
+            websocket.send_json({"id": "1", "type": "start", "payload": {"query": query}})
+            with pytest.raises(WebSocketDisconnect) as error:
+                websocket.receive_json()
+            assert error.value.code == 4406
+
+    # Test subscriptions are refused over HTTP
+    def test_subscription_over_http(self, client):
+        query = "subscription { postCreated { id } }"
+        response = client.post("/graphql/", json={"query": query})
+        assert response.status_code == 200
+        assert "WebSocket" in response.json()["errors"][0]["message"]
+
+
+# Test the response cache of public read queries
+@pytest.mark.usefixtures("client")
+class TestResponseCache:
+
+    def count_statements(self, client, query, headers=None):
+        from sqlalchemy import event
+        from app.db_configuration import async_engine
+
+        statements = []
+
+        def collect(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", collect)
+        try:
+            response = client.post("/graphql/", json={"query": query}, headers=headers)
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", collect)
+        assert response.status_code == 200
+        return response.json(), len(statements)
+
+    # Test a repeated query is answered without touching the database
+    def test_repeated_query_cached(self, client):
+        query = f"""
+        query {{ postById(postId: {POST_2.id}) {{ content, user {{ username }} }} }}
+        """
+        first, _ = self.count_statements(client, query)
+        # Formatting differences share the normalized document
+        second, statements = self.count_statements(client, " ".join(query.split()))
+        assert second["data"] == first["data"]
+        assert statements == 0
+        stats = client.get("/stats/graphql").json()["response_cache"]
+        assert stats["hits"] >= 1
+
+    # Test a new comment invalidates the cached responses of its post
+    def test_invalidated_on_write(self, client):
+        query = f"""
+        query {{ postById(postId: {POST_2.id}) {{ comments {{ content }} }} }}
+        """
+        before, _ = self.count_statements(client, query)
+        mutation = f"""
+        mutation {{
+            createComment(postId: {POST_2.id}, content: "Cache buster") {{ ok }}
+        }}
+        """
+        response = client.post(
+            "/graphql/",
+            json={"query": mutation},
+            headers={"Authorization": f"Bearer {USER_1.access_token}"},
+        )
+        assert response.json()["data"]["createComment"]["ok"] is True
+        after, statements = self.count_statements(client, query)
+        assert statements > 0
+        contents = [c["content"] for c in after["data"]["postById"]["comments"]]
+        assert len(contents) == len(before["data"]["postById"]["comments"]) + 1
+        assert "Cache buster" in contents
+
+    # Test the shared cache entries of a write are deleted before its response
+    def test_invalidated_before_response(self, client, monkeypatch):
+        import asyncio
+        import app.response_cache as response_cache
+
+        class RecordingRedis:
+            def __init__(self):
+                self.deleted = []
+
+            async def smembers(self, name):
+                return {"cached"}
+
+            async def delete(self, *names):
+                await asyncio.sleep(0.05)  # Slower than sending the response
+                self.deleted.extend(names)
+
+        cache = response_cache.RedisResponseCache("redis://localhost:6379/0")
+        cache.redis = RecordingRedis()
+        monkeypatch.setattr(response_cache, "response_cache", cache)
+        mutation = f"""
+        mutation {{
+            createComment(postId: {POST_2.id}, content: "Ordered") {{ ok }}
+        }}
+        """
+        response = client.post(
+            "/graphql/",
+            json={"query": mutation},
+            headers={"Authorization": f"Bearer {USER_1.access_token}"},
+        )
+        assert response.json()["data"]["createComment"]["ok"] is True
+        assert f"gqlcache:tag:posts:{POST_2.id}" in cache.redis.deleted
+        assert "gqlcache:cached" in cache.redis.deleted
+
+    # Test queries outside the cacheable fields are always executed
+    def test_uncacheable_query(self, client):
+        query = "query { allRoles { name } }"
+        self.count_statements(client, query)
+        _, statements = self.count_statements(client, query)
+        assert statements > 0
+
+
+# Test the commentThread query
+@pytest.mark.usefixtures("client")
+class TestCommentThread:
+
+    def query_thread(self, client, arguments):
+        from sqlalchemy import event
+        from app.db_configuration import async_engine
+
+        query = f"""
+        query {{
+            commentThread({arguments}) {{
+                comment {{ id, content }}
+                depth
+                replyCount
+                replies {{
+                    comment {{ id, content }}
+                    depth
+                    replyCount
+                    replies {{ comment {{ id }} }}
+                }}
+            }}
+        }}
+        """
+        statements = []
+
+        def collect(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", collect)
+        try:
+            response = client.post("/graphql/", json={"query": query})
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", collect)
+        assert response.status_code == 200
+        response_data = response.json()
+        assert "errors" not in response_data
+        return response_data["data"]["commentThread"], len(statements)
+
+    # Test the whole tree is loaded with a single statement
+    def test_thread(self, client):
+        mutation = f"""
+        mutation {{
+            createReply(commentId: {REPLY_1.id}, content: "Nested reply") {{ ok }}
+        }}
+        """
+        response = client.post(
+            "/graphql/",
+            json={"query": mutation},
+            headers={"Authorization": f"Bearer {USER_1.access_token}"},
+        )
+        assert response.json()["data"]["createReply"]["ok"] is True
+
+        thread, statements = self.query_thread(client, f"postId: {POST_1.id}")
+        assert statements == 1
+        comment = thread[0]
+        assert comment["comment"]["content"] == COMMENT_1.content
+        assert comment["depth"] == 1
+        assert comment["replyCount"] == 1
+        reply = comment["replies"][0]
+        assert reply["comment"]["content"] == REPLY_1.content
+        assert reply["depth"] == 2
+        assert reply["replyCount"] == 1
+        assert len(reply["replies"]) == 1
+
+    # Test replies below maxDepth are counted but not loaded
+    def test_max_depth(self, client):
+        thread, _ = self.query_thread(client, f"postId: {POST_1.id}, maxDepth: 2")
+        reply = thread[0]["replies"][0]
+        assert reply["replyCount"] == 1
+        assert reply["replies"] == []
+
+    # Test each parent is limited to its oldest `first` comments
+    def test_first(self, client):
+        thread, _ = self.query_thread(client, f"postId: {POST_1.id}, first: 1")
+        assert len(thread) == 1
+        assert int(thread[0]["comment"]["id"]) == COMMENT_1.id
+
+    # Test a wide and deep thread keeps `first` replies per parent at each level
+    def test_wide_deep_thread(self, client):
+        import app.models as models
+        from app.db_configuration import SessionLocal
+
+        with SessionLocal() as db:
+            post = models.Post(content="Wide thread", user_id=USER_1.id)
+            db.add(post)
+            db.flush()
+            parents = [None]
+            for _ in range(4):
+                level = []
+                for parent in parents:
+                    for i in range(4):
+                        comment = models.Comment(
+                            content=f"Reply {i}",
+                            user_id=USER_1.id,
+                            post_id=post.id,
+                            parent_comment_id=parent,
+                        )
+                        db.add(comment)
+                        db.flush()
+                        level.append(comment.id)
+                parents = level
+            db.commit()
+            post_id = post.id
+
+        thread, statements = self.query_thread(
+            client, f"postId: {post_id}, first: 2, maxDepth: 3"
+        )
+        assert statements == 1
+        assert len(thread) == 2
+        for node in thread:
+            assert node["replyCount"] == 4
+            assert [r["comment"]["content"] for r in node["replies"]] == [
+                "Reply 0",
+                "Reply 1",
+            ]
+            for reply in node["replies"]:
+                assert reply["replyCount"] == 4
+                assert len(reply["replies"]) == 2
+
+    # Test a deep branch can be loaded from its parent comment
+    def test_parent_comment(self, client):
+        thread, _ = self.query_thread(
+            client, f"postId: {POST_1.id}, parentCommentId: {REPLY_1.id}"
+        )
+        assert [node["comment"]["content"] for node in thread] == ["Nested reply"]
+        assert thread[0]["depth"] == 1
+
+
+# Test the viewer is resolved from the token user_id through the user cache
+@pytest.mark.usefixtures("client")
+class TestViewer:
+
+    def create_comment(self, client, content):
+        from sqlalchemy import event
+        from app.db_configuration import async_engine
+
+        statements = []
+
+        def collect(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        mutation = f"""
+        mutation {{
+            createComment(postId: {POST_2.id}, content: "{content}") {{ ok }}
+        }}
+        """
+        event.listen(async_engine.sync_engine, "before_cursor_execute", collect)
+        try:
+            response = client.post(
+                "/graphql/",
+                json={"query": mutation},
+                headers={"Authorization": f"Bearer {USER_2.access_token}"},
+            )
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", collect)
+        assert response.json()["data"]["createComment"]["ok"] is True
+        return [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+    # Test repeated mutations do not look the user up again
+    def test_cached_viewer(self, client):
+        self.create_comment(client, "Viewer comment 1")
+        selects = self.create_comment(client, "Viewer comment 2")
+        assert not any("FROM users" in select for select in selects)
+
+    # Test saving the user evicts it from the cache
+    def test_evicted_on_save(self, client):
+        from app import user_cache
+
+        self.create_comment(client, "Viewer comment 3")
+        assert USER_2.id in user_cache._users
+        # Login saves the user's last_login
+        mutation = f"""
+        mutation {{
+            login(username: "{USER_2.username}", password: "{USER_2.password}") {{ ok }}
+        }}
+        """
+        response = client.post("/graphql/", json={"query": mutation})
+        assert response.json()["data"]["login"]["ok"] is True
+        assert USER_2.id not in user_cache._users
+
+
+# Test Read Replica Routing
+@pytest.mark.usefixtures("client")
+class TestReplicaRouting:
+
+    @pytest.fixture
+    def replica(self, monkeypatch):
+        from sqlalchemy import event
+        from sqlalchemy.ext.asyncio import create_async_engine
+        import app.db_configuration as db_configuration
+
+        # A second engine on the test database stands in for a replica
+        engine = create_async_engine(
+            db_configuration.async_database_url(db_configuration.TEST_DATABASE_URL)
+        )
+        statements = []
+
+        def collect(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine.sync_engine, "before_cursor_execute", collect)
+        monkeypatch.setattr(
+            db_configuration, "replicas", db_configuration.ReplicaSet([engine])
+        )
+        yield statements
+        event.remove(engine.sync_engine, "before_cursor_execute", collect)
+
+    def query_roles(self, client, headers=None):
+        response = client.post(
+            "/graphql/", json={"query": "{ allRoles { id } }"}, headers=headers
+        )
+        assert response.json()["data"]["allRoles"]
+
+    # Test queries read from the replica
+    def test_query_uses_replica(self, client, replica):
+        self.query_roles(client)
+        assert any("FROM roles" in statement for statement in replica)
+
+    # Test mutations write to the primary and the writer then reads from it
+    def test_read_your_writes(self, client, replica):
+        headers = {"Authorization": f"Bearer {USER_2.access_token}"}
+        mutation = f"""
+        mutation {{
+            createComment(postId: {POST_2.id}, content: "Replica comment") {{ ok }}
+        }}
+        """
+        response = client.post("/graphql/", json={"query": mutation}, headers=headers)
+        assert response.json()["data"]["createComment"]["ok"] is True
+        assert replica == []
+
+        self.query_roles(client, headers=headers)
+        assert replica == []
+        # Other viewers keep reading from the replica
+        self.query_roles(client)
+        assert any("FROM roles" in statement for statement in replica)
+
+    # Test a write recorded by one worker keeps the viewer on the primary in
+    # the other workers sharing the Redis backend
+    def test_read_your_writes_across_workers(self):
+        import asyncio
+        import app.db_configuration as db_configuration
+
+        class SharedRedis:
+            def __init__(self):
+                self.keys = {}
+
+            async def set(self, name, value, px=None):
+                self.keys[name] = value
+
+            async def exists(self, name):
+                return int(name in self.keys)
+
+        shared = SharedRedis()
+        workers = [db_configuration.RecentWriters(sticky_seconds=5) for _ in range(2)]
+        for worker in workers:
+            worker.redis = shared
+        asyncio.run(workers[0].record(USER_2.id))
+        assert workers[0].local and not workers[1].local
+        assert asyncio.run(workers[1].wrote_recently(USER_2.id)) is True
+        assert asyncio.run(workers[1].wrote_recently(USER_1.id)) is False
+
+    # Test cacheable queries read from the primary, so a lagging replica never
+    # fills the shared response cache with stale rows
+    def test_cacheable_query_uses_primary(self, client, replica):
+        # The alias keeps the document out of the cache of earlier tests
+        query = "{ primaryRole: roleById(roleId: %d) { id name } }" % ROLE_1.id
+        response = client.post("/graphql/", json={"query": query})
+        assert response.json()["data"]["primaryRole"]["name"] == ROLE_1.name
+        assert replica == []
+
+    # Test unhealthy replicas are skipped
+    def test_unhealthy_replica(self, client, replica):
+        import asyncio
+        from sqlalchemy.ext.asyncio import create_async_engine
+        import app.db_configuration as db_configuration
+
+        engine = create_async_engine("sqlite+aiosqlite:////nonexistent/replica.db")
+        replicas = db_configuration.ReplicaSet([engine])
+        asyncio.run(replicas.check())
+        assert replicas.healthy == []
+        assert replicas.choose() is None
+        asyncio.run(engine.dispose())
+
+
+# Test Likes
+@pytest.mark.usefixtures("client")
+class TestLikes:
+
+    def like(self, client, field, argument, row_id, user):
+        mutation = f"""
+        mutation {{
+            {field}({argument}: {row_id}) {{ ok likes }}
+        }}
+        """
+        response = client.post(
+            "/graphql/",
+            json={"query": mutation},
+            headers={"Authorization": f"Bearer {user.access_token}"},
+        )
+        return response.json()["data"][field]
+
+    def stored_likes(self, model, row_id):
+        from app.db_configuration import SessionLocal
+
+        with SessionLocal() as db:
+            return db.get(model, row_id).likes or 0
+
+    # Test likes are counted once per user and written in one flush
+    def test_like_post(self, client):
+        import app.like_counters as like_counters
+        import app.models as models
+
+        client.portal.call(like_counters.flush)
+        stored = self.stored_likes(models.Post, POST_1.id)
+        first = self.like(client, "likePost", "postId", POST_1.id, USER_1)
+        assert first == {"ok": True, "likes": stored + 1}
+        # Liking again has no effect
+        again = self.like(client, "likePost", "postId", POST_1.id, USER_1)
+        assert again["likes"] == stored + 1
+        second = self.like(client, "likePost", "postId", POST_1.id, USER_2)
+        assert second["likes"] == stored + 2
+
+        # Reads include the likes not written yet
+        query = f"query {{ postById(postId: {POST_1.id}) {{ likes }} }}"
+        response = client.post("/graphql/", json={"query": query})
+        assert response.json()["data"]["postById"]["likes"] == stored + 2
+
+        client.portal.call(like_counters.flush)
+        assert self.stored_likes(models.Post, POST_1.id) == stored + 2
+        response = client.post("/graphql/", json={"query": query})
+        assert response.json()["data"]["postById"]["likes"] == stored + 2
+
+    # Test liking a comment
+    def test_like_comment(self, client):
+        import app.like_counters as like_counters
+        import app.models as models
+
+        client.portal.call(like_counters.flush)
+        stored = self.stored_likes(models.Comment, COMMENT_1.id)
+        liked = self.like(client, "likeComment", "commentId", COMMENT_1.id, USER_2)
+        assert liked == {"ok": True, "likes": stored + 1}
+        client.portal.call(like_counters.flush)
+        assert self.stored_likes(models.Comment, COMMENT_1.id) == stored + 1
+
+    # Test reads keep counting the likes while the flush writes them
+    def test_flush_keeps_deltas_until_commit(self, client):
+        from sqlalchemy import event
+        import app.like_counters as like_counters
+        import app.models as models
+        from app.db_configuration import async_engine
+
+        client.portal.call(like_counters.flush)
+        stored = self.stored_likes(models.Post, POST_2.id)
+        self.like(client, "likePost", "postId", POST_2.id, USER_1)
+        seen = []
+
+        def during_update(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().upper().startswith("UPDATE"):
+                seen.append(like_counters.count(models.Post, POST_2.id, stored))
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", during_update)
+        try:
+            client.portal.call(like_counters.flush)
+        finally:
+            event.remove(
+                async_engine.sync_engine, "before_cursor_execute", during_update
+            )
+        assert seen == [stored + 1]
+        assert self.stored_likes(models.Post, POST_2.id) == stored + 1
+        assert like_counters.count(models.Post, POST_2.id, stored + 1) == stored + 1
+
+    # Test liking a missing post
+    def test_like_missing_post(self, client):
+        mutation = "mutation { likePost(postId: 999999) { ok likes } }"
+        response = client.post(
+            "/graphql/",
+            json={"query": mutation},
+            headers={"Authorization": f"Bearer {USER_1.access_token}"},
+        )
+        assert response.json()["data"]["likePost"] is None
+        assert "Post not found" in response.json()["errors"][0]["message"]
+
+
+# Test the post and media unit of work
+@pytest.mark.usefixtures("client")
+class TestPostUnitOfWork:
+
+    # Test the post and its media are saved with one commit and one media INSERT
+    def test_single_commit(self, client):
+        from sqlalchemy import event
+        import app.crud as crud
+        import app.models as models
+        from app.db_configuration import SessionLocal, engine
+
+        statements, commits = [], []
+
+        def collect(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        def commit(conn):
+            commits.append(conn)
+
+        event.listen(engine, "before_cursor_execute", collect)
+        event.listen(engine, "commit", commit)
+        try:
+            with SessionLocal() as db:
+                post = models.Post(content="Unit of work", user_id=USER_1.id)
+                media = [
+                    {
+                        "file_url": f"uploads/posts/{i}.webp",
+                        "media_type": models.MediaType.IMAGE,
+                    }
+                    for i in range(3)
+                ]
+                post_id = crud.save_post_with_media(db, post, media)
+        finally:
+            event.remove(engine, "before_cursor_execute", collect)
+            event.remove(engine, "commit", commit)
+        assert len(commits) == 1
+        assert len([s for s in statements if s.startswith("INSERT INTO media")]) == 1
+
+        with SessionLocal() as db:
+            rows = db.query(models.Media).filter(models.Media.post_id == post_id).all()
+            assert len(rows) == 3
+            for row in rows:
+                db.delete(row)
+            db.delete(db.get(models.Post, post_id))
+            db.commit()
+
+    # Test a failing media row leaves no post behind
+    def test_rollback(self, client):
+        import app.crud as crud
+        import app.models as models
+        from app.db_configuration import SessionLocal
+
+        with SessionLocal() as db:
+            before = db.query(models.Post).count()
+            post = models.Post(content="Rolled back", user_id=USER_1.id)
+            with pytest.raises(Exception):
+                crud.save_post_with_media(db, post, [{"file_url": None}])
+        with SessionLocal() as db:
+            assert db.query(models.Post).count() == before
+
+
+# Test Media Processing Status
+@pytest.mark.usefixtures("client")
+class TestMediaStatus:
+
+    def media_status(self, client, post_id):
+        query = f"""
+        query {{
+            mediaStatus(postId: {post_id}) {{
+                total pending ready failed done
+                media {{ id status fileUrl error }}
+            }}
+        }}
+        """
+        response = client.post("/graphql/", json={"query": query})
+        return response.json()["data"]["mediaStatus"]
+
+    # Execute a query, returns (data, number of SQL statements it ran)
+    def execute_counted(self, client, query):
+        from sqlalchemy import event
+        from app.db_configuration import async_engine
+
+        statements = []
+
+        def collect(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", collect)
+        try:
+            response = client.post("/graphql/", json={"query": query})
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", collect)
+        return response.json()["data"], len(statements)
+
+    # Test the uploaded media of a post were processed (tasks run eagerly in tests)
+    def test_processed(self, client):
+        status = self.media_status(client, POST_1.id)
+        assert status["total"] == len(POST_1.medias)
+        assert status["ready"] == status["total"]
+        assert status["done"] is True
+        for media in status["media"]:
+            assert media["status"] == "READY"
+            assert media["fileUrl"].endswith(".webp")
+
+    # Create a post with images, returns the post ID
+    def create_post(self, client, *image_paths):
+        count = len(image_paths)
+        operations = json.dumps(
+            {
+                "query": """
+                mutation($mediaFiles: [Upload]) {
+                    createPost(content: "Pending media", mediaFiles: $mediaFiles) {
+                        ok postId
+                    }
+                }
+                """,
+                "variables": {"mediaFiles": [None] * count},
+            }
+        )
+        map_data = {str(i): [f"variables.mediaFiles.{i}"] for i in range(count)}
+        files = {"operations": (None, operations), "map": (None, json.dumps(map_data))}
+        for i, image_path in enumerate(image_paths):
+            files[str(i)] = ("pending.jpeg", open(image_path, "rb"), "image/jpeg")
+        try:
+            response = client.post(
+                "/graphql/",
+                files=files,
+                headers={"Authorization": f"Bearer {USER_1.access_token}"},
+            )
+        finally:
+            for i in range(count):
+                files[str(i)][1].close()
+        return response.json()["data"]["createPost"]["postId"]
+
+    # Image no other test uploads
+    def unique_image(self, tmp_path, size=(64, 64), orientation=1):
+        from PIL import Image
+
+        image_path = tmp_path / f"unique_{size[0]}x{size[1]}.jpeg"
+        color = tuple(int.from_bytes(os.urandom(1), "big") for _ in range(3))
+        image = Image.new("RGB", size, color)
+        exif = image.getexif()
+        exif[0x0112] = orientation  # EXIF Orientation
+        image.save(image_path, "jpeg", exif=exif)
+        return image_path
+
+    # Test media stay pending until the worker processes them
+    def test_pending_until_processed(self, client, monkeypatch, tmp_path):
+        from app.tasks import media_tasks
+
+        queued = []
+        monkeypatch.setattr(media_tasks.process_media, "delay", queued.append)
+        post_id = self.create_post(client, self.unique_image(tmp_path))
+        status = self.media_status(client, post_id)
+        assert status["pending"] == 1
+        assert status["done"] is False
+        assert status["media"][0]["status"] == "PENDING"
+        raw_file = Path(status["media"][0]["fileUrl"])
+        assert raw_file.exists()
+
+        # The worker transcodes the raw upload and records the result
+        assert queued == [int(status["media"][0]["id"])]
+        media_tasks.process_media(queued[0])
+        status = self.media_status(client, post_id)
+        assert status["ready"] == 1
+        assert status["done"] is True
+        assert status["media"][0]["fileUrl"].endswith(".webp")
+        assert not raw_file.exists()
+
+    # Test responses containing pending media are not cached
+    def test_pending_not_cached(self, client, monkeypatch, tmp_path):
+        from app.tasks import media_tasks
+
+        queued = []
+        monkeypatch.setattr(media_tasks.process_media, "delay", queued.append)
+        post_id = self.create_post(client, self.unique_image(tmp_path))
+        query = f"query {{ allMediaByPostId(postId: {post_id}) {{ status fileUrl }} }}"
+        for _ in range(2):
+            data, statements = self.execute_counted(client, query)
+            assert data["allMediaByPostId"][0]["status"] == "PENDING"
+            assert statements > 0
+        media_tasks.process_media(queued[0])
+        data, _ = self.execute_counted(client, query)
+        assert data["allMediaByPostId"][0]["status"] == "READY"
+
+    # Test profiles whose photo is still being processed are not cached
+    def test_pending_profile_photo_not_cached(self, client, monkeypatch, tmp_path):
+        from app.tasks import media_tasks
+
+        queued = []
+
+        def delay(*args):
+            queued.append(args)
+
+        monkeypatch.setattr(media_tasks.process_profile_photo, "delay", delay)
+        operations = json.dumps(
+            {
+                "query": """
+                mutation($profilePhoto: Upload) {
+                    updateUserProfile(profilePhoto: $profilePhoto) { ok }
+                }
+                """,
+                "variables": {"profilePhoto": None},
+            }
+        )
+        map_data = json.dumps({"0": ["variables.profilePhoto"]})
+        with open(self.unique_image(tmp_path), "rb") as image:
+            response = client.post(
+                "/graphql/",
+                files={
+                    "operations": (None, operations),
+                    "map": (None, map_data),
+                    "0": ("pending.jpeg", image, "image/jpeg"),
+                },
+                headers={"Authorization": f"Bearer {USER_1.access_token}"},
+            )
+        assert response.json()["data"]["updateUserProfile"]["ok"] is True
+
+        query = f"query {{ userProfile(userId: {USER_1.id}) {{ profilePhoto }} }}"
+        for _ in range(2):
+            data, statements = self.execute_counted(client, query)
+            assert "/raw/" in data["userProfile"]["profilePhoto"]
+            assert statements > 0
+        media_tasks.process_profile_photo(*queued[0])
+        data, _ = self.execute_counted(client, query)
+        assert Path(data["userProfile"]["profilePhoto"]).exists()
+
+    # Test a worker outside of an event loop invalidates the shared Redis cache
+    def test_worker_invalidates_redis(self, client, monkeypatch, tmp_path):
+        import app.response_cache as response_cache
+        from app.tasks import media_tasks
+
+        queued = []
+        monkeypatch.setattr(media_tasks.process_media, "delay", queued.append)
+        post_id = self.create_post(client, self.unique_image(tmp_path))
+
+        class RecordingRedis:
+            def __init__(self):
+                self.deleted = []
+
+            def smembers(self, name):
+                return {"cached"}
+
+            def delete(self, *names):
+                self.deleted.extend(names)
+
+        cache = response_cache.RedisResponseCache("redis://localhost:6379/0")
+        cache.sync_redis = RecordingRedis()
+        monkeypatch.setattr(response_cache, "response_cache", cache)
+        media_tasks.process_media(queued[0])
+        assert f"gqlcache:tag:posts:{post_id}" in cache.sync_redis.deleted
+        assert "gqlcache:cached" in cache.sync_redis.deleted
+
+    # Test a profile photo that cannot be processed is unset
+    def test_profile_photo_failed(self, client, tmp_path):
+        import app.models as models
+        from app.db_configuration import SessionLocal
+        from app.tasks import media_tasks
+
+        raw_file = tmp_path / "broken.jpeg"
+        raw_file.write_bytes(b"not an image")
+        with SessionLocal() as db:
+            profile = db.query(models.UserProfile).first()
+            previous = profile.profile_photo, profile.profile_photo_variants
+            profile.profile_photo = str(raw_file)
+            db.commit()
+            try:
+                media_tasks.process_profile_photo(profile.id, str(raw_file))
+                db.refresh(profile)
+                assert profile.profile_photo is None
+                assert profile.profile_photo_variants is None
+                assert not raw_file.exists()
+            finally:
+                profile.profile_photo, profile.profile_photo_variants = previous
+                db.commit()
+
+    # Test a duplicate upload reuses the stored artifact without processing
+    def test_duplicate_upload(self, client, monkeypatch, tmp_path):
+        from app.tasks import media_tasks
+
+        queued = []
+        monkeypatch.setattr(media_tasks.process_media, "delay", queued.append)
+        image_path = self.unique_image(tmp_path)
+        first_post_id = self.create_post(client, image_path)
+        media_tasks.process_media(queued.pop())
+        artifact = self.media_status(client, first_post_id)["media"][0]["fileUrl"]
+        assert "/store/" in artifact
+
+        status = self.media_status(client, self.create_post(client, image_path))
+        assert status["done"] is True
+        assert status["media"][0]["status"] == "READY"
+        assert status["media"][0]["fileUrl"] == artifact
+        assert queued == []
+        assert list(Path("uploads/posts/raw").glob("*_pending.jpeg")) == []
+
+    # Test an artifact is only removed once no row references it
+    def test_release_file(self, client, monkeypatch, tmp_path):
+        import app.crud as crud
+        import app.models as models
+        from app.db_configuration import SessionLocal
+        from app.utils import media_store
+
+        monkeypatch.setattr(media_store, "MEDIA_STORE_GRACE_SECONDS", 0)
+        (artifact,), _ = media_store.store_artifacts(
+            "0" * 64,
+            [{"format": "webp"}],
+            lambda paths: Path(paths[0]).write_bytes(b"x"),
+        )
+        with SessionLocal() as db:
+            media = models.Media(
+                file_url=artifact, media_type=models.MediaType.IMAGE, post_id=POST_1.id
+            )
+            crud.save_to_db(db, media)
+            assert crud.count_file_references(db, artifact) == 1
+            assert crud.release_file(db, artifact) is False
+            assert Path(artifact).exists()
+
+            db.delete(media)
+            db.commit()
+            assert crud.count_file_references(db, artifact) == 0
+            assert crud.release_file(db, artifact) is True
+            assert not Path(artifact).exists()
+
+    # Test an image gets the IMAGE_VARIANTS ladder, upright and within each size
+    def test_variants(self, client, tmp_path):
+        from app.utils.image_utils import IMAGE_VARIANTS
+
+        # Stored landscape, displayed portrait (rotated 90 degrees)
+        image_path = self.unique_image(tmp_path, size=(2400, 1200), orientation=6)
+        query = f"""
+        query {{
+            mediaStatus(postId: {self.create_post(client, image_path)}) {{
+                media {{
+                    fileUrl
+                    variants {{ name url format width height }}
+                }}
+            }}
+        }}
+        """
+        response = client.post("/graphql/", json={"query": query})
+        media = response.json()["data"]["mediaStatus"]["media"][0]
+        variants = media["variants"]
+        assert [v["name"] for v in variants] == [v["name"] for v in IMAGE_VARIANTS]
+        assert variants[-1]["url"] == media["fileUrl"]
+        for variant, parameters in zip(variants, IMAGE_VARIANTS):
+            assert variant["height"] > variant["width"]
+            if parameters["max_size"]:
+                assert variant["height"] <= parameters["max_size"]
+            else:
+                assert (variant["width"], variant["height"]) == (1200, 2400)
+            assert Path(variant["url"]).exists()
+
+    # Test the files of a post are stored together and kept in upload order
+    def test_multiple_files_in_order(self, client, monkeypatch, tmp_path):
+        from app.tasks import media_tasks
+
+        queued = []
+        monkeypatch.setattr(media_tasks.process_media, "delay", queued.append)
+        widths = [96, 64, 128]
+        post_id = self.create_post(
+            client, *[self.unique_image(tmp_path, size=(w, w)) for w in widths]
+        )
+        assert len(queued) == len(widths)
+        for media_id in queued:
+            media_tasks.process_media(media_id)
+        query = f"""
+        query {{
+            mediaStatus(postId: {post_id}) {{
+                done
+                media {{ variants {{ width }} }}
+            }}
+        }}
+        """
+        response = client.post("/graphql/", json={"query": query})
+        status = response.json()["data"]["mediaStatus"]
+        assert status["done"] is True
+        assert [m["variants"][-1]["width"] for m in status["media"]] == widths